@@ -0,0 +1,358 @@
+"""
+Generate a synthetic MOSES dataset and time each publication stage on it.
+
+  python moses_benchmark.py --activities 20 --indicators 10 --years 3 --sparsity 0.5
+  python moses_benchmark.py ... --save-baseline
+  python moses_benchmark.py ... --baseline benchmark-baseline.json
+
+The dataset is written as CSV extracts (see README for loading them
+in PostgreSQL) and optionally as a SQLite database.
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import sqlite3
+import string
+import sys
+import time
+import tracemalloc
+
+try:
+  import resource
+except ImportError:
+  # Not available on Windows, only the Python allocations peak is reported
+  resource = None
+
+from moses_mapfile import *
+
+
+class SyntheticDataset:
+  """
+  MOSES extracts with NUTS levels 0 to 3, each region having
+  nutsBranching sub regions, and values for a share of the combinations.
+  """
+  SECTORS = ['Fisheries', 'Aquaculture', 'Transport', 'Tourism', 'Energy', 'Shipbuilding']
+  STATUSES = ['', 'e', 'p', 'c']
+
+  def __init__(self, nbOfActivities=10, nbOfIndicators=5, nbOfYears=3, nbOfCountries=10, nutsBranching=3,
+               sparsity=0.5, firstYear=2013, seed=1):
+    self.nbOfActivities = nbOfActivities
+    self.nbOfIndicators = nbOfIndicators
+    self.nbOfYears = nbOfYears
+    self.nbOfCountries = nbOfCountries
+    self.nutsBranching = nutsBranching
+    self.sparsity = sparsity
+    self.firstYear = firstYear
+    self.seed = seed
+
+  def getName(self):
+    return (f'a{self.nbOfActivities}-i{self.nbOfIndicators}-y{self.nbOfYears}'
+            f'-c{self.nbOfCountries}-b{self.nutsBranching}-s{self.sparsity}')
+
+  def getNutsIds(self):
+    """
+    NUTS ids by level, a NUTS id being its parent id plus one character.
+
+    :rtype: dict
+    """
+    letters = string.ascii_uppercase
+    characters = string.digits[1:] + letters
+    nutsIds = {0: [a + b for a in letters for b in letters][:self.nbOfCountries]}
+    for level in (1, 2, 3):
+      nutsIds[level] = [parent + characters[c] for parent in nutsIds[level - 1] for c in range(self.nutsBranching)]
+    return nutsIds
+
+  def getNutsExtents(self):
+    """
+    NUTS bounding boxes by id, countries being 4 degree squares of a grid over
+    Europe and sub regions vertical strips of their parent, so that tiling runs
+    have tiles to seed.
+
+    :rtype: dict
+    """
+    nutsIds = self.getNutsIds()
+    extents = {nutsId: (-10.0 + (c % 10) * 4, 36.0 + (c // 10) * 4, -6.0 + (c % 10) * 4, 40.0 + (c // 10) * 4)
+               for c, nutsId in enumerate(nutsIds[0])}
+    for level in (1, 2, 3):
+      for n, nutsId in enumerate(nutsIds[level]):
+        xmin, ymin, xmax, ymax = extents[nutsId[:-1]]
+        width = (xmax - xmin) / self.nutsBranching
+        c = n % self.nutsBranching
+        extents[nutsId] = (round(xmin + c * width, 6), ymin, round(xmin + (c + 1) * width, 6), ymax)
+    return extents
+
+  def getActivities(self):
+    return [(f'{a // 10 + 1:02d},{a % 10 + 1}', self.SECTORS[a % len(self.SECTORS)], f'Synthetic activity {a}')
+            for a in range(self.nbOfActivities)]
+
+  def getIndicators(self):
+    return [(f'V{11110 + i}', f'Synthetic indicator {i}', 'EUR' if i % 2 else '-')
+            for i in range(self.nbOfIndicators)]
+
+  def getValues(self):
+    """
+    Rows of NUTS id, activity, indicator, unit and one (value, status) per year,
+    value being None when missing.
+
+    :rtype: list
+    """
+    generator = random.Random(self.seed)
+    rows = []
+    for level, nutsIds in sorted(self.getNutsIds().items()):
+      for nutsId in nutsIds:
+        for activityId, sector, name in self.getActivities():
+          for indicatorId, indicatorName, unit in self.getIndicators():
+            if generator.random() >= self.sparsity:
+              continue
+            scale = 10 ** generator.randint(0, 4)
+            years = []
+            for y in range(self.nbOfYears):
+              if generator.random() < self.sparsity:
+                years.append((round(generator.lognormvariate(0, 1) * scale, 3), generator.choice(self.STATUSES)))
+              else:
+                years.append((None, ''))
+            rows.append((nutsId, activityId, indicatorId, unit, years))
+    return rows
+
+  def writeCsv(self, folder):
+    """
+    Write extracts in the format read by FileDataSource.
+    """
+    os.makedirs(folder, exist_ok=True)
+    self.writeCsvFile(os.path.join(folder, 'moses_NACES.csv'), ['nace_id', 'sector', 'nace_descr'], self.getActivities())
+    self.writeCsvFile(os.path.join(folder, 'moses_indicator.csv'), ['ind_id', 'ind_name', 'ind_unit'], self.getIndicators())
+    extents = self.getNutsExtents()
+    self.writeCsvFile(os.path.join(folder, 'nuts.csv'), ['nuts_id', 'levl_code', 'xmin', 'ymin', 'xmax', 'ymax'],
+                      [(nutsId, level) + extents[nutsId]
+                       for level, nutsIds in sorted(self.getNutsIds().items()) for nutsId in nutsIds])
+
+    header = ['nuts_id', 'nacescode', 'indicators', 'unit']
+    for y in range(self.nbOfYears):
+      header.extend([f'year{self.firstYear + y}', f'status_{y + 1}'])
+    header.extend(['data_sourc', 'website', 'remarks'])
+    rows = []
+    for nutsId, activityId, indicatorId, unit, years in self.getValues():
+      row = [nutsId, activityId, indicatorId, unit]
+      for value, status in years:
+        row.extend(['' if value is None else str(value).replace('.', ','), status])
+      rows.append(row + ['synthetic', '', ''])
+    self.writeCsvFile(os.path.join(folder, 'moses_values.csv'), header, rows)
+
+  def writeCsvFile(self, file, header, rows):
+    with open(file, 'w', newline='', encoding='latin-1') as csvFile:
+      writer = csv.writer(csvFile, delimiter=';')
+      writer.writerow(header)
+      writer.writerows(rows)
+
+  def writeSqlite(self, file):
+    """
+    Write a SQLite database with the tables read by SqliteDataSource.
+    """
+    if os.path.exists(file):
+      os.remove(file)
+    connection = sqlite3.connect(file)
+    connection.execute('CREATE TABLE moses_activities (id TEXT PRIMARY KEY, sector TEXT, name TEXT)')
+    connection.execute('CREATE TABLE moses_indicators (id TEXT PRIMARY KEY, name TEXT, unit TEXT)')
+    connection.execute('''CREATE TABLE nuts (nuts_id TEXT PRIMARY KEY, levl_code INTEGER,
+                            xmin REAL, ymin REAL, xmax REAL, ymax REAL)''')
+    connection.execute('''CREATE TABLE moses_indicator_values (nuts_id TEXT, nuts_level TEXT, activity_id TEXT,
+                            indicator_id TEXT, unit TEXT, year TEXT, value REAL, status TEXT, data_source TEXT,
+                            website TEXT, remarks TEXT)''')
+    connection.executemany('INSERT INTO moses_activities VALUES (?, ?, ?)', self.getActivities())
+    connection.executemany('INSERT INTO moses_indicators VALUES (?, ?, ?)', self.getIndicators())
+    nutsLevels = {}
+    for level, nutsIds in self.getNutsIds().items():
+      for nutsId in nutsIds:
+        nutsLevels[nutsId] = level
+    extents = self.getNutsExtents()
+    connection.executemany('INSERT INTO nuts VALUES (?, ?, ?, ?, ?, ?)',
+                           [(nutsId, level) + extents[nutsId] for nutsId, level in nutsLevels.items()])
+    connection.executemany('INSERT INTO moses_indicator_values VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           [(nutsId, str(nutsLevels[nutsId]), activityId, indicatorId, unit, str(self.firstYear + y),
+                             value, status, 'synthetic', '', '')
+                            for nutsId, activityId, indicatorId, unit, years in self.getValues()
+                            for y, (value, status) in enumerate(years)
+                            if value is not None])
+    connection.commit()
+    connection.close()
+
+
+class BenchmarkPublication(MosesPublication):
+  """
+  Publication whose stages are run one by one by the benchmark.
+  """
+
+  def publish(self):
+    pass
+
+
+class Benchmark:
+  """
+  Time, throughput and peak memory of each publication stage.
+  """
+
+  def __init__(self, dataSource, folder, numberOfWorkers=1):
+    self.dataSource = dataSource
+    self.folder = folder
+    self.numberOfWorkers = numberOfWorkers
+    self.results = {}
+
+  def measure(self, stage, function):
+    """
+    Run a stage and record its duration and the peak of Python allocations.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    self.results[stage] = {'seconds': round(seconds, 4), 'peakMemoryMb': round(peak / 1024 / 1024, 2)}
+    return result
+
+  def report(self, nbOfLayers):
+    for stage, result in self.results.items():
+      result['layers'] = nbOfLayers
+      result['layersPerSecond'] = round(nbOfLayers / result['seconds'], 1) if result['seconds'] > 0 else None
+      print(f"{stage:<15} {result['seconds']:>10.3f}s {result['layersPerSecond'] or 0:>12.1f} layers/s "
+            f"{result['peakMemoryMb']:>10.2f} MB")
+
+  def getOptions(self, suffix):
+    return {'map': os.path.join(self.folder, f'moses{suffix}.map'),
+            'maptime': os.path.join(self.folder, f'moses{suffix}-time.map'),
+            'context': os.path.join(self.folder, f'moses{suffix}.xml'),
+            'contexttime': os.path.join(self.folder, f'moses{suffix}-time.xml'),
+            'manifest': None,
+            'isIncremental': False,
+            'isAddingLayerToQgisProject': importQgis()}
+
+  def getRecords(self, statistics, classes):
+    """
+    Layer records of all combinations, as built by a publication.
+
+    :rtype: list
+    """
+    activityLabels = {activityId: name for activityId, sector, name in self.dataSource.getActivities()}
+    indicatorLabels = self.dataSource.getIndicatorLabels()
+    records = []
+    for activityId, activityStatistics in sorted(statistics.items()):
+      for indicator, indicatorStatistics in sorted(activityStatistics.items()):
+        for nutsLevel, levelStatistics in sorted(indicatorStatistics.items()):
+          for year, yearStatistics in sorted(levelStatistics.items()):
+            layerCode = f"MOSES.Benchmark.{activityId.replace(',', '')}.{indicator}.NUTS{nutsLevel}.{year}"
+            records.append(LayerRecord(layerCode, layerCode, ','.join(yearStatistics.nutsIds), nutsLevel, activityId,
+                                       indicator, year, classes[activityId][indicator][nutsLevel][year],
+                                       activityLabels.get(activityId), indicatorLabels.get(indicator)))
+    return records
+
+  def writeLayers(self, builder, records):
+    builder.writeHeader()
+    for record in records:
+      builder.writeLayer(record)
+    builder.writeFooter()
+
+  def addQgisLayers(self, publication, records):
+    projectBuilder = QgisProjectBuilder()
+    for record in records:
+      for vlayer in publication.createFilteredLayers(record.layerCode, record.level, record.activity, record.indicator,
+                                                     record.year, record.categories):
+        projectBuilder.addLayer((record.activityFullLabel, record.indicatorFullLabel, f'Nuts{record.level}'), vlayer)
+    projectBuilder.build()
+
+  def run(self):
+    publication = BenchmarkPublication(self.dataSource, wmsTimeLayerMode=False, **self.getOptions('-stages'))
+    publication.createBuilders()
+
+    statistics = self.measure('statistics', lambda: publication.dataSource.getIndicatorStatistics(publication.nutsLevels))
+    classes = self.measure('classification', lambda: publication.classifyStatistics(statistics))
+    records = self.getRecords(statistics, classes)
+
+    self.measure('mapfile', lambda: self.writeLayers(publication.mapBuilder, records))
+    self.measure('context', lambda: self.writeLayers(publication.contextBuilder, records))
+    if importQgis():
+      self.measure('qgis', lambda: self.addQgisLayers(publication, records))
+
+    # Whole publication, including time layers and activity contexts
+    self.measure('publication', lambda: MosesPublication(self.dataSource, numberOfWorkers=self.numberOfWorkers,
+                                                         **self.getOptions('')))
+    self.report(len(records))
+    if resource is not None:
+      maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+      # Kilobytes on Linux, bytes on macOS
+      self.results['maxResidentMemoryMb'] = round(maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 2)
+    return self.results
+
+
+def compareToBaseline(results, baseline, tolerance):
+  """
+  Stages whose throughput dropped by more than the tolerance.
+
+  :rtype: list
+  """
+  regressions = []
+  for stage, result in results.items():
+    if not isinstance(result, dict) or stage not in baseline or not result['layersPerSecond']:
+      continue
+    reference = baseline[stage]['layersPerSecond']
+    ratio = result['layersPerSecond'] / reference if reference else 1
+    print(f"{stage:<15} {result['layersPerSecond']:>12.1f} layers/s, baseline {reference:>12.1f} ({ratio:.0%})")
+    if ratio < 1 - tolerance:
+      regressions.append(stage)
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark MOSES publication stages on a synthetic dataset.')
+  parser.add_argument('--activities', type=int, default=10)
+  parser.add_argument('--indicators', type=int, default=5)
+  parser.add_argument('--years', type=int, default=3)
+  parser.add_argument('--countries', type=int, default=10)
+  parser.add_argument('--branching', type=int, default=3, help='Number of sub regions of each NUTS region')
+  parser.add_argument('--sparsity', type=float, default=0.5, help='Share of combinations and years having a value')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--folder', default='benchmark')
+  parser.add_argument('--source', choices=['csv', 'sqlite'], default='csv')
+  parser.add_argument('--workers', type=int, default=1)
+  parser.add_argument('--baseline', default='benchmark-baseline.json')
+  parser.add_argument('--save-baseline', action='store_true')
+  parser.add_argument('--tolerance', type=float, default=0.2, help='Accepted throughput drop before failing')
+  args = parser.parse_args()
+
+  dataset = SyntheticDataset(args.activities, args.indicators, args.years, args.countries, args.branching,
+                             args.sparsity, seed=args.seed)
+  dataFolder = os.path.join(args.folder, dataset.getName())
+  dataset.writeCsv(dataFolder)
+  if args.source == 'sqlite':
+    dataset.writeSqlite(os.path.join(dataFolder, 'moses.sqlite'))
+    dataSource = SqliteDataSource(os.path.join(dataFolder, 'moses.sqlite'))
+  else:
+    dataSource = FileDataSource(dataFolder)
+
+  outputFolder = os.path.join(dataFolder, 'output')
+  os.makedirs(outputFolder, exist_ok=True)
+  results = Benchmark(dataSource, outputFolder, args.workers).run()
+
+  baselines = {}
+  if os.path.exists(args.baseline):
+    with open(args.baseline) as baselineFile:
+      baselines = json.load(baselineFile)
+  scenario = f'{dataset.getName()}-{args.source}-w{args.workers}'
+  regressions = []
+  if scenario in baselines:
+    regressions = compareToBaseline(results, baselines[scenario], args.tolerance)
+  if args.save_baseline:
+    baselines[scenario] = results
+    with open(args.baseline, 'w') as baselineFile:
+      json.dump(baselines, baselineFile, indent=2, sort_keys=True)
+    print(f'Baseline of {scenario} saved in {args.baseline}.')
+
+  print(json.dumps(results, indent=2))
+  if len(regressions) > 0:
+    print(f"Throughput regression on {', '.join(regressions)}.")
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,9 +1,181 @@
-from qgis.utils import *
-from qgis.core import *
-
+import abc
+import argparse
+import concurrent.futures
+import contextlib
+import csv
+import hashlib
+import heapq
+import json
+import multiprocessing
 import re
 import os
+import shutil
+import string
+import struct
+import sys
 import time
+import urllib.parse
+import xml.sax.saxutils
+import zlib
+
+import numpy
+
+# None until QGIS is imported by importQgis
+QGIS_AVAILABLE = None
+
+
+def importQgis():
+  """
+  Import QGIS in the module namespace when first needed (QGIS data source or project),
+  so that mapfiles and contexts are built without loading it.
+
+  :rtype: bool
+  """
+  global QGIS_AVAILABLE
+  if QGIS_AVAILABLE is None:
+    try:
+      import qgis.utils
+      import qgis.core
+      for module in (qgis.utils, qgis.core):
+        for name in dir(module):
+          if not name.startswith('_'):
+            globals().setdefault(name, getattr(module, name))
+      QGIS_AVAILABLE = True
+    except ImportError:
+      # Mapfiles and contexts can still be built from a DB-API or file data source
+      QGIS_AVAILABLE = False
+  return QGIS_AVAILABLE
+
+
+if 'qgis.core' in sys.modules:
+  # Running in QGIS, which is already loaded
+  importQgis()
+
+
+class OutputSink:
+  """
+  Output file opened once and written through a large buffer
+  until closed.
+  """
+  BUFFER_SIZE = 1024 * 1024
+
+  def __init__(self, file):
+    self.file = file
+    self.stream = None
+
+  def open(self):
+    self.stream = open(self.file, "w", buffering=self.BUFFER_SIZE)
+
+  def write(self, text):
+    self.stream.write(text)
+
+  def close(self):
+    self.stream.close()
+    self.stream = None
+
+
+class NullSink:
+  """
+  Output of a stage which is not run, discarding what is written.
+  """
+
+  def __init__(self, file=None):
+    self.file = file
+
+  def open(self):
+    pass
+
+  def write(self, text):
+    pass
+
+  def close(self):
+    pass
+
+
+class CompiledTemplate:
+  """
+  Format template with values which are the same for all layers
+  (eg. project name, DB connection) substituted once.
+  """
+
+  def __init__(self, template):
+    self.template = template
+
+  def bind(self, **values):
+    """
+    Substitute the given fields and keep the others for render.
+
+    :rtype: CompiledTemplate
+    """
+    template = ""
+    for literal, field, formatSpec, conversion in string.Formatter().parse(self.template):
+      template = template + literal.replace('{', '{{').replace('}', '}}')
+      if field is None:
+        continue
+      if field in values:
+        template = template + str(values[field]).replace('{', '{{').replace('}', '}}')
+      else:
+        template = template + '{' + field + (f'!{conversion}' if conversion else '') + (f':{formatSpec}' if formatSpec else '') + '}'
+    return CompiledTemplate(template)
+
+  def render(self, **values):
+    return self.template.format(**values)
+
+
+class LayerRecord:
+  """
+  One layer as written in the mapfile and the contexts.
+  """
+
+  def __init__(self, layerCode, layerTitle, layerAbstract, level, activity, indicator, year, categories,
+               activityFullLabel, indicatorFullLabel, asTime=False, dbTable='moses_indicator_values', listOfYears=(2013, 2014, 2015),
+               extent=None, legend=None, vectorData=None, baseLayer=None):
+    self.layerCode = layerCode
+    self.layerTitle = layerTitle
+    self.layerAbstract = layerAbstract
+    self.level = level
+    self.activity = activity
+    self.indicator = indicator
+    self.year = year
+    self.categories = categories
+    self.activityFullLabel = activityFullLabel
+    self.indicatorFullLabel = indicatorFullLabel
+    self.asTime = asTime
+    self.dbTable = dbTable
+    self.listOfYears = listOfYears
+    # Bounding box (minx, miny, maxx, maxy) of the NUTS having data, None if unknown
+    self.extent = extent
+    # Static legend (URL, width, height), None for the MapServer legend
+    self.legend = legend
+    # Exported values (values URL, manifest URL), None when not exporting vectors
+    self.vectorData = vectorData
+    # "No data" layer of the level drawn below, None when the layer draws all NUTS
+    self.baseLayer = baseLayer
+
+    groupTokens = layerCode.replace('.', '/').split('/')
+    groupTokens.pop()
+    groupTokens.pop(0)
+    groupTokens[1] = activityFullLabel
+    groupTokens[2] = indicatorFullLabel
+    self.layerGroup = '/'.join(groupTokens)
+
+    # WMS layer and request parameters, when publishing a parameterized layer
+    self.wmsName = layerCode
+    self.wmsParameters = {}
+
+
+class QueryShape:
+  """
+  Table of a layer query with the columns it is filtered on by equality,
+  the column joining NUTS regions and the columns read from matching rows.
+  """
+
+  def __init__(self, table, filterColumns, joinColumn, includeColumns, geometryColumn=None):
+    self.table = table
+    self.filterColumns = filterColumns
+    self.joinColumn = joinColumn
+    self.includeColumns = includeColumns
+    self.geometryColumn = geometryColumn
 
 
 class ContextBuilder:
@@ -34,50 +206,514 @@ class ContextBuilder:
       <ows:Title>OpenStreetMap</ows:Title>
     </ows-context:Layer>"""
 
-    LAYER = """<ows-context:Layer name="{layerCode}" group="/{layerGroup}" hidden="true" opacity="1" groupcombo="moses">
+    LAYER = """<ows-context:Layer name="{layerName}" group="/{layerGroup}" hidden="true" opacity="1" groupcombo="moses">
       <ows:Title>{year}</ows:Title>
       <ows-context:Server service="urn:ogc:serviceType:WMS" version="1.3.0">
-        <ows-context:OnlineResource xlink:href="{wmsUrl}"/>
-      </ows-context:Server>
-      <ows-context:Extension>
+        <ows-context:OnlineResource xlink:href="{wmsUrl}{wmsQuery}"/>
+      </ows-context:Server>{boundingBox}{styleList}
+      <ows-context:Extension>{vectorData}
         <ows-context:MetadataUrlList/>
         <ows-context:QIList/>
       </ows-context:Extension>
     </ows-context:Layer>"""
 
+    BOUNDINGBOX = """
+      <ows:BoundingBox crs="urn:ogc:def:crs:OGC:1.3:CRS84">
+        <ows:LowerCorner>{minx} {miny}</ows:LowerCorner>
+        <ows:UpperCorner>{maxx} {maxy}</ows:UpperCorner>
+      </ows:BoundingBox>"""
+
+    STYLELIST = """
+      <ows-context:StyleList>
+        <ows-context:Style current="1">
+          <ows-context:Name>default</ows-context:Name>
+          <ows-context:Title>default</ows-context:Title>
+          <ows-context:LegendURL width="{width}" height="{height}" format="image/png">
+            <ows-context:OnlineResource xlink:type="simple" xlink:href="{url}"/>
+          </ows-context:LegendURL>
+        </ows-context:Style>
+      </ows-context:StyleList>"""
+
+    VECTORDATA = """
+        <ows-context:VectorData valuesUrl="{valuesUrl}" manifestUrl="{manifestUrl}" level="{level}" year="{year}"/>"""
+
     FOOTER = """
   </ows-context:ResourceList>
 </ows-context:OWSContext>"""
 
 
-    def __init__(self, file):
+    def __init__(self, file, wmsUrl):
         self.file = file
+        self.wmsUrl = wmsUrl
+        self.sink = OutputSink(file)
+        self.layerTemplate = CompiledTemplate(self.LAYER).bind(wmsUrl=wmsUrl)
+        self.boundingBoxTemplate = CompiledTemplate(self.BOUNDINGBOX)
+        self.styleListTemplate = CompiledTemplate(self.STYLELIST)
+        self.vectorDataTemplate = CompiledTemplate(self.VECTORDATA)
 
     def writeHeader(self):
-        contextFile = open(self.file, "w+")
-        contextFile.write(self.HEADER)
-        contextFile.close()
-
-    def writeLayer(self, layerCode, wmsUrl, activityFullLabel, indicatorFullLabel, year):
-        contextFile = open(self.file, "a+")
-
-        groupTokens = layerCode.replace('.', '/').split('/')
-        groupTokens.pop()
-        groupTokens.pop(0)
-        groupTokens[1] = activityFullLabel
-        groupTokens[2] = indicatorFullLabel
-
-        layerConfig = f"" + self.LAYER.format(layerCode=layerCode,
-                                              layerGroup='/'.join(groupTokens),
-                                              wmsUrl=wmsUrl,
-                                              year=year)
-        contextFile.write(layerConfig)
-        contextFile.close()
+        self.sink.open()
+        self.sink.write(self.HEADER)
+
+    def renderLayer(self, record):
+        wmsQuery = ''
+        if len(record.wmsParameters) > 0:
+            wmsQuery = ('&amp;' if '?' in self.wmsUrl else '?') + '&amp;'.join(
+                f'{name}={urllib.parse.quote(str(value))}' for name, value in record.wmsParameters.items())
+        boundingBox = ''
+        if record.extent is not None:
+            minx, miny, maxx, maxy = record.extent
+            boundingBox = self.boundingBoxTemplate.render(minx=minx, miny=miny, maxx=maxx, maxy=maxy)
+        styleList = ''
+        if record.legend is not None:
+            url, width, height = record.legend
+            styleList = self.styleListTemplate.render(url=url, width=width, height=height)
+        vectorData = ''
+        if record.vectorData is not None:
+            valuesUrl, manifestUrl = record.vectorData
+            vectorData = self.vectorDataTemplate.render(valuesUrl=xml.sax.saxutils.escape(valuesUrl),
+                                                        manifestUrl=xml.sax.saxutils.escape(manifestUrl),
+                                                        level=record.level,
+                                                        year='' if record.asTime else record.year)
+        # Layers only having NUTS with data are requested with the base layer of their level
+        layerName = record.wmsName if record.baseLayer is None else f'{record.baseLayer},{record.wmsName}'
+        return self.layerTemplate.render(layerName=layerName,
+                                         layerGroup=record.layerGroup,
+                                         wmsQuery=wmsQuery,
+                                         boundingBox=boundingBox,
+                                         styleList=styleList,
+                                         vectorData=vectorData,
+                                         year='' if record.asTime else record.year)
+
+    def writeLayer(self, record):
+        self.sink.write(self.renderLayer(record))
 
     def writeFooter(self):
-        contextFile = open(self.file, "a+")
-        contextFile.write(f"" + self.FOOTER)
-        contextFile.close()
+        self.sink.write(self.FOOTER)
+        self.sink.close()
+
+
+class CapabilitiesBuilder:
+  """
+  Static WMS 1.3.0 capabilities document of a mapfile, built from the layer records
+  so that clients do not wait for MapServer to parse thousands of layers.
+
+  Layers are nested in groups following their wms_layer_group path. Layer blocks
+  do not depend on the service URL and can be shared by several documents.
+  """
+  HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<WMS_Capabilities version="1.3.0" xmlns="http://www.opengis.net/wms" xmlns:xlink="http://www.w3.org/1999/xlink" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.opengis.net/wms http://schemas.opengis.net/wms/1.3.0/capabilities_1_3_0.xsd">
+  <Service>
+    <Name>WMS</Name>
+    <Title>{projectName}</Title>
+    <Abstract>Web Map Service for MOSES</Abstract>
+    <KeywordList>
+      <Keyword>MOSES</Keyword>
+      <Keyword>Sextant</Keyword>
+      <Keyword>Inspire</Keyword>
+      <Keyword>OGC</Keyword>
+      <Keyword>WMS</Keyword>
+      <Keyword>Ifremer</Keyword>
+      <Keyword>infoMapAccessService</Keyword>
+    </KeywordList>
+    <OnlineResource xlink:type="simple" xlink:href="{wmsUrl}"/>
+    <ContactInformation>
+      <ContactPersonPrimary>
+        <ContactPerson>Equipe Sextant</ContactPerson>
+        <ContactOrganization>Ifremer</ContactOrganization>
+      </ContactPersonPrimary>
+      <ContactPosition>distributor</ContactPosition>
+      <ContactElectronicMailAddress>sextant@ifremer.fr</ContactElectronicMailAddress>
+    </ContactInformation>
+    <Fees>conditions unknown</Fees>
+    <AccessConstraints>None</AccessConstraints>
+  </Service>
+  <Capability>
+    <Request>
+      <GetCapabilities>
+        <Format>text/xml</Format>
+        <DCPType><HTTP><Get><OnlineResource xlink:type="simple" xlink:href="{requestUrl}"/></Get></HTTP></DCPType>
+      </GetCapabilities>
+      <GetMap>
+        <Format>image/png</Format>
+        <Format>image/jpeg</Format>
+        <DCPType><HTTP><Get><OnlineResource xlink:type="simple" xlink:href="{requestUrl}"/></Get></HTTP></DCPType>
+      </GetMap>
+      <GetFeatureInfo>
+        <Format>text/plain</Format>
+        <Format>application/vnd.ogc.gml</Format>
+        <DCPType><HTTP><Get><OnlineResource xlink:type="simple" xlink:href="{requestUrl}"/></Get></HTTP></DCPType>
+      </GetFeatureInfo>
+    </Request>
+    <Exception>
+      <Format>XML</Format>
+      <Format>INIMAGE</Format>
+      <Format>BLANK</Format>
+    </Exception>
+    <Layer>
+      <Title>{projectName}</Title>
+      <Abstract>Web Map Service for MOSES</Abstract>
+      <CRS>CRS:84</CRS>
+      <CRS>EPSG:4326</CRS>
+      <CRS>EPSG:27582</CRS>
+      <CRS>EPSG:3395</CRS>
+      <CRS>EPSG:2154</CRS>
+      <CRS>EPSG:3857</CRS>{boundingBox}
+"""
+
+  LAYER = """
+      <Layer queryable="1" opaque="0">
+        <Name>{layerName}</Name>
+        <Title>{layerTitle}</Title>
+        <Abstract>{layerAbstract}</Abstract>
+        <CRS>EPSG:{srid}</CRS>{boundingBox}{dimension}
+        <Attribution>
+          <Title>{projectName}</Title>
+          <OnlineResource xlink:type="simple" xlink:href="http://mosesproject.eu/"/>
+        </Attribution>
+        <Style>
+          <Name>default</Name>
+          <Title>default</Title>
+          <LegendURL{legendSize}>
+            <Format>image/png</Format>
+            <OnlineResource xlink:type="simple" xlink:href="{legendUrl}"/>
+          </LegendURL>
+        </Style>
+      </Layer>"""
+
+  BOUNDINGBOX = """
+        <EX_GeographicBoundingBox>
+          <westBoundLongitude>{minx}</westBoundLongitude>
+          <eastBoundLongitude>{maxx}</eastBoundLongitude>
+          <southBoundLatitude>{miny}</southBoundLatitude>
+          <northBoundLatitude>{maxy}</northBoundLatitude>
+        </EX_GeographicBoundingBox>
+        <BoundingBox CRS="CRS:84" minx="{minx}" miny="{miny}" maxx="{maxx}" maxy="{maxy}"/>
+        <BoundingBox CRS="EPSG:4326" minx="{miny}" miny="{minx}" maxx="{maxy}" maxy="{maxx}"/>"""
+
+  # Bounding box in the projected SRS of the layers
+  PROJECTED_BOUNDINGBOX = """
+        <BoundingBox CRS="EPSG:{srid}" minx="{minx}" miny="{miny}" maxx="{maxx}" maxy="{maxy}"/>"""
+
+  DIMENSION = """
+        <Dimension name="time" units="ISO8601" default="{lastYear}" nearestValue="0">{listOfYears}</Dimension>"""
+
+  GROUP_HEADER = """
+      <Layer>
+        <Title>{title}</Title>"""
+
+  GROUP_FOOTER = """
+      </Layer>"""
+
+  FOOTER = """
+    </Layer>
+  </Capability>
+</WMS_Capabilities>
+"""
+
+  # Service URL of layer blocks, substituted when writing a document
+  WMS_URL_TOKEN = '%wmsurl%'
+
+  LEGEND_QUERY = 'SERVICE=WMS&amp;VERSION=1.3.0&amp;REQUEST=GetLegendGraphic&amp;FORMAT=image/png&amp;SLD_VERSION=1.1.0&amp;LAYER={layerName}'
+
+  # Apache configuration answering GetCapabilities requests with the static documents
+  SERVER_CONFIG_HEADER = """# Static WMS 1.3.0 capabilities, written by moses_mapfile.py
+Alias "{alias}" "{folder}/"
+<Directory "{folder}">
+  <FilesMatch "-capabilities\\.xml$">
+    Require all granted
+    ForceType text/xml
+  </FilesMatch>
+</Directory>
+
+RewriteEngine On
+"""
+
+  SERVER_CONFIG_SERVICE = """
+RewriteCond %{{QUERY_STRING}} (^|&)request=GetCapabilities(&|$) [NC]
+RewriteCond %{{QUERY_STRING}} !(^|&)version=1\\.[01]\\. [NC]
+RewriteRule ^{path}$ {alias}{file} [PT,L]
+"""
+
+  def __init__(self, file, wmsUrl, projectName, srid=4326):
+    self.file = file
+    self.wmsUrl = wmsUrl
+    self.projectName = projectName
+    self.srid = srid
+    self.sink = OutputSink(file)
+    self.layers = []
+    self.layerTemplate = CompiledTemplate(self.LAYER).bind(projectName=xml.sax.saxutils.escape(projectName), srid=srid)
+    self.boundingBoxTemplate = CompiledTemplate(self.BOUNDINGBOX)
+    self.dimensionTemplate = CompiledTemplate(self.DIMENSION)
+
+  def writeHeader(self):
+    self.sink.open()
+    self.layers = []
+    requestUrl = xml.sax.saxutils.escape(self.wmsUrl + ('&' if '?' in self.wmsUrl else '?'))
+    self.sink.write(self.HEADER.format(projectName=xml.sax.saxutils.escape(self.projectName),
+                                       wmsUrl=xml.sax.saxutils.escape(self.wmsUrl),
+                                       requestUrl=requestUrl,
+                                       boundingBox=self.renderBoundingBox(MapfileBuilder.WORLD_EXTENT)))
+
+  def renderBoundingBox(self, extent):
+    minx, miny, maxx, maxy = extent
+    boundingBox = self.boundingBoxTemplate.render(minx=minx, miny=miny, maxx=maxx, maxy=maxy)
+    if self.srid != 4326:
+      minx, miny, maxx, maxy = MapfileBuilder.projectExtent(extent, self.srid)
+      boundingBox = boundingBox + self.PROJECTED_BOUNDINGBOX.format(srid=self.srid, minx=minx, miny=miny, maxx=maxx, maxy=maxy)
+    return boundingBox
+
+  def renderLayer(self, record):
+    """
+    Group path and Layer element of a layer record.
+
+    :rtype: list
+    """
+    dimension = ''
+    if record.asTime:
+      dimension = self.dimensionTemplate.render(listOfYears=','.join(str(x) for x in record.listOfYears),
+                                                lastYear=record.listOfYears[0])
+    layerName = xml.sax.saxutils.escape(record.wmsName)
+    legendUrl = self.WMS_URL_TOKEN + self.LEGEND_QUERY.format(layerName=layerName)
+    legendSize = ''
+    if record.legend is not None:
+      url, width, height = record.legend
+      legendUrl = xml.sax.saxutils.escape(url)
+      legendSize = f' width="{width}" height="{height}"'
+    return [record.layerGroup,
+            self.layerTemplate.render(layerName=layerName,
+                                      layerTitle=xml.sax.saxutils.escape(str(record.layerTitle)),
+                                      layerAbstract=xml.sax.saxutils.escape(str(record.layerAbstract)),
+                                      boundingBox=self.renderBoundingBox(record.extent or MapfileBuilder.WORLD_EXTENT),
+                                      dimension=dimension,
+                                      legendUrl=legendUrl,
+                                      legendSize=legendSize)]
+
+  def renderBaseLayer(self, layerName, layerTitle):
+    """
+    Group path and Layer element of a "No data" base layer.
+
+    :rtype: list
+    """
+    layerName = xml.sax.saxutils.escape(layerName)
+    return [MapfileBuilder.BASE_LAYER_GROUP,
+            self.layerTemplate.render(layerName=layerName,
+                                      layerTitle=xml.sax.saxutils.escape(layerTitle),
+                                      layerAbstract='',
+                                      boundingBox=self.renderBoundingBox(MapfileBuilder.WORLD_EXTENT),
+                                      dimension='',
+                                      legendUrl=self.WMS_URL_TOKEN + self.LEGEND_QUERY.format(layerName=layerName),
+                                      legendSize='')]
+
+  def addLayer(self, block):
+    self.layers.append(block)
+
+  def writeFooter(self):
+    # Groups of a path are merged as by MapServer, in order of first appearance
+    root = {'groups': {}, 'items': []}
+    for layerGroup, layer in self.layers:
+      node = root
+      for title in [t for t in layerGroup.split('/') if t != '']:
+        if title not in node['groups']:
+          node['groups'][title] = {'groups': {}, 'items': []}
+          node['items'].append((title, node['groups'][title]))
+        node = node['groups'][title]
+      node['items'].append((None, layer))
+
+    wmsUrl = xml.sax.saxutils.escape(self.wmsUrl + ('&' if '?' in self.wmsUrl else '?'))
+    self.writeItems(root['items'], wmsUrl)
+    self.sink.write(self.FOOTER)
+    self.sink.close()
+
+  def writeItems(self, items, wmsUrl):
+    for title, item in items:
+      if title is None:
+        self.sink.write(item.replace(self.WMS_URL_TOKEN, wmsUrl))
+      else:
+        self.sink.write(self.GROUP_HEADER.format(title=xml.sax.saxutils.escape(title)))
+        self.writeItems(item['items'], wmsUrl)
+        self.sink.write(self.GROUP_FOOTER)
+
+  @classmethod
+  def writeServerConfig(cls, file, alias, services):
+    """
+    Apache configuration serving the capabilities documents of the services,
+    given as (WMS URL, capabilities file). Documents are served from
+    the folder of the first one.
+    Raise a ValueError when services share a URL path, as one document would never be served.
+    """
+    folder = os.path.dirname(os.path.abspath(services[0][1])).replace('\\', '/')
+    paths = set()
+    with open(file, 'w') as configFile:
+      configFile.write(cls.SERVER_CONFIG_HEADER.format(alias=alias, folder=folder))
+      for wmsUrl, capabilitiesFile in services:
+        path = urllib.parse.urlparse(wmsUrl).path
+        if path in paths:
+          raise ValueError(f'Capabilities of {capabilitiesFile} can not be served, another service uses the URL path {path}.')
+        paths.add(path)
+        configFile.write(cls.SERVER_CONFIG_SERVICE.format(path=re.escape(path), alias=alias,
+                                                          file=os.path.basename(capabilitiesFile)))
+
+
+class TileCacheBuilder:
+  """
+  MapCache configuration with one tileset per mapfile layer, and seeding plan
+  of the tiles of each layer intersecting the NUTS having data, at the zoom
+  levels of its NUTS level. Layers only having the NUTS with data are cached
+  over the "No data" base layer of their level, as requested by contexts.
+
+  Tiles are the column and row (from the top left corner) of the GoogleMapsCompatible
+  grid, found from the bounding boxes of the polygons of each NUTS when geometries are
+  available, so that multipart NUTS (eg. with islands or overseas regions) do not seed
+  the sea between their parts, or else from the NUTS bounding boxes. The plan is sorted
+  by layer, zoom, column and row, so that it only depends on the layers and the NUTS.
+  """
+  HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<mapcache>
+  <cache name="moses" type="disk">
+    <base>{cacheFolder}</base>
+  </cache>
+"""
+
+  LAYER = """
+  <source name="{layerName}" type="wms">
+    <getmap>
+      <params>
+        <FORMAT>image/png</FORMAT>
+        <LAYERS>{wmsLayers}</LAYERS>
+        <TRANSPARENT>true</TRANSPARENT>
+      </params>
+    </getmap>
+    <http>
+      <url>{wmsUrl}</url>
+    </http>
+  </source>
+  <tileset name="{layerName}">
+    <source>{layerName}</source>
+    <cache>moses</cache>
+    <grid restricted_extent="{extent}" minzoom="{minZoom}" maxzoom="{maxZoom}">GoogleMapsCompatible</grid>
+    <format>PNG</format>
+    <metatile>1 1</metatile>
+  </tileset>
+"""
+
+  FOOTER = """
+  <service type="wms" enabled="true"/>
+  <service type="wmts" enabled="true"/>
+  <errors>empty_img</errors>
+</mapcache>
+"""
+
+  SEED_HEADER = 'tileset,zoom,column,row\n'
+
+  # Latitude limit of the GoogleMapsCompatible grid
+  MERCATOR_MAX_LATITUDE = 85.0511287798066
+
+  def __init__(self, file, seedFile, wmsUrl, cacheFolder, nutsExtents, zoomLevels, nutsPartExtents=None):
+    self.file = file
+    self.seedFile = seedFile
+    self.wmsUrl = wmsUrl
+    self.cacheFolder = cacheFolder
+    self.nutsExtents = nutsExtents
+    self.nutsPartExtents = nutsPartExtents or {}
+    self.zoomLevels = zoomLevels
+    self.sink = OutputSink(file)
+    self.seedSink = OutputSink(seedFile)
+    self.layerTemplate = CompiledTemplate(self.LAYER).bind(wmsUrl=xml.sax.saxutils.escape(wmsUrl))
+    # Tiles of each NUTS by zoom level, shared by all layers
+    self.nutsTiles = {}
+    self.numberOfTiles = 0
+
+  def writeHeader(self):
+    self.sink.open()
+    self.seedSink.open()
+    self.numberOfTiles = 0
+    self.sink.write(self.HEADER.format(cacheFolder=xml.sax.saxutils.escape(self.cacheFolder)))
+    self.seedSink.write(self.SEED_HEADER)
+
+  def getTileRanges(self, extent, zoom):
+    """
+    First and last column and row of the tiles of a CRS84 bounding box.
+
+    :rtype: tuple
+    """
+    minx, miny, maxx, maxy = extent
+    n = 2 ** zoom
+    columns = numpy.floor((numpy.array([minx, maxx]) + 180) / 360 * n)
+    latitudes = numpy.radians(numpy.clip([maxy, miny], -self.MERCATOR_MAX_LATITUDE, self.MERCATOR_MAX_LATITUDE))
+    rows = numpy.floor((1 - numpy.log(numpy.tan(latitudes) + 1 / numpy.cos(latitudes)) / numpy.pi) / 2 * n)
+    columns = numpy.clip(columns, 0, n - 1).astype(int)
+    rows = numpy.clip(rows, 0, n - 1).astype(int)
+    return columns[0], rows[0], columns[1], rows[1]
+
+  def getNutsTiles(self, nutsId, zoom):
+    """
+    Tiles of a NUTS at a zoom level, as column * 2 ** zoom + row.
+
+    :rtype: numpy.ndarray
+    """
+    key = (nutsId, zoom)
+    tiles = self.nutsTiles.get(key)
+    if tiles is None:
+      arrays = []
+      for extent in self.nutsPartExtents.get(nutsId) or [self.nutsExtents[nutsId]]:
+        minColumn, minRow, maxColumn, maxRow = self.getTileRanges(extent, zoom)
+        columns, rows = numpy.meshgrid(numpy.arange(minColumn, maxColumn + 1, dtype=numpy.int64),
+                                       numpy.arange(minRow, maxRow + 1, dtype=numpy.int64))
+        arrays.append((columns * 2 ** zoom + rows).ravel())
+      tiles = numpy.unique(numpy.concatenate(arrays))
+      self.nutsTiles[key] = tiles
+    return tiles
+
+  def getTiles(self, nutsLevel, nutsIds):
+    """
+    Sorted (zoom, column, row) of the tiles intersecting NUTS at the zoom levels of their level.
+    NUTS without bounding box nor geometry are ignored.
+
+    :rtype: list
+    """
+    minZoom, maxZoom = self.zoomLevels[nutsLevel]
+    tiles = []
+    for zoom in range(minZoom, maxZoom + 1):
+      arrays = [self.getNutsTiles(nutsId, zoom) for nutsId in nutsIds
+                if nutsId in self.nutsExtents or nutsId in self.nutsPartExtents]
+      if len(arrays) == 0:
+        continue
+      for tile in numpy.unique(numpy.concatenate(arrays)).tolist():
+        tiles.append((zoom, tile // 2 ** zoom, tile % 2 ** zoom))
+    return tiles
+
+  def renderExtent(self, extent):
+    """
+    GoogleMapsCompatible extent in meters of a CRS84 bounding box.
+
+    :rtype: str
+    """
+    return ' '.join(f'{c:.2f}' for c in MapfileBuilder.projectExtent(extent, 3857))
+
+  def addLayer(self, layerName, nutsLevel, nutsIds, extent=None, baseLayer=None):
+    """
+    Write the tileset of a layer and the tiles to seed. Layers without
+    NUTS bounding box or outside of the zoom levels are not cached.
+    """
+    if nutsLevel not in self.zoomLevels:
+      return
+    tiles = self.getTiles(nutsLevel, nutsIds)
+    if len(tiles) == 0:
+      return
+    minZoom, maxZoom = self.zoomLevels[nutsLevel]
+    wmsLayers = layerName if baseLayer is None else f'{baseLayer},{layerName}'
+    self.sink.write(self.layerTemplate.render(layerName=xml.sax.saxutils.escape(layerName),
+                                              wmsLayers=xml.sax.saxutils.escape(wmsLayers),
+                                              extent=self.renderExtent(extent or MapfileBuilder.WORLD_EXTENT),
+                                              minZoom=minZoom, maxZoom=maxZoom))
+    self.seedSink.write(''.join(f'{layerName},{zoom},{column},{row}\n' for zoom, column, row in tiles))
+    self.numberOfTiles = self.numberOfTiles + len(tiles)
+
+  def writeFooter(self):
+    self.sink.write(self.FOOTER)
+    self.sink.close()
+    self.seedSink.close()
 
 
 class MapfileBuilder:
@@ -181,24 +817,18 @@ class MapfileBuilder:
       TYPE POLYGON
       DUMP TRUE
       STATUS ON
-      EXTENT -180 -90 180 90
-      UNITS DD
+      EXTENT {extent}
+      UNITS {units}{scaleTokens}
 
       CONNECTIONTYPE POSTGIS
       CONNECTION "host={dbHost} dbname={dbName} user={dbUsername}
                   password='{dbPassword}' port={dbPort}"
-      DATA "wkb_geometry FROM (
-      SELECT n.nuts_id, v.activity_id, v.indicator_id, v.unit,
-        year, value, status, data_source, website, wkb_geometry
-              FROM {dbSchema}.nuts n
-             LEFT OUTER JOIN {dbSchema}.{dbTable} v
-               ON v.nuts_id = n.nuts_id AND v.indicator_id = '{indicator}'
-                 AND v.activity_id = '{activity}' {yearFilter}
-              WHERE n.levl_code = '{level}'
-          ) AS RS USING UNIQUE nuts_id USING srid=4326"
+      DATA "{geometryColumn} FROM (
+      {query}
+          ) AS RS USING UNIQUE nuts_id USING srid={srid}"
 
       PROJECTION
-          "init=epsg:4326"
+          "init=epsg:{srid}"
       END
 
       TEMPLATE "queryable"
@@ -206,7 +836,8 @@ class MapfileBuilder:
         wms_title "{layerTitle}"
         wms_name "{layerCode}"
         wms_abstract "{layerAbstract}"
-        wms_srs "EPSG:4326"
+        wms_srs "EPSG:{srid}"
+        wms_extent "{extent}"
         wms_connectiontimeout "120"
         wms_server_version "1.3.0"
         wms_attribution_title "{projectName}"
@@ -214,11 +845,11 @@ class MapfileBuilder:
         wms_layer_group "/{layerGroup}"
         wms_group_title "/{layerGroup}"
         wms_group_abstract ""
-        gml_include_items "all"
+        gml_include_items "{includeItems}"
         wms_metadataurl_format "text/xml"
         wms_metadataurl_type "TC211"
         wms_metadataurl_href "{layerMetadataUrl}"
-        {wmsTimeConfig}
+        {wmsTimeConfig}{legendConfig}{featureInfoConfig}
       END
 
       CLASS
@@ -233,6 +864,95 @@ class MapfileBuilder:
     END
   """
 
+  # Features of a layer, also used to derive indexes (see SchemaOptimizer)
+  QUERY = """SELECT n.nuts_id, v.activity_id, v.indicator_id, v.unit,
+        year, value, status, data_source, website, {geometryColumn}
+              FROM {dbSchema}.{nutsTable} n
+             {join} {dbSchema}.{dbTable} v
+               ON v.nuts_id = n.nuts_id AND v.indicator_id = '{indicator}'
+                 AND v.activity_id = '{activity}' {yearFilter}
+              WHERE n.levl_code = '{level}'"""
+
+  # Features of a layer read from the query table of its NUTS level (see SchemaOptimizer)
+  FEATURE_QUERY = """SELECT v.nuts_id, {items}, v.{geometryColumn}
+              FROM {dbSchema}.{queryTable} v
+              WHERE v.indicator_id = '{indicator}'
+                AND v.activity_id = '{activity}' {yearFilter}"""
+
+  # Attributes of the layer features which GetFeatureInfo may return
+  FEATURE_ITEMS = ['activity_id', 'indicator_id', 'unit', 'year', 'value', 'status', 'data_source', 'website']
+
+  # NUTS of a level drawn below the layers only having NUTS with data
+  BASE_LAYER = """
+    # # {layerCode} ##
+    LAYER
+      NAME "{layerCode}"
+      TYPE POLYGON
+      STATUS ON
+      EXTENT {extent}
+      UNITS {units}{scaleTokens}
+
+      CONNECTIONTYPE POSTGIS
+      CONNECTION "host={dbHost} dbname={dbName} user={dbUsername}
+                  password='{dbPassword}' port={dbPort}"
+      DATA "{geometryColumn} FROM (
+      SELECT n.nuts_id, n.{geometryColumn}
+              FROM {dbSchema}.{nutsTable} n
+              WHERE n.levl_code = '{level}'
+          ) AS RS USING UNIQUE nuts_id USING srid={srid}"
+
+      PROJECTION
+          "init=epsg:{srid}"
+      END
+
+      METADATA
+        wms_title "{layerTitle}"
+        wms_name "{layerCode}"
+        wms_srs "EPSG:{srid}"
+        wms_extent "{extent}"
+        wms_attribution_title "{projectName}"
+        wms_attribution_onlineresource "http://mosesproject.eu/"
+        wms_layer_group "/{layerGroup}"
+        wms_group_title "/{layerGroup}"
+      END
+
+      CLASS
+        NAME "No data"
+        STYLE
+          COLOR 240 240 240
+          OUTLINECOLOR 211 211 211
+        END
+      END
+    END
+  """
+
+  # A MapServer layer has one group: base layers are shared by all indicator layers of their level in
+  # their own group, and combined with them by contexts, the tile cache and the QGIS project instead
+  BASE_LAYER_GROUP = 'NUTS'
+
+  # NUTS table of the scale band, the table being substituted in the query by MapServer
+  SCALETOKEN = """
+
+      SCALETOKEN
+        NAME "{token}"
+        VALUES
+{values}        END
+      END"""
+
+  SCALETOKEN_VALUE = """          "{minScaleDenom}" "{table}"
+"""
+
+  NUTS_TOKEN = '%nuts%'
+
+  # Extent of layers without known extent
+  WORLD_EXTENT = (-180, -90, 180, 90)
+
+  # Units of the layer SRS which layers can be read in
+  UNITS = {4326: 'DD', 3857: 'METERS', 3395: 'METERS'}
+  WGS84_SEMI_MAJOR_AXIS = 6378137.0
+  WGS84_ECCENTRICITY = 0.0818191908426215
+  MERCATOR_MAX_LATITUDE = 85.0511287798066
+
   TIME = """
         wms_timeextent "{listOfYears}"
         wms_timeitem "year"
@@ -240,6 +960,14 @@ class MapfileBuilder:
         wms_timedefault "{lastYear}"
   """
 
+  LEGEND = """
+        wms_style "default"
+        wms_style_default_legendurl_href "{url}"
+        wms_style_default_legendurl_format "image/png"
+        wms_style_default_legendurl_width "{width}"
+        wms_style_default_legendurl_height "{height}"
+  """
+
   CATEGORY = """
       CLASS
         NAME "{label}"
@@ -251,152 +979,1657 @@ class MapfileBuilder:
       END
       """
 
+  FEATUREINFO = """
+        wms_include_items "{includeItems}"
+        gml_featureid "nuts_id"
+        wms_feature_info_max_features "{maxFeatures}"
+  """
+
+  INCLUDE = """
+    INCLUDE "{file}"
+  """
+
   FOOTER = """
 END
   """
 
-  def __init__(self, file, projectName, projectDescription, projectUrl, wmsBaseUrl, debug):
+  def __init__(self, file, projectName, projectDescription, projectUrl, wmsBaseUrl, debug,
+               dbHost, dbPort, dbName, dbUsername, dbPassword, dbSchema, isUsingLevelTables=False, resolutions=(), srid=4326,
+               isUsingBaseLayers=False, featureInfoItems=None, featureInfoMaxFeatures=10):
     self.file = file
     self.projectName = projectName
     self.projectDescription = projectDescription
     self.projectUrl = projectUrl
     self.wmsBaseUrl = wmsBaseUrl
     self.debug = debug
+    self.isUsingLevelTables = isUsingLevelTables
+    self.resolutions = resolutions
+    self.srid = srid
+    self.geometryColumn = SchemaOptimizer.getGeometryColumn(srid)
+    # Layers only select NUTS with data, drawn over a "No data" base layer
+    self.isUsingBaseLayers = isUsingBaseLayers
+    # Layers read the NUTS level query tables and only return these items, year and value
+    # being always read for the time dimension and the classes, for at most featureInfoMaxFeatures features
+    self.featureInfoItems = None
+    includeItems = 'all'
+    featureInfoConfig = ''
+    if featureInfoItems is not None:
+      self.featureInfoItems = list(dict.fromkeys(['year', 'value'] + list(featureInfoItems)))
+      includeItems = ','.join(['nuts_id'] + self.featureInfoItems)
+      featureInfoConfig = self.FEATUREINFO.format(includeItems=includeItems, maxFeatures=featureInfoMaxFeatures)
+    self.sink = OutputSink(file)
+    # Everything but the layer specific values is substituted once
+    self.layerTemplate = CompiledTemplate(self.LAYER).bind(projectName=projectName,
+                                                           layerMetadataUrl="",
+                                                           dbHost=dbHost,
+                                                           dbPort=dbPort,
+                                                           dbName=dbName,
+                                                           dbUsername=dbUsername,
+                                                           dbPassword=dbPassword,
+                                                           dbSchema=dbSchema,
+                                                           srid=srid,
+                                                           units=self.UNITS[srid],
+                                                           geometryColumn=self.geometryColumn,
+                                                           includeItems=includeItems,
+                                                           featureInfoConfig=featureInfoConfig)
+    self.queryTemplate = CompiledTemplate(self.QUERY).bind(dbSchema=dbSchema, geometryColumn=self.geometryColumn,
+                                                           join='JOIN' if isUsingBaseLayers else 'LEFT OUTER JOIN')
+    if self.featureInfoItems is not None:
+      self.queryTemplate = CompiledTemplate(self.FEATURE_QUERY).bind(dbSchema=dbSchema, geometryColumn=self.geometryColumn,
+                                                                     items=', '.join(f'v.{item}' for item in self.featureInfoItems))
+    self.baseLayerTemplate = CompiledTemplate(self.BASE_LAYER).bind(projectName=projectName,
+                                                                    dbHost=dbHost,
+                                                                    dbPort=dbPort,
+                                                                    dbName=dbName,
+                                                                    dbUsername=dbUsername,
+                                                                    dbPassword=dbPassword,
+                                                                    dbSchema=dbSchema,
+                                                                    srid=srid,
+                                                                    units=self.UNITS[srid],
+                                                                    geometryColumn=self.geometryColumn,
+                                                                    layerGroup=self.BASE_LAYER_GROUP)
+    self.categoryTemplate = CompiledTemplate(self.CATEGORY)
+    self.timeTemplate = CompiledTemplate(self.TIME)
+    self.legendTemplate = CompiledTemplate(self.LEGEND)
 
   # Write the mapfile
   def writeHeader(self):
-    mapfile = open(self.file, "w+")
-    mapfile.write(self.HEADER.format(projectName=self.projectName,
-                                     projectDescription=self.projectDescription,
-                                     projectUrl=self.projectUrl,
-                                     debug=self.debug,
-                                     wmsBaseUrl=self.wmsBaseUrl))
-    mapfile.close()
+    self.sink.open()
+    self.sink.write(self.HEADER.format(projectName=self.projectName,
+                                       projectDescription=self.projectDescription,
+                                       projectUrl=self.projectUrl,
+                                       debug=self.debug,
+                                       wmsBaseUrl=self.wmsBaseUrl))
 
-  def writeLayer(self, layerCode, layerTitle, layerAbstract, level, activity, indicator, year, categories, dbHost, dbPort, dbName, dbUsername,
-                 dbPassword, dbSchema, activityFullLabel, indicatorFullLabel, asTime = False, dbTable = 'moses_indicator_values', listOfYears = [2013, 2014, 2015]):
+  def renderLayer(self, record):
     """
+    Mapfile LAYER block of a layer record.
 
-    :rtype: object
+    :rtype: str
     """
-    mapfile = open(self.file, "a+")
+    categories = record.categories
     categoriesConfig = ""
     for c in categories:
       # Upper bound of last class must be equal to get the max value
       equal = ''
       if c == len(categories) - 1:
         equal = '='
-      categoriesConfig = categoriesConfig + self.CATEGORY.format(min=categories[c].min,
-                                                                 max=categories[c].max,
-                                                                 equal=equal,
-                                                                 # equal=(c==5 ? '=' : ''),
-                                                                 color=categories[c].color,
-                                                                 label=categories[c].label)
-
-    groupTokens = layerCode.replace('.', '/').split('/')
-    groupTokens.pop()
-    groupTokens.pop(0)
-    groupTokens[1] = activityFullLabel
-    groupTokens[2] = indicatorFullLabel
+      categoriesConfig = categoriesConfig + self.categoryTemplate.render(min=categories[c].min,
+                                                                         max=categories[c].max,
+                                                                         equal=equal,
+                                                                         color=categories[c].color,
+                                                                         label=categories[c].label)
 
-    if asTime:
-        wmsTimeConfig = self.TIME.format(
-            listOfYears=','.join(str(x) for x in listOfYears),
-            lastYear=listOfYears[0])
-        yearFilter = ''
+    if record.asTime:
+        wmsTimeConfig = self.timeTemplate.render(
+            listOfYears=','.join(str(x) for x in record.listOfYears),
+            lastYear=record.listOfYears[0])
     else:
         wmsTimeConfig = ''
-        yearFilter = f"AND v.year = '{year}'"
-
-    layerConfig = f"" + self.LAYER.format(layerCode=layerCode,
-                                          layerTitle=layerTitle,
-                                          level=level,
-                                          layerGroup='/'.join(groupTokens),
-                                          layerAbstract=layerAbstract,
-                                          activity=activity,
-                                          indicator=indicator,
-                                          yearFilter=yearFilter,
-                                          projectName=self.projectName,
-                                          layerMetadataUrl="",
-                                          dbHost=dbHost,
-                                          dbPort=dbPort,
-                                          dbName=dbName,
-                                          dbUsername=dbUsername,
-                                          dbPassword=dbPassword,
-                                          dbSchema=dbSchema,
-                                          dbTable=dbTable,
-                                          categories=categoriesConfig,
-                                          wmsTimeConfig=wmsTimeConfig)
-    mapfile.write(layerConfig)
-    mapfile.close()
 
-  def writeFooter(self):
-    mapfile = open(self.file, "a+")
-    mapfile.write(f"" + self.FOOTER)
-    mapfile.close()
+    legendConfig = ''
+    if record.legend is not None:
+      url, width, height = record.legend
+      legendConfig = self.legendTemplate.render(url=url, width=width, height=height)
 
+    return self.layerTemplate.render(layerCode=record.layerCode,
+                                     layerTitle=record.layerTitle,
+                                     layerGroup=record.layerGroup,
+                                     layerAbstract=record.layerAbstract,
+                                     extent=self.renderExtent(record.extent or self.WORLD_EXTENT),
+                                     scaleTokens=self.renderScaleTokens(record.level),
+                                     query=self.renderQuery(record.level, record.activity, record.indicator, record.year,
+                                                            record.dbTable, record.asTime, self.getLayerNutsTable(record.level)),
+                                     categories=categoriesConfig,
+                                     wmsTimeConfig=wmsTimeConfig,
+                                     legendConfig=legendConfig)
 
+  @classmethod
+  def projectExtent(cls, extent, srid):
+    """
+    CRS84 bounding box in a layer SRS, latitudes being limited to the Mercator ones.
 
-class CONST:
-  class LAYERNAME:
-    activities = "moses_activities"
-    indicators = "moses_indicators"
-    ivalue = "moses_indicator_values"
-    ivalueview = "moses_indicator_values_with_nuts"
+    :rtype: tuple
+    """
+    if srid == 4326:
+      return tuple(extent)
+    minx, miny, maxx, maxy = extent
+    latitudes = numpy.radians(numpy.clip([miny, maxy], -cls.MERCATOR_MAX_LATITUDE, cls.MERCATOR_MAX_LATITUDE))
+    y = numpy.tan(numpy.pi / 4 + latitudes / 2)
+    if srid == 3395:
+      # Ellipsoidal Mercator
+      e = cls.WGS84_ECCENTRICITY
+      y = y * ((1 - e * numpy.sin(latitudes)) / (1 + e * numpy.sin(latitudes))) ** (e / 2)
+    y = numpy.log(y) * cls.WGS84_SEMI_MAJOR_AXIS
+    x = numpy.radians([minx, maxx]) * cls.WGS84_SEMI_MAJOR_AXIS
+    return tuple(round(float(c), 2) for c in (x[0], y[0], x[1], y[1]))
 
+  def renderExtent(self, extent):
+    return ' '.join(str(c) for c in self.projectExtent(extent, self.srid))
 
+  @staticmethod
+  def getBaseLayerName(level):
+    """
+    "No data" base layer of a NUTS level (eg. MOSES.Base.NUTS2).
 
+    :rtype: str
+    """
+    return f'MOSES.Base.NUTS{level}'
 
-class MosesPublication:
-  # dbName = 'moses'
-  # dbHost = 'localhost'
-  # dbPort = '5432'
-  # dbUsername = 'www-data'
-  # dbPassword = 'www-data'
-  # dbSchema = 'public'
-  dbName = 'moses'
-  dbHost = 'vpostgres2.ifremer.fr'
-  dbPort = '5432'
-  dbUsername = 'moses_usr'
-  dbPassword = 'The ...'
-  dbSchema = 'moses'
+  def writeBaseLayer(self, level):
+    self.sink.write(self.baseLayerTemplate.render(layerCode=self.getBaseLayerName(level),
+                                                  layerTitle=f'NUTS level {level}',
+                                                  extent=self.renderExtent(self.WORLD_EXTENT),
+                                                  scaleTokens=self.renderScaleTokens(level),
+                                                  nutsTable=self.getLayerNutsTable(level),
+                                                  level=level))
 
-  # wmsTimeLayerMode = False
-  wmsTimeLayerMode = True
+  def getNutsTable(self, level, resolution=0):
+    """
+    NUTS table of a level at a resolution of the scale bands.
 
-  classificationMethod = "equalInterval"
-  classificationNbOfClasses = 5
+    :rtype: str
+    """
+    if len(self.resolutions) > 0 and self.resolutions[resolution][1] > 0:
+      return SchemaOptimizer.getResolutionTable(level, resolution)
+    if self.isUsingLevelTables:
+      return SchemaOptimizer.getLevelTable('nuts', level)
+    return 'nuts'
 
-  # Define color map
-  # ['Spectral', 'RdYlGn', 'Set2', 'Accent', 'OrRd', 'Set1', 'PuBu', 'Set3', 'BuPu', 'Dark2', 'RdBu', 'Oranges', 'BuGn', 'PiYG', 'YlOrBr', 'YlGn', 'Reds', 'RdPu', 'Greens', 'PRGn', 'YlGnBu', 'RdYlBu', 'Paired', 'BrBG', 'Purples', 'Pastel2', 'Pastel1', 'GnBu', 'Greys', 'RdGy', 'YlOrRd', 'PuOr', 'PuRd', 'Blues', 'PuBuGn']
-  colorScheme = 'Oranges'
+  def getLayerNutsTable(self, level):
+    """
+    NUTS table as written in layers, substituted by scale when using scale bands.
 
-  palette = QgsColorBrewerColorRamp.create({'colors': str(classificationNbOfClasses), 'schemeName': colorScheme})
+    :rtype: str
+    """
+    return self.NUTS_TOKEN if len(self.resolutions) > 0 else self.getNutsTable(level)
 
-  isBuildingMapfile = True
-  isAddingLayerToQgisProject = True
+  def renderScaleTokens(self, level):
+    """
+    SCALETOKEN block selecting the NUTS table of each scale band.
 
-  def addTable(self, tableName, schema=None, geometryColumn=None):
+    :rtype: str
     """
-    Add DB table to current project
+    if len(self.resolutions) == 0:
+      return ''
+    values = ''.join(self.SCALETOKEN_VALUE.format(minScaleDenom=minScaleDenom, table=self.getNutsTable(level, r))
+                     for r, (minScaleDenom, tolerance) in enumerate(self.resolutions))
+    return self.SCALETOKEN.format(token=self.NUTS_TOKEN, values=values)
 
-    :rtype: QgsVectorLayer
+  def renderQuery(self, level, activity, indicator, year, dbTable, asTime=False, nutsTable=None):
     """
-    uri = QgsDataSourceUri()
-    uri.setConnection(self.dbHost, self.dbPort, self.dbName, self.dbUsername, self.dbPassword)
-    uri.setDataSource(schema or self.dbSchema, tableName, geometryColumn)
-    vlayer = QgsVectorLayer(uri.uri(False), tableName, "postgres")
-    QgsProject.instance().addMapLayer(vlayer)
-    return vlayer
+    SQL selecting the features of a layer (ie. the DATA sub query).
+    Time layers select all years.
 
-  def getTable(self, tableName):
+    :rtype: str
     """
-    Get a table and exit if not found.
+    yearFilter = '' if asTime else f"AND v.year = '{year}'"
+    if self.featureInfoItems is not None:
+      return self.queryTemplate.render(queryTable=SchemaOptimizer.getQueryTable(dbTable, level),
+                                       activity=activity,
+                                       indicator=indicator,
+                                       yearFilter=yearFilter)
+    if nutsTable is None:
+      nutsTable = self.getNutsTable(level)
+    if self.isUsingLevelTables:
+      dbTable = SchemaOptimizer.getLevelTable(dbTable, level)
+    return self.queryTemplate.render(nutsTable=nutsTable,
+                                     dbTable=dbTable,
+                                     level=level,
+                                     activity=activity,
+                                     indicator=indicator,
+                                     yearFilter=yearFilter)
 
-    :rtype: QgsVectorLayer
+  def getQueryShapes(self, dbTable, asTime=False):
     """
-    layers = QgsProject.instance().mapLayersByName(tableName)
-    table = None
+    Tables filtered and joined by the layer queries.
+
+    :rtype: list
+    """
+    filterColumns = ['indicator_id', 'activity_id'] if asTime else ['indicator_id', 'activity_id', 'year']
+    includeColumns = ['year', 'value'] if asTime else ['value']
+    return [QueryShape('nuts', ['levl_code'], 'nuts_id', [], self.geometryColumn),
+            QueryShape(dbTable, filterColumns, 'nuts_id', includeColumns)]
+
+  def writeLayer(self, record):
+    self.sink.write(self.renderLayer(record))
+
+  def writeInclude(self, file):
+    self.sink.write(self.INCLUDE.format(file=file))
+
+  def writeFooter(self):
+    self.sink.write(self.FOOTER)
+    self.sink.close()
+
+
+class ParameterizedMapfileBuilder(MapfileBuilder):
+  """
+  Mapfile with one layer per NUTS level using runtime substitution of the
+  activity, indicator and year request parameters.
+
+  Instead of a layer, each combination writes its classes in a SQL script
+  loading the classes table which is joined to style features.
+  """
+  PARAMETERIZED_LAYER = """
+    # # {layerCode} ##
+    LAYER
+      NAME "{layerCode}"
+      TYPE POLYGON
+      DUMP TRUE
+      STATUS ON
+      EXTENT {extent}
+      UNITS {units}{scaleTokens}
+
+      CONNECTIONTYPE POSTGIS
+      CONNECTION "host={dbHost} dbname={dbName} user={dbUsername}
+                  password='{dbPassword}' port={dbPort}"
+      DATA "{geometryColumn} FROM (
+      {query}
+          ) AS RS USING UNIQUE nuts_id USING srid={srid}"
+
+      VALIDATION
+        "activity" "^[0-9,]{{1,10}}$"
+        "indicator" "^[A-Za-z0-9_]{{1,10}}$"
+        "year" "^[0-9]{{4}}$"
+        "default_activity" "{defaultActivity}"
+        "default_indicator" "{defaultIndicator}"
+        "default_year" "{defaultYear}"
+      END
+
+      PROJECTION
+          "init=epsg:{srid}"
+      END
+
+      TEMPLATE "queryable"
+      METADATA
+        wms_title "{layerTitle}"
+        wms_name "{layerCode}"
+        wms_abstract "Moses indicators for nuts level {level}, selected using the activity, indicator and year parameters."
+        wms_srs "EPSG:{srid}"
+        wms_connectiontimeout "120"
+        wms_server_version "1.3.0"
+        wms_attribution_title "{projectName}"
+        wms_attribution_onlineresource "http://mosesproject.eu/"
+        gml_include_items "all"
+      END
+
+      CLASS
+        NAME "No data"
+        EXPRESSION (NOT [value])
+        STYLE
+          COLOR 240 240 240
+          OUTLINECOLOR 211 211 211
+        END
+      END
+{classes}    END
+  """
+
+  # Class of a class index, colored by the classes table. Class names are
+  # the labels of the default combination, shown by GetLegendGraphic.
+  PARAMETERIZED_CLASS = """      CLASS
+        NAME "{label}"
+        EXPRESSION ([class_index] = {index})
+        STYLE
+          COLOR [color]
+          OUTLINECOLOR 211 211 211
+        END
+      END
+"""
+
+  PARAMETERIZED_QUERY = """SELECT n.nuts_id, v.activity_id, v.indicator_id, v.unit,
+        v.year, value, status, data_source, website, c.class_index, c.label, c.color, {geometryColumn}
+              FROM {dbSchema}.{nutsTable} n
+             LEFT OUTER JOIN {dbSchema}.{dbTable} v
+               ON v.nuts_id = n.nuts_id AND v.indicator_id = '%indicator%'
+                 AND v.activity_id = '%activity%' AND v.year = '%year%'
+             LEFT OUTER JOIN {dbSchema}.{classesTable} c
+               ON c.activity_id = v.activity_id AND c.indicator_id = v.indicator_id
+                 AND c.nuts_level = '{level}' AND c.year = v.year
+                 AND v.value >= c.lower
+                 AND (v.value < c.upper OR (c.is_last AND v.value <= c.upper))
+              WHERE n.levl_code = '{level}'"""
+
+  CLASSES_HEADER = """CREATE TABLE IF NOT EXISTS {dbSchema}.{classesTable}
+(
+  activity_id character varying(10),
+  indicator_id character varying(10),
+  nuts_level character varying(1),
+  year character varying(4),
+  class_index integer,
+  lower double precision,
+  upper double precision,
+  is_last boolean,
+  label character varying(254),
+  color character varying(7),
+  PRIMARY KEY (activity_id, indicator_id, nuts_level, year, class_index)
+);
+-- Bounds of tables created with numeric(24,15) overflow from 1e9
+ALTER TABLE {dbSchema}.{classesTable} ALTER COLUMN lower TYPE double precision, ALTER COLUMN upper TYPE double precision;
+
+BEGIN;
+DELETE FROM {dbSchema}.{classesTable};
+"""
+
+  CLASS_ROW = """INSERT INTO {dbSchema}.{classesTable} VALUES ('{activity}', '{indicator}', '{level}', '{year}', {index}, {min}, {max}, {isLast}, '{label}', '{color}');
+"""
+
+  CLASSES_FOOTER = """COMMIT;
+"""
+
+  def __init__(self, file, classesFile, projectName, projectDescription, projectUrl, wmsBaseUrl, debug,
+               dbHost, dbPort, dbName, dbUsername, dbPassword, dbSchema, isUsingLevelTables=False, resolutions=(),
+               classesTable='moses_indicator_classes', srid=4326):
+    super().__init__(file, projectName, projectDescription, projectUrl, wmsBaseUrl, debug,
+                     dbHost, dbPort, dbName, dbUsername, dbPassword, dbSchema, isUsingLevelTables, resolutions, srid)
+    self.classesFile = classesFile
+    self.classesTable = classesTable
+    self.dbSchema = dbSchema
+    # Layer blocks are classes rows, the mapfile only holds parameterized layers
+    self.mapSink = self.sink
+    self.sink = OutputSink(classesFile)
+    self.parameterizedLayerTemplate = CompiledTemplate(self.PARAMETERIZED_LAYER).bind(projectName=projectName,
+                                                                                      dbHost=dbHost,
+                                                                                      dbPort=dbPort,
+                                                                                      dbName=dbName,
+                                                                                      dbUsername=dbUsername,
+                                                                                      dbPassword=dbPassword,
+                                                                                      dbSchema=dbSchema,
+                                                                                      classesTable=classesTable,
+                                                                                      srid=srid,
+                                                                                      units=self.UNITS[srid],
+                                                                                      geometryColumn=self.geometryColumn,
+                                                                                      extent=self.renderExtent(self.WORLD_EXTENT))
+    self.parameterizedClassTemplate = CompiledTemplate(self.PARAMETERIZED_CLASS)
+    self.parameterizedQueryTemplate = CompiledTemplate(self.PARAMETERIZED_QUERY).bind(dbSchema=dbSchema,
+                                                                                      classesTable=classesTable,
+                                                                                      geometryColumn=self.geometryColumn)
+    self.classRowTemplate = CompiledTemplate(self.CLASS_ROW).bind(dbSchema=dbSchema, classesTable=classesTable)
+
+  def writeHeader(self):
+    self.mapSink.open()
+    self.mapSink.write(self.HEADER.format(projectName=self.projectName,
+                                          projectDescription=self.projectDescription,
+                                          projectUrl=self.projectUrl,
+                                          debug=self.debug,
+                                          wmsBaseUrl=self.wmsBaseUrl))
+    self.sink.open()
+    self.sink.write(self.CLASSES_HEADER.format(dbSchema=self.dbSchema, classesTable=self.classesTable))
+
+  def writeParameterizedLayer(self, level, defaultActivity, defaultIndicator, defaultYear, classLabels,
+                              dbTable='moses_indicator_values'):
+    """
+    Write the layer of a NUTS level with one class per class index. Default values are used
+    when parameters are not set (eg. GetCapabilities and GetLegendGraphic).
+    """
+    classes = ''.join(self.parameterizedClassTemplate.render(label=label.replace('"', '\\"'), index=x)
+                      for x, label in enumerate(classLabels))
+    self.mapSink.write(self.parameterizedLayerTemplate.render(layerCode=f'MOSES.NUTS{level}',
+                                                              layerTitle=f'Moses indicator for nuts level {level}',
+                                                              level=level,
+                                                              scaleTokens=self.renderScaleTokens(level),
+                                                              query=self.renderParameterizedQuery(level, dbTable, self.getLayerNutsTable(level)),
+                                                              defaultActivity=defaultActivity,
+                                                              defaultIndicator=defaultIndicator,
+                                                              defaultYear=defaultYear,
+                                                              classes=classes))
+
+  def renderParameterizedQuery(self, level, dbTable='moses_indicator_values', nutsTable=None):
+    """
+    SQL selecting the features of the layer of a NUTS level, with
+    MapServer substitution tokens for the request parameters.
+
+    :rtype: str
+    """
+    if nutsTable is None:
+      nutsTable = self.getNutsTable(level)
+    if self.isUsingLevelTables:
+      dbTable = SchemaOptimizer.getLevelTable(dbTable, level)
+    return self.parameterizedQueryTemplate.render(nutsTable=nutsTable, dbTable=dbTable, level=level)
+
+  def renderQuery(self, level, activity, indicator, year, dbTable, asTime=False, nutsTable=None):
+    """
+    Parameterized query of the level as MapServer substitutes it for a combination.
+
+    :rtype: str
+    """
+    return self.renderParameterizedQuery(level, dbTable, nutsTable) \
+      .replace('%activity%', activity) \
+      .replace('%indicator%', indicator) \
+      .replace('%year%', year)
+
+  def renderLayer(self, record):
+    """
+    SQL inserting the classes of a layer record.
+
+    :rtype: str
+    """
+    categories = record.categories
+    rows = ""
+    for c in categories:
+      color = categories[c].color.split(' ')
+      rows = rows + self.classRowTemplate.render(activity=record.activity.replace("'", "''"),
+                                                 indicator=record.indicator.replace("'", "''"),
+                                                 level=record.level,
+                                                 year=record.year,
+                                                 index=c,
+                                                 min=categories[c].min,
+                                                 max=categories[c].max,
+                                                 isLast='true' if c == len(categories) - 1 else 'false',
+                                                 label=categories[c].label.replace("'", "''"),
+                                                 color='#{:02x}{:02x}{:02x}'.format(*(int(x) for x in color)))
+    return rows
+
+  def writeFooter(self):
+    self.sink.write(self.CLASSES_FOOTER)
+    self.sink.close()
+    self.mapSink.write(self.FOOTER)
+    self.mapSink.close()
+
+
+class LayerWriter:
+  """
+  Write a layer record once rendered to a mapfile, to all contexts
+  listing the layer and to the capabilities of the mapfile if any.
+  """
+
+  def __init__(self, mapBuilder, contextBuilders, capabilitiesBuilder=None):
+    self.mapBuilder = mapBuilder
+    self.contextBuilders = contextBuilders
+    self.capabilitiesBuilder = capabilitiesBuilder
+
+  def renderLayer(self, record, contextBuilders=None):
+    """
+    Mapfile block, context entries (by WMS URL) and capabilities layer of a layer record.
+
+    :rtype: dict
+    """
+    # Contexts using the same service share the same entry
+    contextLayers = {}
+    for contextBuilder in self.contextBuilders + (contextBuilders or []):
+      if contextBuilder.wmsUrl not in contextLayers:
+        contextLayers[contextBuilder.wmsUrl] = contextBuilder.renderLayer(record)
+    blocks = {'map': self.mapBuilder.renderLayer(record), 'contexts': contextLayers}
+    if self.capabilitiesBuilder is not None:
+      blocks['capabilities'] = self.capabilitiesBuilder.renderLayer(record)
+    return blocks
+
+  def writeBlocks(self, blocks, contextBuilders=None, mapSinks=None, capabilitiesBuilders=None):
+    """
+    Write blocks to the mapfile (or to the given mapfile sinks, eg. included mapfiles),
+    to the contexts and to the capabilities.
+    """
+    for mapSink in [self.mapBuilder.sink] if mapSinks is None else mapSinks:
+      mapSink.write(blocks['map'])
+    for contextBuilder in self.contextBuilders + (contextBuilders or []):
+      contextBuilder.sink.write(blocks['contexts'][contextBuilder.wmsUrl])
+    if self.capabilitiesBuilder is not None:
+      for capabilitiesBuilder in [self.capabilitiesBuilder] + (capabilitiesBuilders or []):
+        capabilitiesBuilder.addLayer(blocks['capabilities'])
+
+  def writeLayer(self, record, contextBuilders=None):
+    self.writeBlocks(self.renderLayer(record, contextBuilders), contextBuilders)
+
+
+class QgisProjectBuilder:
+  """
+  Add the layers of a run to a QGIS project at once.
+
+  Layers are registered with a single addMapLayers call and inserted in
+  groups found through an index, so that adding a layer does not get
+  slower as the project grows.
+  """
+
+  def __init__(self, project=None):
+    # Current project by default
+    if project is None:
+      project = QgsProject.instance()
+    self.project = project
+    self.root = project.layerTreeRoot()
+    # Layers of the project by name and groups by path
+    self.layerIds = {}
+    for layer in project.mapLayers().values():
+      self.layerIds.setdefault(layer.name(), []).append(layer.id())
+    self.groups = {(): self.root}
+    self.reset()
+
+  def reset(self):
+    # New groups are filled before being inserted in the project tree
+    self.newGroups = []
+    self.newGroupPaths = set()
+    self.layers = []
+    self.replacedLayerIds = []
+
+  def hasLayer(self, name):
+    return name in self.layerIds
+
+  def getGroup(self, path):
+    """
+    Group of a path of group names, created when missing.
+
+    :rtype: QgsLayerTreeGroup
+    """
+    group = self.groups.get(path)
+    if group is None:
+      parent = self.getGroup(path[:-1])
+      group = next((c for c in parent.children() if QgsLayerTree.isGroup(c) and c.name() == path[-1]), None)
+      if group is None:
+        group = QgsLayerTreeGroup(path[-1])
+        if path[:-1] in self.newGroupPaths:
+          parent.addChildNode(group)
+        else:
+          self.newGroups.append((parent, group))
+        self.newGroupPaths.add(path)
+      self.groups[path] = group
+    return group
+
+  def addLayer(self, path, layer):
+    """
+    Add a layer to the group of a path, replacing the layers of the project having the same name.
+    """
+    self.replacedLayerIds.extend(self.layerIds.pop(layer.name(), []))
+    self.getGroup(path)
+    self.layers.append((path, layer))
+
+  def build(self):
+    """
+    Register the added layers in the project and insert them in the layer tree, hidden.
+    """
+    if len(self.replacedLayerIds) > 0:
+      self.project.removeMapLayers(self.replacedLayerIds)
+    self.project.addMapLayers([layer for path, layer in self.layers], False)
+    for path, layer in self.layers:
+      self.groups[path].addLayer(layer).setItemVisibilityChecked(False)
+      self.layerIds.setdefault(layer.name(), []).append(layer.id())
+    for parent, group in self.newGroups:
+      parent.addChildNode(group)
+    self.reset()
+
+
+class LayerManifest:
+  """
+  Hash and rendered blocks of each layer of the previous run
+  keyed by layer code, to only rebuild layers which changed.
+
+  The previous run is ignored when the signature (templates and
+  settings shared by all layers) changed. Without file,
+  all layers are rebuilt.
+  """
+
+  def __init__(self, file, signature):
+    self.file = file
+    self.signature = signature
+    self.previous = {}
+    self.current = {}
+    if file is not None and os.path.exists(file):
+      with open(file) as manifestFile:
+        manifest = json.load(manifestFile)
+      if manifest.get('signature') == signature:
+        self.previous = manifest['layers']
+
+  @staticmethod
+  def hash(*values):
+    return hashlib.sha1(json.dumps(values, default=LayerManifest.encode).encode('utf-8')).hexdigest()
+
+  @staticmethod
+  def encode(value):
+    # NumPy arrays are hashed like lists
+    if isinstance(value, numpy.ndarray):
+      return value.tolist()
+    return str(value)
+
+  def get(self, layerCode, layerHash):
+    """
+    Blocks of the previous run if the layer did not change.
+
+    :rtype: dict
+    """
+    layer = self.previous.get(layerCode)
+    if layer is None or layer['hash'] != layerHash:
+      return None
+    return layer['blocks']
+
+  def getPrevious(self, layerCode):
+    """
+    Hash and blocks of a layer in the previous run, whether it changed or not.
+
+    :rtype: dict
+    """
+    return self.previous.get(layerCode)
+
+  def update(self, layers):
+    """
+    Record hash and blocks of layers of the current run.
+    """
+    self.current.update(layers)
+
+  def keepPrevious(self):
+    """
+    Keep layers of the previous run which are not part of the current one (eg. filtered run).
+    """
+    for layerCode, layer in self.previous.items():
+      self.current.setdefault(layerCode, layer)
+
+  def save(self):
+    if self.file is None:
+      return
+    with open(self.file + '.tmp', 'w') as manifestFile:
+      json.dump({'signature': self.signature, 'layers': self.current}, manifestFile)
+    os.replace(self.file + '.tmp', self.file)
+
+
+
+class Instrumentation:
+  """
+  Named timers and counters of a run, the slowest combinations
+  and progress output throttled by time.
+
+  Workers record in their own instrumentation which is then
+  merged in the one of the main process.
+  """
+
+  def __init__(self, progressInterval=5, nbOfSlowestCombinations=20):
+    self.progressInterval = progressInterval
+    self.nbOfSlowestCombinations = nbOfSlowestCombinations
+    self.timers = {}
+    self.counters = {}
+    # Min heap of (seconds, combination)
+    self.slowestCombinations = []
+    self.start = time.perf_counter()
+    self.lastProgress = None
+
+  @contextlib.contextmanager
+  def timer(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.addTime(name, time.perf_counter() - start)
+
+  def addTime(self, name, seconds, calls=1):
+    timer = self.timers.setdefault(name, {'seconds': 0, 'calls': 0})
+    timer['seconds'] = timer['seconds'] + seconds
+    timer['calls'] = timer['calls'] + calls
+
+  def count(self, name, value=1):
+    self.counters[name] = self.counters.get(name, 0) + value
+
+  def addCombination(self, combination, seconds):
+    if len(self.slowestCombinations) < self.nbOfSlowestCombinations:
+      heapq.heappush(self.slowestCombinations, (seconds, combination))
+    else:
+      heapq.heappushpop(self.slowestCombinations, (seconds, combination))
+
+  def merge(self, other):
+    for name, timer in other.timers.items():
+      self.addTime(name, timer['seconds'], timer['calls'])
+    for name, value in other.counters.items():
+      self.count(name, value)
+    for seconds, combination in other.slowestCombinations:
+      self.addCombination(combination, seconds)
+
+  def progress(self, current, total):
+    """
+    Print progress, at most once per progress interval.
+    """
+    now = time.perf_counter()
+    if current == total or self.lastProgress is None or now - self.lastProgress >= self.progressInterval:
+      self.lastProgress = now
+      print(f"{current:>15}/{total:<15} - {current / total:.0%} - {now - self.start:.1f}s")
+
+  def getReport(self):
+    """
+    :rtype: dict
+    """
+    return {'seconds': round(time.perf_counter() - self.start, 3),
+            'timers': {name: {'seconds': round(timer['seconds'], 3), 'calls': timer['calls']}
+                       for name, timer in sorted(self.timers.items(), key=lambda t: -t[1]['seconds'])},
+            'counters': dict(sorted(self.counters.items())),
+            'slowestCombinations': [{'combination': combination, 'seconds': round(seconds, 4)}
+                                    for seconds, combination in sorted(self.slowestCombinations, reverse=True)]}
+
+  def save(self, file):
+    with open(file, 'w') as reportFile:
+      json.dump(self.getReport(), reportFile, indent=2)
+
+
+class SchemaOptimizer:
+  """
+  SQL script creating the indexes, and optionally the per NUTS level tables,
+  the query tables and the simplified NUTS tables of the scale bands, matching
+  the query shapes of the generated layers.
+
+  Query plans of sample layer queries can be checked once the script is loaded.
+  Covering indexes require PostgreSQL 11.
+  """
+  HEADER = """BEGIN;
+"""
+
+  # Covering indexes (INCLUDE) fail before PostgreSQL 11, so the script stops with a clear message
+  VERSION_CHECK = """
+DO $$
+BEGIN
+  IF current_setting('server_version_num')::integer < 110000 THEN
+    RAISE EXCEPTION 'Covering indexes of this script require PostgreSQL 11 or later.';
+  END IF;
+END
+$$;
+"""
+
+  LEVEL_TABLE = """
+DROP TABLE IF EXISTS {dbSchema}.{levelTable} CASCADE;
+CREATE TABLE {dbSchema}.{levelTable} AS
+  SELECT t.* FROM {dbSchema}.{table} t
+    JOIN {dbSchema}.nuts n ON n.nuts_id = t.nuts_id
+   WHERE n.levl_code = '{level}';
+"""
+
+  # Values of a NUTS level joined to their geometry, reading only the feature info items
+  QUERY_TABLE = """
+DROP TABLE IF EXISTS {dbSchema}.{queryTable} CASCADE;
+CREATE TABLE {dbSchema}.{queryTable} AS
+  SELECT t.nuts_id, t.activity_id, t.indicator_id, {items}, n.{geometryColumn}
+    FROM {dbSchema}.{table} t
+    JOIN {dbSchema}.nuts n ON n.nuts_id = t.nuts_id
+   WHERE n.levl_code = '{level}';
+"""
+
+  RESOLUTION_TABLE = """
+DROP TABLE IF EXISTS {dbSchema}.{resolutionTable} CASCADE;
+CREATE TABLE {dbSchema}.{resolutionTable} AS
+  SELECT nuts_id, levl_code,
+         ST_Multi(ST_SimplifyPreserveTopology(wkb_geometry, {tolerance})) AS wkb_geometry{projectedGeometry}
+    FROM {dbSchema}.nuts
+   WHERE levl_code = '{level}';
+"""
+
+  RESOLUTION_PROJECTED_GEOMETRY = """,
+         ST_Multi(ST_Transform(ST_SimplifyPreserveTopology(wkb_geometry, {tolerance}), {srid})) AS {geometryColumn}"""
+
+  # Geometry of the NUTS in the layer SRS, kept up to date by a trigger
+  PROJECTED_GEOMETRY = """
+ALTER TABLE {dbSchema}.nuts ADD COLUMN IF NOT EXISTS {geometryColumn} geometry(MultiPolygon, {srid});
+UPDATE {dbSchema}.nuts SET {geometryColumn} = ST_Multi(ST_Transform(wkb_geometry, {srid}));
+
+CREATE OR REPLACE FUNCTION {dbSchema}.nuts_{geometryColumn}() RETURNS trigger AS $$
+BEGIN
+  NEW.{geometryColumn} := ST_Multi(ST_Transform(NEW.wkb_geometry, {srid}));
+  RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS nuts_{geometryColumn} ON {dbSchema}.nuts;
+CREATE TRIGGER nuts_{geometryColumn} BEFORE INSERT OR UPDATE OF wkb_geometry ON {dbSchema}.nuts
+  FOR EACH ROW EXECUTE PROCEDURE {dbSchema}.nuts_{geometryColumn}();
+"""
+
+  INDEX = """CREATE INDEX IF NOT EXISTS {name}
+  ON {dbSchema}.{table} USING {method} ({columns}){include};
+"""
+
+  ANALYZE = """ANALYZE {dbSchema}.{table};
+"""
+
+  FOOTER = """COMMIT;
+"""
+
+  # PostgreSQL identifier length
+  MAX_NAME_LENGTH = 63
+
+  def __init__(self, file, dbSchema, nutsLevels, isUsingLevelTables=False, resolutions=(), srid=4326, queryItems=None):
+    self.file = file
+    self.dbSchema = dbSchema
+    self.nutsLevels = nutsLevels
+    self.isUsingLevelTables = isUsingLevelTables
+    self.resolutions = resolutions
+    self.srid = srid
+    self.queryItems = queryItems
+    self.shapes = []
+
+  @staticmethod
+  def getGeometryColumn(srid):
+    """
+    NUTS geometry column in a SRS (eg. wkb_geometry_3857), wkb_geometry being in EPSG:4326.
+
+    :rtype: str
+    """
+    return 'wkb_geometry' if srid == 4326 else f'wkb_geometry_{srid}'
+
+  @staticmethod
+  def getLevelTable(table, level):
+    """
+    Table holding the rows of a NUTS level (eg. moses_indicator_values_level2).
+
+    :rtype: str
+    """
+    return f'{table}_level{level}'
+
+  @staticmethod
+  def getQueryTable(table, level):
+    """
+    Table of a NUTS level holding values with their geometry (eg. moses_indicator_values_query_level2).
+
+    :rtype: str
+    """
+    return f'{table}_query_level{level}'
+
+  @staticmethod
+  def getResolutionTable(level, resolution):
+    """
+    Simplified NUTS table of a level for a scale band (eg. nuts_level2_r1).
+
+    :rtype: str
+    """
+    return f'nuts_level{level}_r{resolution}'
+
+  @classmethod
+  def getIndexName(cls, table, columns):
+    """
+    Index name, shortened with a hash when too long for PostgreSQL.
+
+    :rtype: str
+    """
+    name = f"{table}_{'_'.join(c.replace('_id', '') for c in columns)}_idx"
+    if len(name) > cls.MAX_NAME_LENGTH:
+      name = f"{name[:cls.MAX_NAME_LENGTH - 9]}_{hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]}"
+    return name
+
+  def addQueryShapes(self, shapes):
+    for shape in shapes:
+      if vars(shape) not in [vars(s) for s in self.shapes]:
+        self.shapes.append(shape)
+
+  def renderIndexes(self, shape, table):
+    """
+    Composite index on the filter and join columns covering the columns read
+    and spatial index on the geometry.
+
+    :rtype: str
+    """
+    columns = shape.filterColumns + [shape.joinColumn]
+    include = f" INCLUDE ({', '.join(shape.includeColumns)})" if len(shape.includeColumns) > 0 else ''
+    sql = self.INDEX.format(name=self.getIndexName(table, columns), dbSchema=self.dbSchema, table=table,
+                            method='btree', columns=', '.join(columns), include=include)
+    if shape.geometryColumn is not None:
+      sql = sql + self.INDEX.format(name=self.getIndexName(table, [shape.geometryColumn]), dbSchema=self.dbSchema,
+                                    table=table, method='gist', columns=shape.geometryColumn, include='')
+    return sql
+
+  def render(self):
+    """
+    :rtype: str
+    """
+    tables = [(shape, shape.table) for shape in self.shapes]
+    sql = self.HEADER
+    if any(len(shape.includeColumns) > 0 for shape in self.shapes):
+      sql = sql + self.VERSION_CHECK
+    # Projected geometries are added before NUTS tables are derived
+    geometryColumn = self.getGeometryColumn(self.srid)
+    if self.srid != 4326:
+      sql = sql + self.PROJECTED_GEOMETRY.format(dbSchema=self.dbSchema, geometryColumn=geometryColumn, srid=self.srid)
+    if self.isUsingLevelTables:
+      levelTables = {}
+      for shape in self.shapes:
+        for level in sorted(self.nutsLevels):
+          levelTable = self.getLevelTable(shape.table, level)
+          if levelTable not in levelTables:
+            levelTables[levelTable] = self.LEVEL_TABLE.format(dbSchema=self.dbSchema, table=shape.table,
+                                                              levelTable=levelTable, level=level)
+          tables.append((shape, levelTable))
+      sql = sql + ''.join(levelTables.values())
+
+    # Query tables of the values tables, filtered on the same columns and read with a spatial index
+    if self.queryItems is not None:
+      items = ', '.join(f't.{item}' for item in self.queryItems if item not in ('activity_id', 'indicator_id'))
+      for shape in [shape for shape in self.shapes if shape.geometryColumn is None]:
+        for level in sorted(self.nutsLevels):
+          queryTable = self.getQueryTable(shape.table, level)
+          sql = sql + self.QUERY_TABLE.format(dbSchema=self.dbSchema, queryTable=queryTable, table=shape.table,
+                                              items=items, geometryColumn=geometryColumn, level=level)
+          tables.append((QueryShape(queryTable, shape.filterColumns, shape.joinColumn, shape.includeColumns,
+                                    geometryColumn), queryTable))
+
+    # Geometries are simplified in the tables of the scale bands, which are then queried as the NUTS table
+    geometryShapes = [shape for shape in self.shapes if shape.geometryColumn is not None]
+    for level in sorted(self.nutsLevels):
+      for r, (minScaleDenom, tolerance) in enumerate(self.resolutions):
+        if tolerance > 0:
+          resolutionTable = self.getResolutionTable(level, r)
+          projectedGeometry = ''
+          if self.srid != 4326:
+            projectedGeometry = self.RESOLUTION_PROJECTED_GEOMETRY.format(tolerance=tolerance, srid=self.srid,
+                                                                          geometryColumn=geometryColumn)
+          sql = sql + self.RESOLUTION_TABLE.format(dbSchema=self.dbSchema, resolutionTable=resolutionTable,
+                                                   tolerance=tolerance, level=level, projectedGeometry=projectedGeometry)
+          tables.extend((shape, resolutionTable) for shape in geometryShapes)
+
+    sql = sql + '\n'
+    for shape, table in tables:
+      sql = sql + self.renderIndexes(shape, table)
+    sql = sql + '\n'
+    for table in dict.fromkeys(table for shape, table in tables):
+      sql = sql + self.ANALYZE.format(dbSchema=self.dbSchema, table=table)
+    return sql + self.FOOTER
+
+  def write(self):
+    sink = OutputSink(self.file)
+    sink.open()
+    sink.write(self.render())
+    sink.close()
+
+  @classmethod
+  def findSeqScans(cls, plan):
+    """
+    Relations read by a sequential scan in an EXPLAIN (FORMAT JSON) plan node.
+
+    :rtype: list
+    """
+    relations = []
+    if plan.get('Node Type') == 'Seq Scan':
+      relations.append(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+      relations.extend(cls.findSeqScans(child))
+    return relations
+
+  def verifyQueryPlans(self, connection, queries):
+    """
+    Explain queries using a DB-API connection, sequential scans being disabled
+    so that they are only planned when no index matches.
+    Raise a RuntimeError listing the queries planning a sequential scan.
+    """
+    failures = []
+    cursor = connection.cursor()
+    try:
+      cursor.execute('SET LOCAL enable_seqscan = off')
+      for query in queries:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {query}')
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+          plan = json.loads(plan)
+        relations = self.findSeqScans(plan[0]['Plan'])
+        if len(relations) > 0:
+          failures.append(f"Sequential scan on {', '.join(relations)} for query:\n{query}")
+    finally:
+      cursor.close()
+      connection.rollback()
+
+    if len(failures) > 0:
+      raise RuntimeError(f'{len(failures)}/{len(queries)} layer queries plan a sequential scan. '
+                         f'Check that {self.file} is loaded.\n' + '\n\n'.join(failures))
+    print(f'Query plans of {len(queries)} layer queries use indexes.')
+
+
+class CONST:
+  class LAYERNAME:
+    activities = "moses_activities"
+    indicators = "moses_indicators"
+    ivalue = "moses_indicator_values"
+    ivalueview = "moses_indicator_values_with_nuts"
+    nuts = "nuts"
+
+
+class IndicatorStatistics:
+  """
+  Number of values, min, max, NUTS ids and values (ordered by value)
+  for one activity, indicator, NUTS level and year.
+  """
+  count = 0
+  min = None
+  max = None
+  nutsIds = []
+  values = []
+
+  def __init__(self, count, min, max, nutsIds, values):
+    self.count = count
+    self.min = min
+    self.max = max
+    self.nutsIds = nutsIds
+    self.values = values
+
+
+class ColorBrewerPalette:
+  """
+  ColorBrewer color scheme usable without QGIS.
+
+  Colors are picked like QgsColorBrewerColorRamp.color does.
+  """
+  SCHEMES = {
+    'Oranges': {
+      3: ['fee6ce', 'fdae6b', 'e6550d'],
+      4: ['feedde', 'fdbe85', 'fd8d3c', 'd94701'],
+      5: ['feedde', 'fdbe85', 'fd8d3c', 'e6550d', 'a63603'],
+      6: ['feedde', 'fdd0a2', 'fdae6b', 'fd8d3c', 'e6550d', 'a63603'],
+      7: ['feedde', 'fdd0a2', 'fdae6b', 'fd8d3c', 'f16913', 'd94801', '8c2d04'],
+      8: ['fff5eb', 'fee6ce', 'fdd0a2', 'fdae6b', 'fd8d3c', 'f16913', 'd94801', '8c2d04'],
+      9: ['fff5eb', 'fee6ce', 'fdd0a2', 'fdae6b', 'fd8d3c', 'f16913', 'd94801', 'a63603', '7f2704']
+    }
+  }
+
+  def __init__(self, schemeName, nbOfColors):
+    self.schemeName = schemeName
+    self.nbOfColors = nbOfColors
+    if nbOfColors in self.SCHEMES.get(schemeName, {}):
+      self.colors = [tuple(int(c[x:x + 2], 16) for x in (0, 2, 4)) for c in self.SCHEMES[schemeName][nbOfColors]]
+    else:
+      # Other schemes and numbers of colors are only available from QGIS
+      if not importQgis():
+        available = ', '.join(f'{name} with {min(colors)} to {max(colors)} colors' for name, colors in self.SCHEMES.items())
+        raise ValueError(f"Color scheme '{schemeName}' with {nbOfColors} colors requires QGIS "
+                         f"(available without QGIS: {available}).")
+      ramp = QgsColorBrewerColorRamp.create({'colors': str(nbOfColors), 'schemeName': schemeName})
+      self.colors = [ramp.color(x / nbOfColors).getRgb()[:3] for x in range(0, nbOfColors)]
+    self.colorTables = {}
+
+  def color(self, value):
+    """
+    RGB color for a value between 0 and 1.
+
+    :rtype: tuple
+    """
+    return self.colors[min(int(value * len(self.colors)), len(self.colors) - 1)]
+
+  def colorTable(self, nbOfClasses):
+    """
+    RGB colors of classes, computed once per number of classes.
+
+    :rtype: list
+    """
+    if nbOfClasses not in self.colorTables:
+      self.colorTables[nbOfClasses] = [self.color(x / nbOfClasses) for x in range(0, nbOfClasses)]
+    return self.colorTables[nbOfClasses]
+
+
+class Classifier:
+  """
+  Class breaks of many value arrays computed at once with NumPy.
+
+  Each array is classified in (lower, upper) bounds, a value belonging
+  to a class when lower <= value < upper (upper included for the last one).
+  A single class is used when all values are equal.
+  """
+  METHODS = ('equalInterval', 'quantile', 'jenks')
+
+  # Larger arrays are classified by Jenks from evenly spaced values (including min and max),
+  # like QGIS samples 3000 values, as the optimization takes n x n operations
+  JENKS_MAX_VALUES = 3000
+  # Number of last values of a class whose candidate classes are computed at once
+  JENKS_BLOCK_SIZE = 256
+
+  def __init__(self, method, nbOfClasses):
+    if method not in self.METHODS:
+      raise ValueError(f"Unknown classification method '{method}', use one of {', '.join(self.METHODS)}.")
+    self.method = method
+    self.nbOfClasses = nbOfClasses
+
+  def classify(self, arrays):
+    """
+    Class bounds of each array of values sorted in ascending order.
+
+    :rtype: list
+    """
+    if len(arrays) == 0:
+      return []
+    mins = numpy.array([a[0] for a in arrays], dtype=float)
+    maxs = numpy.array([a[-1] for a in arrays], dtype=float)
+    if self.method == 'equalInterval':
+      lowers, uppers = self.equalInterval(mins, maxs)
+    elif self.method == 'quantile':
+      lowers, uppers = self.quantile(arrays)
+    else:
+      lowers, uppers = self.jenks(arrays)
+
+    breaks = []
+    for c in range(len(arrays)):
+      if mins[c] == maxs[c]:
+        # No space for creating intervals
+        breaks.append([(mins[c].item(), maxs[c].item())])
+      else:
+        breaks.append(list(zip(lowers[c], uppers[c])))
+    return breaks
+
+  def equalInterval(self, mins, maxs):
+    interval = (maxs - mins) / self.nbOfClasses
+    lowers = mins[:, None] + interval[:, None] * numpy.arange(self.nbOfClasses)
+    uppers = lowers + interval[:, None]
+    uppers[:, -1] = maxs
+    return lowers.tolist(), uppers.tolist()
+
+  def quantile(self, arrays):
+    # Arrays are padded with NaN to compute all quantiles in one call
+    lengths = numpy.array([len(a) for a in arrays])
+    matrix = numpy.full((len(arrays), lengths.max()), numpy.nan)
+    matrix[numpy.arange(lengths.max()) < lengths[:, None]] = numpy.concatenate([numpy.asarray(a, dtype=float) for a in arrays])
+    bounds = numpy.nanquantile(matrix, numpy.linspace(0, 1, self.nbOfClasses + 1), axis=1).T
+    return bounds[:, :-1].tolist(), bounds[:, 1:].tolist()
+
+  def jenks(self, arrays):
+    lowers, uppers = [], []
+    for values in arrays:
+      values = numpy.asarray(values, dtype=float)
+      if len(values) > self.JENKS_MAX_VALUES:
+        values = values[numpy.linspace(0, len(values) - 1, self.JENKS_MAX_VALUES).round().astype(int)]
+      starts = self.jenksClassStarts(values, min(self.nbOfClasses, len(numpy.unique(values))), self.JENKS_BLOCK_SIZE)
+      bounds = values[starts].tolist() + [values[-1].item()]
+      lowers.append(bounds[:-1])
+      uppers.append(bounds[1:])
+    return lowers, uppers
+
+  @staticmethod
+  def jenksClassStarts(values, nbOfClasses, blockSize=256):
+    """
+    Index of the first value of each class minimizing the sum of squared
+    deviations within classes (Fisher-Jenks). Costs and class starts take
+    nbOfClasses x n values, candidate classes being computed by blocks of
+    blockSize last values.
+
+    :rtype: list
+    """
+    n = len(values)
+    sums = numpy.concatenate(([0], numpy.cumsum(values)))
+    squareSums = numpy.concatenate(([0], numpy.cumsum(values * values)))
+
+    # Best cost of the values up to each value in one class
+    j = numpy.arange(n)
+    cost = squareSums[j + 1] - squareSums[0] - (sums[j + 1] - sums[0]) ** 2 / (j + 1)
+    classStarts = []
+    for c in range(1, nbOfClasses):
+      # Best classification of the values before the first value of the last class
+      previous = numpy.concatenate(([numpy.inf], cost[:-1]))
+      starts = numpy.empty(n, dtype=int)
+      cost = numpy.empty(n)
+      for blockStart in range(0, n, blockSize):
+        blockEnd = min(n, blockStart + blockSize)
+        # Class from value i to value j
+        i = numpy.arange(blockEnd)[:, None]
+        j = numpy.arange(blockStart, blockEnd)[None, :]
+        count = numpy.maximum(j - i + 1, 1)
+        deviations = squareSums[j + 1] - squareSums[i] - (sums[j + 1] - sums[i]) ** 2 / count
+        candidates = previous[:blockEnd, None] + numpy.where(j >= i, deviations, numpy.inf)
+        starts[blockStart:blockEnd] = candidates.argmin(axis=0)
+        cost[blockStart:blockEnd] = candidates.min(axis=0)
+      classStarts.append(starts)
+
+    starts = []
+    end = n - 1
+    for c in reversed(classStarts):
+      start = int(c[end])
+      starts.insert(0, start)
+      end = start - 1
+    return [0] + starts
+
+
+class LegendRenderer:
+  """
+  PNG legends of layer classes rendered without MapServer, following the mapfile
+  LEGEND (key size, label color) with a built-in 5x7 pixel font covering class labels.
+
+  Identical legends are stored once, named by the hash of their content.
+  """
+  KEY_SIZE = (20, 10)
+  MARGIN = 5
+  ROW_SPACING = 4
+  NO_DATA_COLOR = (240, 240, 240)
+  OUTLINE_COLOR = (211, 211, 211)
+  LABEL_COLOR = (0, 0, 89)
+
+  # Columns of 5x7 glyphs, lowest bit at the top
+  FONT = {
+    ' ': (0x00, 0x00, 0x00, 0x00, 0x00), '+': (0x08, 0x08, 0x3E, 0x08, 0x08),
+    ',': (0x00, 0x50, 0x30, 0x00, 0x00), '-': (0x08, 0x08, 0x08, 0x08, 0x08),
+    '.': (0x00, 0x60, 0x60, 0x00, 0x00), '0': (0x3E, 0x51, 0x49, 0x45, 0x3E),
+    '1': (0x00, 0x42, 0x7F, 0x40, 0x00), '2': (0x42, 0x61, 0x51, 0x49, 0x46),
+    '3': (0x21, 0x41, 0x45, 0x4B, 0x31), '4': (0x18, 0x14, 0x12, 0x7F, 0x10),
+    '5': (0x27, 0x45, 0x45, 0x45, 0x39), '6': (0x3C, 0x4A, 0x49, 0x49, 0x30),
+    '7': (0x01, 0x71, 0x09, 0x05, 0x03), '8': (0x36, 0x49, 0x49, 0x49, 0x36),
+    '9': (0x06, 0x49, 0x49, 0x29, 0x1E), '?': (0x02, 0x01, 0x51, 0x09, 0x06),
+    'E': (0x7F, 0x49, 0x49, 0x49, 0x41), 'N': (0x7F, 0x04, 0x08, 0x10, 0x7F),
+    'a': (0x20, 0x54, 0x54, 0x54, 0x78), 'd': (0x38, 0x44, 0x44, 0x48, 0x7F),
+    'e': (0x38, 0x54, 0x54, 0x54, 0x18), 'f': (0x08, 0x7E, 0x09, 0x01, 0x02),
+    'i': (0x00, 0x44, 0x7D, 0x40, 0x00), 'n': (0x7C, 0x08, 0x04, 0x04, 0x78),
+    'o': (0x38, 0x44, 0x44, 0x44, 0x38), 't': (0x04, 0x3F, 0x44, 0x40, 0x20)
+  }
+  GLYPH_SIZE = (5, 7)
+
+  def __init__(self, folder, baseUrl):
+    self.folder = folder
+    self.baseUrl = baseUrl
+    # Legends written by this process, by hash
+    self.legends = {}
+
+  def getEntries(self, classes):
+    """
+    Label and RGB color of the legend rows, as classes of the mapfile layer.
+
+    :rtype: list
+    """
+    return [('No data', self.NO_DATA_COLOR)] + \
+           [(classes[c].label, tuple(int(v) for v in classes[c].color.split())) for c in classes]
+
+  def getLegend(self, classes):
+    """
+    URL, width and height of the legend of classes, written if not already stored.
+
+    :rtype: tuple
+    """
+    entries = self.getEntries(classes)
+    legendHash = LayerManifest.hash(entries, self.KEY_SIZE, self.FONT)[:16]
+    if legendHash not in self.legends:
+      file = os.path.join(self.folder, f'legend-{legendHash}.png')
+      pixels = self.render(entries)
+      if not os.path.exists(file):
+        os.makedirs(self.folder, exist_ok=True)
+        # Workers may write the same legend
+        temporaryFile = f'{file}.{os.getpid()}.tmp'
+        with open(temporaryFile, 'wb') as pngFile:
+          pngFile.write(self.encodePng(pixels))
+        os.replace(temporaryFile, file)
+      self.legends[legendHash] = (f"{self.baseUrl.rstrip('/')}/legend-{legendHash}.png", pixels.shape[1], pixels.shape[0])
+    return self.legends[legendHash]
+
+  def render(self, entries):
+    """
+    RGBA pixels of a legend on a transparent background.
+
+    :rtype: numpy.ndarray
+    """
+    keyWidth, keyHeight = self.KEY_SIZE
+    glyphWidth, glyphHeight = self.GLYPH_SIZE
+    rowHeight = max(keyHeight, glyphHeight) + self.ROW_SPACING
+    labelX = self.MARGIN + keyWidth + self.MARGIN
+    width = labelX + max(len(label) for label, color in entries) * (glyphWidth + 1) + self.MARGIN
+    height = self.MARGIN * 2 + len(entries) * rowHeight - self.ROW_SPACING
+    pixels = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+
+    glyphRows = numpy.arange(glyphHeight)[:, None]
+    for row, (label, color) in enumerate(entries):
+      y = self.MARGIN + row * rowHeight
+      pixels[y:y + keyHeight, self.MARGIN:self.MARGIN + keyWidth] = self.OUTLINE_COLOR + (255,)
+      pixels[y + 1:y + keyHeight - 1, self.MARGIN + 1:self.MARGIN + keyWidth - 1] = color + (255,)
+      textY = y + (keyHeight - glyphHeight) // 2
+      for x, character in enumerate(label):
+        glyph = (numpy.array(self.FONT.get(character, self.FONT['?']))[None, :] >> glyphRows) & 1
+        textX = labelX + x * (glyphWidth + 1)
+        pixels[textY:textY + glyphHeight, textX:textX + glyphWidth][glyph == 1] = self.LABEL_COLOR + (255,)
+    return pixels
+
+  @staticmethod
+  def encodePng(pixels):
+    """
+    PNG file of RGBA pixels.
+
+    :rtype: bytes
+    """
+    height, width = pixels.shape[:2]
+
+    def chunk(chunkType, data):
+      return struct.pack('>I', len(data)) + chunkType + data + struct.pack('>I', zlib.crc32(chunkType + data) & 0xffffffff)
+
+    # Each row starts with filter type 0
+    raw = numpy.concatenate((numpy.zeros((height, 1), dtype=numpy.uint8), pixels.reshape(height, width * 4)), axis=1)
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw.tobytes(), 9))
+            + chunk(b'IEND', b''))
+
+
+class VectorExporter:
+  """
+  Static vector data for client side rendering: NUTS geometries of each level written once,
+  and the values of each activity and indicator as a little endian float32 array (NaN without
+  data) of all levels and years, indexed like the geometries. A manifest lists the files,
+  the years and the classes of each combination.
+
+  Geometries are written as FlatGeobuf with a spatial index when GDAL Python bindings
+  are available, as GeoJSON otherwise. As FlatGeobuf features are sorted by the spatial
+  index, features carry the position of their values in an index property.
+  """
+  MANIFEST = 'moses-vector.json'
+
+  def __init__(self, folder, baseUrl):
+    self.folder = folder
+    self.baseUrl = baseUrl.rstrip('/')
+    # Geometry file and NUTS ids in values order of each level
+    self.levels = {}
+    self.indicators = []
+
+  def getUrl(self, file):
+    return f'{self.baseUrl}/{file}'
+
+  def getValuesFile(self, activityId, indicator):
+    return f"{activityId.replace(',', '')}.{indicator}.f32"
+
+  def getVectorData(self, activityId, indicator):
+    """
+    Values and manifest URLs of an activity and indicator, as referenced by contexts.
+
+    :rtype: tuple
+    """
+    return self.getUrl(self.getValuesFile(activityId, indicator)), self.getUrl(self.MANIFEST)
+
+  def writeGeometries(self, nutsLevel, geometries, nutsIdsWithData):
+    """
+    Write the geometries (NUTS id, GeoJSON geometry) of a level. NUTS without geometry
+    (eg. NULL in the NUTS table) are skipped, and when having data indexed after the others,
+    so that their values are still exported.
+    """
+    os.makedirs(self.folder, exist_ok=True)
+    file = f'nuts{nutsLevel}.geojson'
+    path = os.path.join(self.folder, file)
+    nutsIds = []
+    with open(path + '.tmp', 'w') as geojsonFile:
+      geojsonFile.write('{"type": "FeatureCollection", "features": [')
+      for nutsId, geometry in geometries:
+        geometry = json.loads(geometry) if geometry is not None else None
+        if geometry is None:
+          continue
+        feature = {'type': 'Feature', 'properties': {'nuts_id': nutsId, 'index': len(nutsIds)}, 'geometry': geometry}
+        geojsonFile.write(',\n' if len(nutsIds) > 0 else '\n')
+        geojsonFile.write(json.dumps(feature))
+        nutsIds.append(nutsId)
+      geojsonFile.write('\n]}\n')
+    if len(nutsIds) == 0:
+      os.remove(path + '.tmp')
+      file = None
+    else:
+      os.replace(path + '.tmp', path)
+      file = self.convertToFlatGeobuf(file)
+
+    knownNutsIds = set(nutsIds)
+    nutsIds.extend(sorted({nutsId for nutsId in nutsIdsWithData if nutsId not in knownNutsIds}))
+    self.levels[nutsLevel] = {'geometry': file, 'nutsIds': nutsIds,
+                              'index': {nutsId: index for index, nutsId in enumerate(nutsIds)}}
+
+  def convertToFlatGeobuf(self, file):
+    """
+    FlatGeobuf file with a spatial index converted from a GeoJSON one, the GeoJSON file
+    when GDAL is not available.
+
+    :rtype: str
+    """
+    try:
+      from osgeo import gdal
+    except ImportError:
+      return file
+    flatGeobufFile = os.path.splitext(file)[0] + '.fgb'
+    gdal.VectorTranslate(os.path.join(self.folder, flatGeobufFile), os.path.join(self.folder, file),
+                         format='FlatGeobuf', layerCreationOptions=['SPATIAL_INDEX=YES'])
+    return flatGeobufFile
+
+  def writeValues(self, activityId, indicator, indicatorStatistics, indicatorClasses, activityLabel, indicatorLabel):
+    """
+    Write the values of all levels and years of an activity and indicator, and list them in the manifest.
+    """
+    levels = {}
+    arrays = []
+    offset = 0
+    for nutsLevel in sorted(indicatorStatistics):
+      levelStatistics = indicatorStatistics[nutsLevel]
+      index = self.levels[nutsLevel]['index']
+      years = sorted(levelStatistics)
+      values = numpy.full((len(years), len(index)), numpy.nan, dtype='<f4')
+      for y, year in enumerate(years):
+        yearStatistics = levelStatistics[year]
+        values[y, [index[nutsId] for nutsId in yearStatistics.nutsIds]] = yearStatistics.values
+      levels[str(nutsLevel)] = {'offset': offset,
+                                'years': years,
+                                'classes': {year: self.getClasses(indicatorClasses[nutsLevel][year]) for year in years}}
+      arrays.append(values.ravel())
+      offset = offset + values.size
+
+    file = self.getValuesFile(activityId, indicator)
+    numpy.concatenate(arrays).tofile(os.path.join(self.folder, file))
+    self.indicators.append({'activity': activityId, 'indicator': indicator,
+                            'activityLabel': activityLabel, 'indicatorLabel': indicatorLabel,
+                            'values': self.getUrl(file), 'levels': levels})
+
+  def getClasses(self, classes):
+    """
+    Lower and upper bounds, hexadecimal color and label of classes.
+
+    :rtype: list
+    """
+    return [[classes[c].min, classes[c].max,
+             '#' + ''.join(f'{int(v):02x}' for v in classes[c].color.split()), classes[c].label]
+            for c in classes]
+
+  def writeManifest(self):
+    manifest = {'levels': {str(nutsLevel): {'geometry': None if level['geometry'] is None else self.getUrl(level['geometry']),
+                                            'nutsIds': level['nutsIds']}
+                           for nutsLevel, level in sorted(self.levels.items())},
+                'indicators': self.indicators}
+    file = os.path.join(self.folder, self.MANIFEST)
+    with open(file + '.tmp', 'w') as manifestFile:
+      json.dump(manifest, manifestFile)
+    os.replace(file + '.tmp', file)
+
+
+class DataSource(abc.ABC):
+  """
+  Access to MOSES activities, indicators and indicator values.
+  """
+  # One grouped query collecting statistics for all combinations having data
+  STATISTICS = """
+    SELECT activity_id, indicator_id, nuts_level, year,
+           count(*), min(value), max(value),
+           string_agg(nuts_id, ',' ORDER BY value, nuts_id),
+           string_agg(value::text, ',' ORDER BY value, nuts_id)
+      FROM {dbSchema}.{dbTable}
+     WHERE value IS NOT NULL
+     GROUP BY activity_id, indicator_id, nuts_level, year
+  """
+
+  VALUES = """
+    SELECT activity_id, indicator_id, nuts_level, year, nuts_id, value, status
+      FROM {dbSchema}.{dbTable}
+     WHERE value IS NOT NULL
+  """
+
+  # Bounding box of each NUTS region
+  NUTS_EXTENTS = """
+    SELECT nuts_id, ST_XMin(wkb_geometry), ST_YMin(wkb_geometry), ST_XMax(wkb_geometry), ST_YMax(wkb_geometry)
+      FROM {dbSchema}.{dbTable}
+  """
+
+  # Geometry of the NUTS regions of a level
+  NUTS_GEOMETRIES = """
+    SELECT nuts_id, ST_AsGeoJSON(wkb_geometry, 6)
+      FROM {dbSchema}.{dbTable}
+     WHERE levl_code = {nutsLevel}
+     ORDER BY nuts_id
+  """
+
+  # Changes when MOSES tables, or NUTS whose extents are kept in the cube, are modified
+  STAMP = """
+    SELECT string_agg(concat_ws(':', relname, n_tup_ins, n_tup_upd, n_tup_del, n_live_tup), ',' ORDER BY relname)
+      FROM pg_stat_user_tables
+     WHERE schemaname = '{dbSchema}'
+       AND relname IN ('moses_activities', 'moses_indicators', 'nuts', '{dbTable}')
+  """
+
+  @abc.abstractmethod
+  def getActivities(self):
+    """
+    List of activities (id, sector, name) ordered by id.
+
+    :rtype: list
+    """
+
+  @abc.abstractmethod
+  def getIndicatorLabels(self):
+    """
+    Full label of all indicators.
+
+    :rtype: dict
+    """
+
+  @abc.abstractmethod
+  def getIndicatorStatistics(self, nutsLevels):
+    """
+    Collect count, min, max, NUTS ids and values of all combinations
+    having data.
+
+    Statistics are indexed by activity, indicator, NUTS level and year.
+
+    :rtype: dict
+    """
+
+  @abc.abstractmethod
+  def getIndicatorValues(self):
+    """
+    All indicator values as rows of activity, indicator,
+    NUTS level, year, NUTS id, value and status.
+
+    :rtype: list
+    """
+
+  def getNutsExtents(self):
+    """
+    Bounding box (minx, miny, maxx, maxy) of each NUTS region.
+    Empty when NUTS geometries are not available.
+
+    :rtype: dict
+    """
+    return {}
+
+  def getNutsGeometries(self, nutsLevel):
+    """
+    NUTS id and GeoJSON geometry of the NUTS regions of a level ordered by NUTS id.
+    Empty when NUTS geometries are not available.
+
+    :rtype: list
+    """
+    return []
+
+  def getNutsPartExtents(self, nutsLevels):
+    """
+    Bounding boxes (minx, miny, maxx, maxy) of the polygons of each NUTS region of the levels,
+    read from their geometries. Empty when NUTS geometries are not available.
+
+    :rtype: dict
+    """
+    partExtents = {}
+    for nutsLevel in sorted(nutsLevels):
+      for nutsId, geometry in self.getNutsGeometries(nutsLevel):
+        extents = self.buildPartExtents(json.loads(geometry) if geometry is not None else None)
+        if len(extents) > 0:
+          partExtents[nutsId] = extents
+    return partExtents
+
+  def getStamp(self):
+    """
+    Stamp of the source data, changing when the data changes.
+    None when it can not be computed.
+
+    :rtype: str
+    """
+    return None
+
+  def buildStamp(self, value):
+    # No statistics (eg. not analyzed tables) give no stamp, so that the cube is always refreshed
+    if value is None or str(value) in ('', 'NULL'):
+      return None
+    return str(value)
+
+  def buildIndicatorLabel(self, name, unit):
+    if unit == '-':
+      return name
+    else:
+      return '{name} ({unit})'.format(name=name, unit=unit)
+
+  def buildPartExtents(self, geometry):
+    """
+    Bounding box of the exterior ring of each polygon of a GeoJSON geometry.
+
+    :rtype: list
+    """
+    if geometry is None:
+      return []
+    if geometry['type'] == 'GeometryCollection':
+      return [extent for part in geometry['geometries'] for extent in self.buildPartExtents(part)]
+    if geometry['type'] == 'Polygon':
+      polygons = [geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+      polygons = geometry['coordinates']
+    else:
+      return []
+    extents = []
+    for polygon in polygons:
+      if len(polygon) == 0 or len(polygon[0]) == 0:
+        continue
+      ring = numpy.array(polygon[0], dtype=float)[:, :2]
+      extents.append(tuple(ring.min(axis=0).tolist() + ring.max(axis=0).tolist()))
+    return extents
+
+  def buildNutsExtents(self, rows):
+    return {nutsId: tuple(float(c) for c in box)
+            for nutsId, *box in rows
+            if None not in box and '' not in box}
+
+  def buildStatistics(self, rows, nutsLevels):
+    statistics = {}
+    for activityId, indicator, nutsLevel, year, count, ivMin, ivMax, nutsIds, values in rows:
+      nutsLevel = int(nutsLevel)
+      if nutsLevel not in nutsLevels:
+        continue
+      statistics.setdefault(activityId, {}) \
+        .setdefault(indicator, {}) \
+        .setdefault(nutsLevel, {})[str(year)] = IndicatorStatistics(int(count), float(ivMin), float(ivMax), nutsIds.split(','),
+                                                                    [float(v) for v in str(values).split(',')])
+    return statistics
+
+
+class QgisDataSource(DataSource):
+  """
+  Read MOSES tables through QGIS PostgreSQL layers of the current project.
+  """
+
+  def __init__(self, dbHost, dbPort, dbName, dbUsername, dbPassword, dbSchema):
+    self.dbHost = dbHost
+    self.dbPort = dbPort
+    self.dbName = dbName
+    self.dbUsername = dbUsername
+    self.dbPassword = dbPassword
+    self.dbSchema = dbSchema
+
+  def addTable(self, tableName, schema=None, geometryColumn=None):
+    """
+    Add DB table to current project
+
+    :rtype: QgsVectorLayer
+    """
+    uri = QgsDataSourceUri()
+    uri.setConnection(self.dbHost, self.dbPort, self.dbName, self.dbUsername, self.dbPassword)
+    uri.setDataSource(schema or self.dbSchema, tableName, geometryColumn)
+    vlayer = QgsVectorLayer(uri.uri(False), tableName, "postgres")
+    QgsProject.instance().addMapLayer(vlayer)
+    return vlayer
+
+  def getTable(self, tableName):
+    """
+    Get a table and exit if not found.
+
+    :rtype: QgsVectorLayer
+    """
+    layers = QgsProject.instance().mapLayersByName(tableName)
+    table = None
     if len(layers) == 0:
       print (f"Open PostgreSQL table '{tableName}' in current project. Adding it ...")
       return self.addTable(tableName)
@@ -406,6 +2639,812 @@ class MosesPublication:
       print (f"MOSES indicator layer '{tableName}' found")
     return table
 
+  def getActivities(self):
+    # Load layers on map
+    # https://gis.stackexchange.com/questions/277040/load-a-postgis-layer-into-a-qgis-map
+    lActivities = self.getTable(CONST.LAYERNAME.activities)
+    requestActivities = QgsFeatureRequest()
+    requestActivities.addOrderBy("id")
+    return [(f.attribute('id'), f.attribute('sector'), f.attribute('name'))
+            for f in lActivities.getFeatures(requestActivities)]
+
+  def getIndicatorLabels(self):
+    lIndicators = self.getTable(CONST.LAYERNAME.indicators)
+    return {f.attribute('id'): self.buildIndicatorLabel(f.attribute('name'), f.attribute('unit'))
+            for f in lIndicators.getFeatures()}
+
+  def executeSql(self, sql, table):
+    uri = QgsDataSourceUri()
+    uri.setConnection(self.dbHost, self.dbPort, self.dbName, self.dbUsername, self.dbPassword)
+    connection = QgsProviderRegistry.instance().providerMetadata('postgres').createConnection(uri.uri(False), {})
+    return connection.executeSql(sql.format(dbSchema=self.dbSchema, dbTable=table))
+
+  def getIndicatorStatistics(self, nutsLevels):
+    return self.buildStatistics(self.executeSql(self.STATISTICS, CONST.LAYERNAME.ivalue), nutsLevels)
+
+  def getIndicatorValues(self):
+    return self.executeSql(self.VALUES, CONST.LAYERNAME.ivalue)
+
+  def getNutsExtents(self):
+    return self.buildNutsExtents(self.executeSql(self.NUTS_EXTENTS, CONST.LAYERNAME.nuts))
+
+  def getNutsGeometries(self, nutsLevel):
+    return [(nutsId, geometry)
+            for nutsId, geometry in self.executeSql(self.NUTS_GEOMETRIES.replace('{nutsLevel}', str(int(nutsLevel))), CONST.LAYERNAME.nuts)]
+
+  def getStamp(self):
+    return self.buildStamp(self.executeSql(self.STAMP, CONST.LAYERNAME.ivalue)[0][0])
+
+
+class DbApiDataSource(DataSource):
+  """
+  Read MOSES tables using a DB-API connection (eg. psycopg2).
+  """
+  ACTIVITIES = "SELECT id, sector, name FROM {dbSchema}.{dbTable} ORDER BY id"
+  INDICATORS = "SELECT id, name, unit FROM {dbSchema}.{dbTable}"
+
+  def __init__(self, connection, dbSchema):
+    self.connection = connection
+    self.dbSchema = dbSchema
+
+  @classmethod
+  def connect(cls, dbHost, dbPort, dbName, dbUsername, dbPassword, dbSchema):
+    """
+    Connect to PostgreSQL using psycopg2.
+
+    :rtype: DbApiDataSource
+    """
+    import psycopg2
+    return cls(psycopg2.connect(host=dbHost, port=dbPort, dbname=dbName,
+                                user=dbUsername, password=dbPassword), dbSchema)
+
+  def execute(self, sql, table):
+    cursor = self.connection.cursor()
+    try:
+      cursor.execute(sql.format(dbSchema=self.dbSchema, dbTable=table))
+      return cursor.fetchall()
+    finally:
+      cursor.close()
+
+  def getActivities(self):
+    return [tuple(row) for row in self.execute(self.ACTIVITIES, CONST.LAYERNAME.activities)]
+
+  def getIndicatorLabels(self):
+    return {id: self.buildIndicatorLabel(name, unit)
+            for id, name, unit in self.execute(self.INDICATORS, CONST.LAYERNAME.indicators)}
+
+  def getIndicatorStatistics(self, nutsLevels):
+    return self.buildStatistics(self.execute(self.STATISTICS, CONST.LAYERNAME.ivalue), nutsLevels)
+
+  def getIndicatorValues(self):
+    return self.execute(self.VALUES, CONST.LAYERNAME.ivalue)
+
+  def getNutsExtents(self):
+    return self.buildNutsExtents(self.execute(self.NUTS_EXTENTS, CONST.LAYERNAME.nuts))
+
+  def getNutsGeometries(self, nutsLevel):
+    return [(nutsId, geometry)
+            for nutsId, geometry in self.execute(self.NUTS_GEOMETRIES.replace('{nutsLevel}', str(int(nutsLevel))), CONST.LAYERNAME.nuts)]
+
+  def getStamp(self):
+    return self.buildStamp(self.execute(self.STAMP, CONST.LAYERNAME.ivalue)[0][0])
+
+
+class SqliteDataSource(DbApiDataSource):
+  """
+  Read MOSES tables from a SQLite extract having the same tables
+  and columns as the PostgreSQL database.
+  """
+  # group_concat keeps the order of the sub query
+  STATISTICS = """
+    SELECT activity_id, indicator_id, nuts_level, year,
+           count(*), min(value), max(value),
+           group_concat(nuts_id, ','),
+           group_concat(value, ',')
+      FROM (SELECT * FROM {dbSchema}.{dbTable}
+             WHERE value IS NOT NULL
+             ORDER BY value, nuts_id)
+     GROUP BY activity_id, indicator_id, nuts_level, year
+  """
+
+  # Optional bounding box and GeoJSON geometry columns of the NUTS table
+  NUTS_EXTENTS = "SELECT nuts_id, xmin, ymin, xmax, ymax FROM {dbSchema}.{dbTable}"
+  NUTS_GEOMETRIES = "SELECT nuts_id, geojson FROM {dbSchema}.{dbTable} WHERE levl_code = {nutsLevel} ORDER BY nuts_id"
+
+  def __init__(self, file):
+    import sqlite3
+    super().__init__(sqlite3.connect(file), 'main')
+    self.file = file
+
+  def getNutsExtents(self):
+    try:
+      return super().getNutsExtents()
+    except self.connection.OperationalError:
+      return {}
+
+  def getNutsGeometries(self, nutsLevel):
+    try:
+      return super().getNutsGeometries(nutsLevel)
+    except self.connection.OperationalError:
+      return []
+
+  def getStamp(self):
+    fileStat = os.stat(self.file)
+    return f'{fileStat.st_mtime_ns}:{fileStat.st_size}'
+
+
+class FileDataSource(DataSource):
+  """
+  Read MOSES CSV extracts (moses_NACES.csv, moses_indicator.csv
+  and moses_values.csv) as loaded in the database (see README).
+
+  NUTS level is read from an optional nuts.csv file (nuts_id, levl_code)
+  or derived from the NUTS id length. NUTS bounding boxes are read from
+  its optional xmin, ymin, xmax and ymax columns, and NUTS geometries from
+  an optional nuts.geojson file (nuts_id and levl_code properties).
+  """
+  YEAR_COLUMN = re.compile(r'^year(\d{4})$')
+
+  def __init__(self, folder, encoding='latin-1',
+               activitiesFile='moses_NACES.csv',
+               indicatorsFile='moses_indicator.csv',
+               valuesFile='moses_values.csv',
+               nutsFile='nuts.csv',
+               statusFile='moses_status.csv',
+               nutsGeometriesFile='nuts.geojson'):
+    self.folder = folder
+    self.encoding = encoding
+    self.activitiesFile = activitiesFile
+    self.indicatorsFile = indicatorsFile
+    self.valuesFile = valuesFile
+    self.nutsFile = nutsFile
+    self.statusFile = statusFile
+    self.nutsGeometriesFile = nutsGeometriesFile
+
+  def readCsv(self, file):
+    """
+    Stream CSV rows with lower case column names.
+
+    :rtype: generator
+    """
+    with open(os.path.join(self.folder, file), newline='', encoding=self.encoding) as csvFile:
+      dialect = csv.Sniffer().sniff(csvFile.readline(), delimiters=';,\t')
+      csvFile.seek(0)
+      for row in csv.DictReader(csvFile, dialect=dialect):
+        yield {k.lower(): v for k, v in row.items()}
+
+  def getActivities(self):
+    return sorted((row['nace_id'].replace('.', ','), row['sector'], row['nace_descr'])
+                  for row in self.readCsv(self.activitiesFile)
+                  if row['nace_id'])
+
+  def getIndicatorLabels(self):
+    return {row['ind_id']: self.buildIndicatorLabel(row['ind_name'], row['ind_unit'])
+            for row in self.readCsv(self.indicatorsFile)
+            if row['ind_id']}
+
+  def getStamp(self):
+    stamps = []
+    for file in (self.activitiesFile, self.indicatorsFile, self.valuesFile, self.nutsFile):
+      path = os.path.join(self.folder, file)
+      if os.path.exists(path):
+        fileStat = os.stat(path)
+        stamps.append(f'{file}:{fileStat.st_mtime_ns}:{fileStat.st_size}')
+    return ','.join(stamps)
+
+  def getNutsLevels(self):
+    if not os.path.exists(os.path.join(self.folder, self.nutsFile)):
+      return {}
+    return {row['nuts_id']: int(row['levl_code']) for row in self.readCsv(self.nutsFile)}
+
+  def getNutsExtents(self):
+    if not os.path.exists(os.path.join(self.folder, self.nutsFile)):
+      return {}
+    return self.buildNutsExtents((row['nuts_id'], row.get('xmin'), row.get('ymin'), row.get('xmax'), row.get('ymax'))
+                                 for row in self.readCsv(self.nutsFile))
+
+  def getNutsGeometries(self, nutsLevel):
+    path = os.path.join(self.folder, self.nutsGeometriesFile)
+    if not os.path.exists(path):
+      return []
+    with open(path, encoding='utf-8') as geojsonFile:
+      features = json.load(geojsonFile)['features']
+    return sorted((feature['properties']['nuts_id'], json.dumps(feature['geometry']))
+                  for feature in features
+                  if int(feature['properties']['levl_code']) == nutsLevel)
+
+  def getIndicatorValues(self):
+    nutsIdLevels = self.getNutsLevels()
+    rows = []
+    for row in self.readCsv(self.valuesFile):
+      nutsId = row['nuts_id']
+      nutsLevel = nutsIdLevels.get(nutsId, len(nutsId) - 2)
+      activityId = row['nacescode'].replace('.', ',')
+      for year, value, status in self.getYearValues(row):
+        rows.append((activityId, row['indicators'], nutsLevel, year, nutsId, float(value), status))
+    return rows
+
+  def getYearValues(self, row):
+    """
+    Unpivot the yearNNNN columns of a values row into (year, value, status),
+    skipping empty values. Values use a decimal point and the status of
+    the n-th year column is in the status_n column.
+
+    :rtype: list
+    """
+    yearValues = []
+    yearColumns = [column for column in row if self.YEAR_COLUMN.match(column)]
+    for y, column in enumerate(yearColumns):
+      value = row[column]
+      if value is None or value.strip() == '':
+        continue
+      yearValues.append((self.YEAR_COLUMN.match(column).group(1), value.strip().replace(',', '.'),
+                         row.get(f'status_{y + 1}') or ''))
+    return yearValues
+
+  def getIndicatorStatistics(self, nutsLevels):
+    values = {}
+    for activityId, indicator, nutsLevel, year, nutsId, value, status in self.getIndicatorValues():
+      if nutsLevel in nutsLevels:
+        values.setdefault((activityId, indicator, nutsLevel, year), []).append((value, nutsId))
+
+    rows = []
+    for (activityId, indicator, nutsLevel, year), combination in values.items():
+      combination.sort()
+      rows.append((activityId, indicator, nutsLevel, year, len(combination),
+                   combination[0][0], combination[-1][0], ','.join(n for _, n in combination),
+                   ','.join(repr(v) for v, _ in combination)))
+    return self.buildStatistics(rows, nutsLevels)
+
+
+class IndicatorCube:
+  """
+  Columnar copy of indicator values saved as NumPy arrays in a folder,
+  memory mapped when loaded.
+
+  Rows are sorted by activity, indicator, NUTS level, year, value and NUTS id,
+  so that the values of a combination are a slice of the arrays. Ids are
+  dictionary encoded, codes following the order of the ids.
+  """
+  COLUMNS = ('activity', 'indicator', 'level', 'year', 'nuts', 'value', 'status')
+  DICTIONARIES = ('activity', 'indicator', 'year', 'nuts', 'status')
+  METADATA = 'cube.json'
+
+  def __init__(self, stamp, arrays, dictionaries, activities, indicatorLabels, nutsExtents):
+    self.stamp = stamp
+    self.arrays = arrays
+    self.dictionaries = dictionaries
+    self.activities = activities
+    self.indicatorLabels = indicatorLabels
+    self.nutsExtents = nutsExtents
+
+  @classmethod
+  def build(cls, source, stamp):
+    """
+    Cube of all values of a data source.
+
+    :rtype: IndicatorCube
+    """
+    rows = source.getIndicatorValues()
+    columns = list(zip(*rows)) if len(rows) > 0 else [()] * len(cls.COLUMNS)
+    arrays = {}
+    dictionaries = {}
+    for name, column in zip(cls.COLUMNS, columns):
+      if name in cls.DICTIONARIES:
+        dictionary, codes = numpy.unique(numpy.array(['' if v is None else str(v) for v in column], dtype=str),
+                                         return_inverse=True)
+        dictionaries[name] = dictionary.tolist()
+        arrays[name] = codes.astype(numpy.int32)
+      elif name == 'level':
+        arrays[name] = numpy.array([int(v) for v in column], dtype=numpy.int8)
+      else:
+        arrays[name] = numpy.array([float(v) for v in column], dtype=numpy.float64)
+
+    order = numpy.lexsort([arrays[name] for name in ('nuts', 'value', 'year', 'level', 'indicator', 'activity')])
+    arrays = {name: array[order] for name, array in arrays.items()}
+
+    # First row of each combination, and end of the last one
+    keys = numpy.stack([arrays[name].astype(numpy.int32) for name in ('activity', 'indicator', 'level', 'year')])
+    starts = numpy.flatnonzero(numpy.any(keys[:, 1:] != keys[:, :-1], axis=0)) + 1
+    offsets = numpy.concatenate(([0], starts, [len(order)])) if len(order) > 0 else numpy.zeros(1)
+    arrays['offsets'] = offsets.astype(numpy.int64)
+    return cls(stamp, arrays, dictionaries, source.getActivities(), source.getIndicatorLabels(), source.getNutsExtents())
+
+  @classmethod
+  def load(cls, folder):
+    """
+    Cube saved in a folder, None if there is none.
+
+    :rtype: IndicatorCube
+    """
+    file = os.path.join(folder, cls.METADATA)
+    if not os.path.exists(file):
+      return None
+    with open(file) as metadataFile:
+      metadata = json.load(metadataFile)
+    arrays = {name: numpy.load(os.path.join(folder, f'{name}.npy'), mmap_mode='r')
+              for name in cls.COLUMNS + ('offsets',)}
+    return cls(metadata['stamp'], arrays, metadata['dictionaries'],
+               [tuple(a) for a in metadata['activities']], metadata['indicatorLabels'],
+               {nutsId: tuple(box) for nutsId, box in metadata.get('nutsExtents', {}).items()})
+
+  def save(self, folder):
+    """
+    Write the cube in a new folder which then replaces the folder, so that an interrupted
+    save leaves the previous cube or none. The cube previously loaded from the folder
+    must be released first, as memory mapped files can not be replaced on Windows.
+    """
+    newFolder = folder + '.new'
+    oldFolder = folder + '.old'
+    for leftover in (newFolder, oldFolder):
+      if os.path.exists(leftover):
+        shutil.rmtree(leftover)
+    os.makedirs(newFolder)
+    for name, array in self.arrays.items():
+      numpy.save(os.path.join(newFolder, f'{name}.npy'), array)
+    with open(os.path.join(newFolder, self.METADATA), 'w') as metadataFile:
+      json.dump({'stamp': self.stamp, 'dictionaries': self.dictionaries,
+                 'activities': self.activities, 'indicatorLabels': self.indicatorLabels,
+                 'nutsExtents': self.nutsExtents}, metadataFile)
+    if os.path.exists(folder):
+      os.replace(folder, oldFolder)
+    os.replace(newFolder, folder)
+    shutil.rmtree(oldFolder, ignore_errors=True)
+
+  def getStatistics(self, nutsLevels):
+    """
+    Statistics of all combinations of the NUTS levels, values being
+    slices of the memory mapped values.
+
+    :rtype: dict
+    """
+    offsets = self.arrays['offsets']
+    starts = offsets[:-1]
+    combinations = numpy.flatnonzero(numpy.isin(self.arrays['level'][starts], list(nutsLevels)))
+    activities = self.dictionaries['activity']
+    indicators = self.dictionaries['indicator']
+    years = self.dictionaries['year']
+    nutsIds = numpy.array(self.dictionaries['nuts'], dtype=str)
+    values = self.arrays['value']
+    nuts = self.arrays['nuts']
+
+    statistics = {}
+    for c in combinations.tolist():
+      start, end = int(offsets[c]), int(offsets[c + 1])
+      combinationValues = values[start:end]
+      statistics.setdefault(activities[self.arrays['activity'][start]], {}) \
+        .setdefault(indicators[self.arrays['indicator'][start]], {}) \
+        .setdefault(int(self.arrays['level'][start]), {})[years[self.arrays['year'][start]]] = \
+        IndicatorStatistics(end - start, float(combinationValues[0]), float(combinationValues[-1]),
+                            nutsIds[nuts[start:end]].tolist(), combinationValues)
+    return statistics
+
+  def getValues(self):
+    """
+    Rows of activity, indicator, NUTS level, year, NUTS id, value and status.
+
+    :rtype: list
+    """
+    decoded = [numpy.array(self.dictionaries[name], dtype=object)[self.arrays[name]] if name in self.DICTIONARIES
+               else self.arrays[name].tolist()
+               for name in self.COLUMNS]
+    return list(zip(*decoded))
+
+
+class CubeDataSource(DataSource):
+  """
+  Read indicators from a local cube, rebuilt from the source when the source stamp changed.
+  Without source, the cube is used as is (eg. offline runs).
+  """
+
+  def __init__(self, source, folder):
+    self.source = source
+    self.folder = folder
+    cube = IndicatorCube.load(folder)
+    if source is not None:
+      stamp = source.getStamp()
+      if cube is None or stamp is None or cube.stamp != stamp:
+        print(f'Refreshing indicator cube {folder} ...')
+        # Memory mapped arrays of the previous cube are released before its folder is replaced
+        cube = None
+        IndicatorCube.build(source, stamp).save(folder)
+        cube = IndicatorCube.load(folder)
+    if cube is None:
+      raise ValueError(f'No indicator cube found in {folder}.')
+    self.cube = cube
+
+  def getActivities(self):
+    return self.cube.activities
+
+  def getIndicatorLabels(self):
+    return self.cube.indicatorLabels
+
+  def getIndicatorStatistics(self, nutsLevels):
+    return self.cube.getStatistics(nutsLevels)
+
+  def getIndicatorValues(self):
+    return self.cube.getValues()
+
+  def getNutsExtents(self):
+    return self.cube.nutsExtents
+
+  def getNutsGeometries(self, nutsLevel):
+    # Geometries are not part of the cube
+    return [] if self.source is None else self.source.getNutsGeometries(nutsLevel)
+
+  def getStamp(self):
+    return self.cube.stamp
+
+
+class CopyStream:
+  """
+  File like object streaming rows in the COPY text format,
+  so that rows are never all held in memory.
+  """
+
+  def __init__(self, rows):
+    self.lines = ('\t'.join(self.encode(value) for value in row) + '\n' for row in rows)
+    self.buffer = ''
+
+  @staticmethod
+  def encode(value):
+    if value is None:
+      return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+  def read(self, size=-1):
+    chunks = [self.buffer]
+    length = len(self.buffer)
+    for line in self.lines:
+      chunks.append(line)
+      length = length + len(line)
+      if 0 <= size <= length:
+        break
+    data = ''.join(chunks)
+    if size < 0:
+      self.buffer = ''
+      return data
+    self.buffer = data[size:]
+    return data[:size]
+
+
+class BulkLoader:
+  """
+  Load a data release of CSV extracts (see FileDataSource) in the MOSES tables
+  created by the DB script (see README) using a psycopg2 connection.
+
+  The values file is streamed once, its year columns unpivoted, and rows are
+  copied straight into moses_indicator_values. Derived tables are then
+  refreshed on the server, all in one transaction: tables are locked
+  until the release is committed and left unchanged on error.
+
+  As with the SQL script, values without status get the '-' status, which
+  is added to moses_status with an empty name, and values of unknown NUTS
+  or status are skipped.
+  """
+  NUTS = "SELECT nuts_id, levl_code FROM {dbSchema}.nuts"
+
+  # Tables referencing the truncated ones are all listed, so that other tables are never emptied
+  TRUNCATE = "TRUNCATE {tables}"
+
+  COPY = "COPY {dbSchema}.{table} ({columns}) FROM STDIN"
+
+  EXISTS = "SELECT to_regclass('{dbSchema}.{table}') IS NOT NULL"
+
+  DATE_TABLE = """
+    INSERT INTO {dbSchema}.moses_indicator_values_date
+      SELECT nuts_id, nuts_level, activity_id, indicator_id, unit,
+             TO_DATE(year, 'YYYY') AS year, value, status, data_source, website, remarks
+        FROM {dbSchema}.moses_indicator_values
+  """
+
+  NUTS_TABLE = """
+    INSERT INTO {dbSchema}.moses_indicator_values_with_nuts_m
+      SELECT i.*, nuts_name, cntr_code, levl_code, wkb_geometry
+        FROM {dbSchema}.nuts n, {dbSchema}.moses_indicator_values i
+       WHERE n.nuts_id = i.nuts_id
+  """
+
+  # Level tables created by the schema script (see SchemaOptimizer)
+  LEVEL_TABLE = """
+    INSERT INTO {dbSchema}.{levelTable}
+      SELECT t.* FROM {dbSchema}.{table} t
+        JOIN {dbSchema}.nuts n ON n.nuts_id = t.nuts_id
+       WHERE n.levl_code = '{level}'
+  """
+
+  COLUMNS = """
+    SELECT column_name FROM information_schema.columns
+     WHERE table_schema = '{dbSchema}' AND table_name = '{table}'
+     ORDER BY ordinal_position
+  """
+
+  # Query tables created by the schema script (see SchemaOptimizer), their geometry columns
+  # (eg. wkb_geometry_3857) being read from the NUTS table and other columns from the values
+  QUERY_TABLE = """
+    INSERT INTO {dbSchema}.{queryTable} ({columns})
+      SELECT {items} FROM {dbSchema}.{table} t
+        JOIN {dbSchema}.nuts n ON n.nuts_id = t.nuts_id
+       WHERE n.levl_code = '{level}'
+  """
+
+  ANALYZE = "ANALYZE {table}"
+
+  VALUE_COLUMNS = ['nuts_id', 'nuts_level', 'activity_id', 'indicator_id', 'unit', 'year', 'value',
+                   'status', 'data_source', 'website', 'remarks']
+
+  # Status of values without status, as set by the SQL script
+  NO_STATUS = '-'
+
+  def __init__(self, connection, dbSchema, source, nutsLevels=(0, 1, 2, 3)):
+    self.connection = connection
+    self.dbSchema = dbSchema
+    self.source = source
+    self.nutsLevels = nutsLevels
+    self.counts = {}
+
+  def execute(self, cursor, sql, **parameters):
+    cursor.execute(sql.format(dbSchema=self.dbSchema, **parameters))
+
+  def copy(self, cursor, table, columns, rows):
+    cursor.copy_expert(self.COPY.format(dbSchema=self.dbSchema, table=table, columns=', '.join(columns)),
+                       CopyStream(rows))
+    self.counts[table] = cursor.rowcount
+
+  def getStatus(self):
+    status = {row['status_id']: row['status_descr'] for row in self.source.readCsv(self.source.statusFile)
+              if row['status_id']}
+    status.setdefault(self.NO_STATUS, '')
+    return status
+
+  def getActivityRows(self):
+    for row in self.source.readCsv(self.source.activitiesFile):
+      if row['nace_id']:
+        yield row['nace_id'].replace('.', ','), row['sector'], row['nace_section'], row['nace_div'], row['nace_descr']
+
+  def getIndicatorRows(self):
+    for row in self.source.readCsv(self.source.indicatorsFile):
+      if row['ind_id']:
+        yield row['ind_id'], row['ind_name'], row['ind_unit']
+
+  def getValueRows(self, nutsIdLevels, status):
+    """
+    Unpivoted rows of the values file.
+
+    :rtype: generator
+    """
+    for row in self.source.readCsv(self.source.valuesFile):
+      nutsId = row['nuts_id']
+      activityId = row['nacescode'].replace('.', ',')
+      for year, value, statusId in self.source.getYearValues(row):
+        statusName = status.get(statusId or self.NO_STATUS)
+        if nutsId not in nutsIdLevels or statusName is None:
+          self.counts['skipped'] = self.counts.get('skipped', 0) + 1
+          continue
+        yield (nutsId, nutsIdLevels[nutsId], activityId, row['indicators'], row['unit'], year, value,
+               statusName, row['data_sourc'], row['website'], row['remarks'])
+
+  def load(self):
+    """
+    Load the release and refresh the derived tables in one transaction.
+
+    :rtype: dict
+    """
+    self.counts = {}
+    cursor = self.connection.cursor()
+    try:
+      self.execute(cursor, self.NUTS)
+      nutsIdLevels = {nutsId: str(level) for nutsId, level in cursor.fetchall()}
+      status = self.getStatus()
+
+      derivedTables = [f'{self.dbSchema}.moses_indicator_values_date', f'{self.dbSchema}.moses_indicator_values_with_nuts_m']
+      levelTables = []
+      queryTables = []
+      for table in (CONST.LAYERNAME.ivalue, 'moses_indicator_values_date'):
+        for level in sorted(self.nutsLevels):
+          levelTable = SchemaOptimizer.getLevelTable(table, level)
+          self.execute(cursor, self.EXISTS, table=levelTable)
+          if cursor.fetchone()[0]:
+            levelTables.append((table, levelTable, level))
+            derivedTables.append(f'{self.dbSchema}.{levelTable}')
+          queryTable = SchemaOptimizer.getQueryTable(table, level)
+          self.execute(cursor, self.EXISTS, table=queryTable)
+          if cursor.fetchone()[0]:
+            self.execute(cursor, self.COLUMNS, table=queryTable)
+            queryTables.append((table, queryTable, level, [column for column, in cursor.fetchall()]))
+            derivedTables.append(f'{self.dbSchema}.{queryTable}')
+
+      tables = [f'{self.dbSchema}.{table}' for table in ('moses_status', CONST.LAYERNAME.activities, CONST.LAYERNAME.indicators,
+                                                          CONST.LAYERNAME.ivalue)] + derivedTables
+      self.execute(cursor, self.TRUNCATE, tables=', '.join(tables))
+
+      self.copy(cursor, 'moses_status', ['id', 'name'], sorted(status.items()))
+      self.copy(cursor, CONST.LAYERNAME.activities, ['id', 'sector', 'section', 'div', 'name'], self.getActivityRows())
+      self.copy(cursor, CONST.LAYERNAME.indicators, ['id', 'name', 'unit'], self.getIndicatorRows())
+      self.copy(cursor, CONST.LAYERNAME.ivalue, self.VALUE_COLUMNS, self.getValueRows(nutsIdLevels, status))
+
+      self.execute(cursor, self.DATE_TABLE)
+      self.execute(cursor, self.NUTS_TABLE)
+      for table, levelTable, level in levelTables:
+        self.execute(cursor, self.LEVEL_TABLE, table=table, levelTable=levelTable, level=level)
+      for table, queryTable, level, columns in queryTables:
+        items = [f'n.{column}' if column.startswith('wkb_geometry') else f't.{column}' for column in columns]
+        self.execute(cursor, self.QUERY_TABLE, table=table, queryTable=queryTable, level=level,
+                     columns=', '.join(columns), items=', '.join(items))
+      for table in tables:
+        self.execute(cursor, self.ANALYZE, table=table)
+
+      self.connection.commit()
+    except Exception:
+      self.connection.rollback()
+      raise
+    finally:
+      cursor.close()
+
+    print(f"Loaded {self.counts.get(CONST.LAYERNAME.ivalue, 0)} indicator values "
+          f"({self.counts.get('skipped', 0)} skipped with unknown NUTS or status).")
+    return self.counts
+
+
+class MosesPublication:
+  # dbName = 'moses'
+  # dbHost = 'localhost'
+  # dbPort = '5432'
+  # dbUsername = 'www-data'
+  # dbPassword = 'www-data'
+  # dbSchema = 'public'
+  dbName = 'moses'
+  dbHost = 'vpostgres2.ifremer.fr'
+  dbPort = '5432'
+  dbUsername = 'moses_usr'
+  dbPassword = 'The ...'
+  dbSchema = 'moses'
+
+  # wmsTimeLayerMode = False
+  wmsTimeLayerMode = True
+
+  # equalInterval, quantile or jenks
+  classificationMethod = "equalInterval"
+  classificationNbOfClasses = 5
+  # Significant digits of the class bounds in labels, bounds of class expressions not being rounded
+  classificationLabelPrecision = 6
+
+  # Define color map
+  # ['Spectral', 'RdYlGn', 'Set2', 'Accent', 'OrRd', 'Set1', 'PuBu', 'Set3', 'BuPu', 'Dark2', 'RdBu', 'Oranges', 'BuGn', 'PiYG', 'YlOrBr', 'YlGn', 'Reds', 'RdPu', 'Greens', 'PRGn', 'YlGnBu', 'RdYlBu', 'Paired', 'BrBG', 'Purples', 'Pastel2', 'Pastel1', 'GnBu', 'Greys', 'RdGy', 'YlOrRd', 'PuOr', 'PuRd', 'Blues', 'PuBuGn']
+  colorScheme = 'Oranges'
+
+  # Stages of a run: mapfile, time mapfile (wmsTimeLayerMode), contexts and QGIS project.
+  # Layers of stages not run are still rendered, so that the manifest stays complete.
+  isBuildingMapfile = True
+  isBuildingContexts = True
+  isAddingLayerToQgisProject = True
+  # Write the QGIS project once all layers are added (eg. 'O:/wms/moses.qgs')
+  qgisProjectFile = None
+  # Add one QGIS layer per activity, indicator, level and year (None) or one temporal layer
+  # per NUTS level ('temporal') showing the activity and indicator of the moses_activity and
+  # moses_indicator project variables, the classes being renderer rules
+  qgisLayerMode = None
+
+  # TODO: Move to property file
+  projectName = "MOSES project data visualization service"
+  projectDescription = "Publishing indicators by NUTS level on marine coastline"
+  projectUrl = "http://mosesproject.eu/"
+  wmsBaseUrl = "http://www.ifremer.fr/services/wms/moses"
+  wmsTimeBaseUrl = "http://www.ifremer.fr/services/wms/moses"
+  # wmsBaseUrl = "http://localhost/cgi-bin/mapserv?map=/data/dev/moses/moses.map"
+  # wmsTimeBaseUrl = "http://localhost/cgi-bin/mapserv?map=/data/dev/moses/moses.map"
+  debug = 'on'
+
+  map = 'O:/wms/moses.map'
+  maptime = 'O:/wms/moses-time.map'
+  context = 'V:/moses/moses.xml'
+  contexttime = 'V:/moses/moses-time.xml'
+  # map = '/data/dev/moses/moses.map'
+  # maptime = '/data/dev/moses/moses-time.map'
+  # context = '/data/dev/moses/moses.xml'
+  # contexttime = '/data/dev/moses/moses-time.xml'
+
+  # Only rebuild layers which changed since the previous run recorded in the manifest
+  # (eg. 'O:/wms/moses-manifest.json'), all layers being rebuilt without manifest
+  isIncremental = True
+  manifest = None
+
+  # Read indicators from a local cube folder, refreshed when the source tables changed (eg. 'O:/wms/moses-cube')
+  indicatorCube = None
+
+  # Build activities in parallel using a pool of processes when more than 1
+  numberOfWorkers = 1
+
+  # Write layers in one mapfile per activity ('activity') or per activity and NUTS level ('level')
+  # included by the main mapfiles. None writes all layers in the main mapfiles.
+  mapfileIncludeMode = None
+  # Also write a standalone mapfile per activity (eg. moses031.map), used by the activity contexts
+  isBuildingActivityMapfiles = False
+  wmsActivityBaseUrl = "http://www.ifremer.fr/services/wms/moses{activity}"
+
+  # Render the legend of each layer as a PNG in legendFolder, published at legendBaseUrl, instead of
+  # MapServer GetLegendGraphic. Identical legends are stored once.
+  isBuildingLegends = False
+  legendFolder = 'O:/wms/legends'
+  legendBaseUrl = 'http://www.ifremer.fr/services/wms/legends'
+
+  # Write a static WMS 1.3.0 capabilities document next to each mapfile (eg. moses-capabilities.xml)
+  # and the Apache configuration answering GetCapabilities requests with them. Documents are served
+  # at capabilitiesAlias.
+  isBuildingCapabilities = False
+  capabilitiesConfig = 'O:/wms/moses-capabilities.conf'
+  capabilitiesAlias = '/moses-capabilities/'
+
+  # Export NUTS geometries of each level (eg. nuts2.fgb, nuts2.geojson without GDAL) and the values of each
+  # activity and indicator for all levels and years (eg. 031.V11110.f32) with their classes (moses-vector.json)
+  # to vectorFolder, published at vectorBaseUrl and referenced by the context layers, for client side rendering
+  isExportingVectors = False
+  vectorFolder = 'O:/wms/vectors'
+  vectorBaseUrl = 'http://www.ifremer.fr/services/wms/vectors'
+
+  # Write a MapCache configuration of the mapfile layers (eg. moses-mapcache.xml) and the plan of
+  # the tiles to seed (eg. moses-seed.csv), only covering the NUTS having data of each layer
+  isBuildingTileCache = False
+  tileCacheFolder = '/var/cache/mapcache/moses'
+  # First and last zoom levels seeded by NUTS level
+  tileCacheZoomLevels = {0: (0, 6), 1: (0, 7), 2: (2, 8), 3: (3, 9)}
+
+  # Write one layer per NUTS level using runtime substitution of activity, indicator and year
+  # instead of one layer per combination. Classes are loaded in the database using the classes SQL script.
+  # Requires wmsTimeLayerMode to be disabled.
+  isParameterizedMode = False
+  classes = 'O:/wms/moses-classes.sql'
+
+  # Write the indexes matching the layer queries in the schema SQL script, and per NUTS level tables
+  # which are then queried by layers when isUsingLevelTables. Once the script is loaded, query plans
+  # of a sample of layers can be checked for sequential scans (PostgreSQL data source or psycopg2).
+  isOptimizingSchema = False
+  schemaSql = 'O:/wms/moses-schema.sql'
+  isUsingLevelTables = False
+  isVerifyingQueryPlans = False
+  queryPlanSampleSize = 20
+
+  # Scale bands as (minimum scale denominator, simplification tolerance in degrees), starting at 0.
+  # Simplified NUTS tables of the bands are created by the schema SQL script and layers
+  # switch tables by scale. A tolerance of 0 uses the full resolution geometry.
+  geometryResolutions = ()
+  # geometryResolutions = [(0, 0), (5000000, 0.005), (25000000, 0.02)]
+
+  # Draw the "No data" NUTS of each level in a shared base layer (eg. MOSES.Base.NUTS2), requested with
+  # the layers by contexts and the tile cache and added below them in the QGIS project, so that layers
+  # only select the NUTS having data
+  isUsingBaseLayers = False
+
+  # Read layers from per NUTS level query tables holding values with their geometry
+  # (eg. moses_indicator_values_query_level2), created with their indexes by the schema SQL script,
+  # so that GetFeatureInfo is a point in polygon search on one table. GetFeatureInfo only returns
+  # NUTS id, year, value and these items, for at most featureInfoMaxFeatures features per layer
+  # (eg. the years of a NUTS in time layers).
+  # Query tables only hold NUTS having data, so base layers are required.
+  isOptimizingFeatureInfo = False
+  featureInfoItems = ('unit', 'status')
+  featureInfoMaxFeatures = 10
+
+  # SRS of the layers: 4326, or 3857 or 3395 read from a projected and indexed NUTS geometry column
+  # (eg. wkb_geometry_3857) maintained by the schema SQL script, so that requests in this SRS
+  # (eg. EPSG:3857 of the viewer) are not reprojected by MapServer
+  layerSrid = 4326
+
+  # Print details of each layer, otherwise only progress is printed, at most once per progress interval in seconds
+  isVerbose = False
+  progressInterval = 5
+  # Write timers, counters and slowest combinations of the run (eg. 'O:/wms/moses-report.json')
+  instrumentationReport = None
+
+  #nutsLevels = (1,)
+  nutsLevels = (0, 1, 2, 3)
+  # Restrict the run to some activities, indicators and NUTS levels (eg. ['03,1'], ['V11110'], {2}), None for all.
+  # Filtered out layers are copied as they were in the previous run recorded in the manifest, so that
+  # the outputs still hold all layers (filtered out layers missing from the manifest are published).
+  activityIds = None
+  indicatorIds = None
+  selectedNutsLevels = None
+
   class ThematicCategory:
     min = 0
     max = 0
@@ -418,285 +3457,1036 @@ class MosesPublication:
       self.label = label
       self.color = color
 
-  def buildClassification(self, min, max, nb, nbOfClasses):
+  def buildClassification(self, breaks):
+    """
+    Categories of class breaks, colored using the palette.
+
+    :rtype: dict
+    """
     classes = {}
+    colors = self.palette.colorTable(len(breaks))
+    for x, (lower, upper) in enumerate(breaks):
+      color = colors[x]
+      label = f'{self.formatClassBound(lower)} - {self.formatClassBound(upper)}'
+      classes[x] = self.ThematicCategory(lower, upper, label, f'{color[0]} {color[1]} {color[2]}')
+    return classes
 
-    # No space for creating intervals
-    if min == max:
-      nbOfClasses = 1
+  def formatClassBound(self, value):
+    """
+    Class bound of a label rounded to classificationLabelPrecision significant digits,
+    without exponent nor trailing zeros (eg. 2172.6 for 2172.6000000000004).
 
-    interval = (max - min) / nbOfClasses
-    print(f" * Building classification with {nbOfClasses} with interval {interval} between {min} and {max} ...")
-    for x in range(0, nbOfClasses):
-      lower = min + (interval * x)
-      if nbOfClasses - 1 == x:
-        upper = max
-      else:
-        upper = lower + interval
-      # TODO: Round values
-      color = self.palette.color(x/nbOfClasses).getRgb()
-      print(color)
-      classes[x] = self.ThematicCategory(lower, upper, f'{lower} - {upper}', f'{color[0]} {color[1]} {color[2]}')
+    :rtype: str
+    """
+    return numpy.format_float_positional(value, precision=self.classificationLabelPrecision, fractional=False, trim='-')
+
+  def classifyStatistics(self, statistics):
+    """
+    Classify all combinations at once, and for time layers all years
+    of a level. Classes are indexed like statistics, None being
+    the year of time layers.
+
+    :rtype: dict
+    """
+    keys = []
+    arrays = []
+    for activityId, activityStatistics in statistics.items():
+      for indicator, indicatorStatistics in activityStatistics.items():
+        for nutsLevel, levelStatistics in indicatorStatistics.items():
+          for year, yearStatistics in levelStatistics.items():
+            keys.append((activityId, indicator, nutsLevel, year))
+            arrays.append(yearStatistics.values)
+          if self.wmsTimeLayerMode:
+            keys.append((activityId, indicator, nutsLevel, None))
+            arrays.append(numpy.sort(numpy.concatenate([s.values for s in levelStatistics.values()])))
+
+    if self.isVerbose:
+      print(f" * Building {self.classificationMethod} classification of {len(keys)} layers with {self.classificationNbOfClasses} classes ...")
+    classes = {}
+    for (activityId, indicator, nutsLevel, year), breaks in zip(keys, self.classifier.classify(arrays)):
+      classes.setdefault(activityId, {}) \
+        .setdefault(indicator, {}) \
+        .setdefault(nutsLevel, {})[year] = self.buildClassification(breaks)
     return classes
 
-  def addFilteredLayer(self, layerCode, n, a, i, y, group, nbOfClasses, min, max):
+  def createFilteredLayers(self, layerCode, n, a, i, y, classes, extent=None):
+    """
+    Create layer with indicator values for a specific level and year,
+    one per scale band when using geometry resolutions.
+    The renderer uses the classes and the extent of the mapfile layer.
+
+    :rtype: list
+    """
+    vlayers = []
+    for uri, minScaleDenom, maxScaleDenom in self.getQgisDataSources(n, a, i, y):
+      vlayer = self.createQgisLayer(uri, layerCode, extent, minScaleDenom, maxScaleDenom)
+      ranges = [QgsRendererRange(classes[c].min, classes[c].max, self.createQgisSymbol(classes[c].color), classes[c].label)
+                for c in classes]
+      renderer = QgsGraduatedSymbolRenderer('value', ranges)
+      vlayer.setRenderer(renderer)
+      vlayers.append(vlayer)
+
+    return vlayers
+
+  def createTemporalLayers(self, n, layers, extent=None):
     """
-    Add layer with indicator values for a specific level and year.
+    Create the temporal layer of a level for all activities, indicators and years,
+    one per scale band when using geometry resolutions. Features are filtered by
+    the moses_activity and moses_indicator project variables and by the year
+    of the project time range. Classes of each combination are renderer rules.
+    The data source only has regions with a value, which are the only ones drawn.
+
+    :rtype: list
+    """
+    vlayers = []
+    for uri, minScaleDenom, maxScaleDenom in self.getQgisDataSources(n):
+      vlayer = self.createQgisLayer(uri, f'MOSES.NUTS{n}', extent, minScaleDenom, maxScaleDenom)
+      temporalProperties = vlayer.temporalProperties()
+      temporalProperties.setMode(QgsVectorLayerTemporalProperties.ModeFeatureDateTimeStartAndEndFromExpressions)
+      temporalProperties.setStartExpression('make_datetime(to_int("year"), 1, 1, 0, 0, 0)')
+      temporalProperties.setEndExpression('make_datetime(to_int("year"), 12, 31, 23, 59, 59)')
+      temporalProperties.setIsActive(True)
+
+      root = QgsRuleBasedRenderer.Rule(None)
+      selection = QgsRuleBasedRenderer.Rule(None, 0, 0, '"activity_id" = @moses_activity AND "indicator_id" = @moses_indicator')
+      root.appendChild(selection)
+      combinations = {}
+      for a, i, y, indicatorFullLabel, classes in layers:
+        combination = combinations.get((a, i))
+        if combination is None:
+          combination = QgsRuleBasedRenderer.Rule(None, 0, 0, f'"activity_id" = \'{a}\' AND "indicator_id" = \'{i}\'',
+                                                  f'{a} {indicatorFullLabel}')
+          selection.appendChild(combination)
+          combinations[(a, i)] = combination
+        yearRule = QgsRuleBasedRenderer.Rule(None, 0, 0, f'"year" = \'{y}\'', f'{y}')
+        combination.appendChild(yearRule)
+        for x, c in enumerate(classes):
+          # Same bounds as the mapfile classes
+          equal = '=' if x == len(classes) - 1 else ''
+          yearRule.appendChild(QgsRuleBasedRenderer.Rule(self.createQgisSymbol(classes[c].color), 0, 0,
+                                                         f'{classes[c].min} <= "value" AND "value" <{equal} {classes[c].max}',
+                                                         classes[c].label))
+      vlayer.setRenderer(QgsRuleBasedRenderer(root))
+      vlayers.append(vlayer)
+
+    return vlayers
+
+  def createBaseLayers(self, n):
+    """
+    Create the "No data" base layer of a level with all its NUTS,
+    one per scale band when using geometry resolutions.
+
+    :rtype: list
+    """
+    vlayers = []
+    for uri, minScaleDenom, maxScaleDenom in self.getQgisNutsDataSources(n):
+      vlayer = self.createQgisLayer(uri, MapfileBuilder.getBaseLayerName(n), None, minScaleDenom, maxScaleDenom)
+      vlayer.setRenderer(QgsSingleSymbolRenderer(self.createQgisSymbol('240 240 240')))
+      vlayers.append(vlayer)
+    return vlayers
+
+  def createQgisLayer(self, uri, name, extent, minScaleDenom, maxScaleDenom):
+    """
+    Layer of a data source with the extent of the mapfile layer, displayed within a scale band.
 
     :rtype: QgsVectorLayer
     """
-    layer = QgsProject.instance().mapLayersByName(layerCode)
-    if layer is not None and len(layer) > 0:
-        QgsProject.instance().removeMapLayers([layer[0].id()])
+    vlayer = QgsVectorLayer(uri.uri(False), f'{name}', "postgres")
+    if extent is not None:
+      vlayer.setExtent(QgsRectangle(*extent))
+    if len(self.geometryResolutions) > 0:
+      # QGIS minimum scale is the most zoomed out one, 0 for no limit
+      vlayer.setScaleBasedVisibility(True)
+      vlayer.setMinimumScale(maxScaleDenom if maxScaleDenom is not None else 0)
+      vlayer.setMaximumScale(minScaleDenom)
+    return vlayer
 
-    uri = QgsDataSourceUri()
-    uri.setConnection(self.dbHost, self.dbPort, self.dbName, self.dbUsername, self.dbPassword)
+  def createQgisSymbol(self, color):
+    """
+    Fill symbol of a class color (eg. '255 0 0').
+
+    :rtype: QgsFillSymbol
+    """
+    return QgsFillSymbol.createSimple({'color': color.replace(' ', ','), 'outline_color': '211,211,211'})
+
+  def getExtent(self, nutsIds):
+    """
+    Bounding box of NUTS regions, None when none of them has a known bounding box.
+
+    :rtype: tuple
+    """
+    boxes = [self.nutsExtents[nutsId] for nutsId in nutsIds if nutsId in self.nutsExtents]
+    if len(boxes) == 0:
+      return None
+    boxes = numpy.array(boxes)
+    return tuple(boxes[:, :2].min(axis=0).tolist() + boxes[:, 2:].max(axis=0).tolist())
+
+  def getLegend(self, classes, instrumentation):
+    """
+    Static legend (URL, width, height) of classes, None when not building legends.
+
+    :rtype: tuple
+    """
+    if self.legendRenderer is None:
+      return None
+    with instrumentation.timer('render.legend'):
+      return self.legendRenderer.getLegend(classes)
+
+  def getQgisDataSources(self, n, a=None, i=None, y=None):
+    """
+    Data source of the QGIS layer of a level and year with the scale band
+    it is displayed in, one per scale band when using geometry resolutions.
+    Without activity, indicator and year, the data source has all values of the level.
+
+    :rtype: list
+    """
     # Add filter to global view / Provider filter
-    filter = f'"year" = \'{y}\' AND "levl_code" = \'{n}\' AND "activity_id" = \'{a}\' AND "indicator_id" = \'{i}\''
-    # uri.setDataSource(self.dbSchema, CONST.LAYERNAME.ivalueview, "wkb_geometry", filter)
-    uri.setDataSource(self.dbSchema, "moses_indicator_values_with_nuts_m", "wkb_geometry", filter)
-    vlayer = QgsVectorLayer(uri.uri(False), f'{layerCode}', "postgres")
+    filter = ' AND '.join(f'"{column}" = \'{value}\''
+                          for column, value in (('year', y), ('levl_code', n), ('activity_id', a), ('indicator_id', i))
+                          if value is not None)
+    if len(self.geometryResolutions) == 0:
+      uri = QgsDataSourceUri()
+      uri.setConnection(self.dbHost, self.dbPort, self.dbName, self.dbUsername, self.dbPassword)
+      # uri.setDataSource(self.dbSchema, CONST.LAYERNAME.ivalueview, "wkb_geometry", filter)
+      uri.setDataSource(self.dbSchema, "moses_indicator_values_with_nuts_m", "wkb_geometry", filter)
+      return [(uri, 0, None)]
 
-    # https://gis.stackexchange.com/questions/325236/qgis-3-crashes-when-adding-a-postgis-view-as-a-map-layer
-    QgsProject.instance().addMapLayer(vlayer)
-    QgsProject.instance().layerTreeRoot().findLayer(vlayer.id()).setItemVisibilityChecked(False)
+    sources = []
+    for r, (minScaleDenom, tolerance) in enumerate(self.geometryResolutions):
+      maxScaleDenom = self.geometryResolutions[r + 1][0] if r + 1 < len(self.geometryResolutions) else None
+      sql = (f'(SELECT v.*, n.levl_code, n.wkb_geometry FROM {self.dbSchema}.{CONST.LAYERNAME.ivalue} v '
+             f'JOIN {self.dbSchema}.{self.mapBuilder.getNutsTable(n, r)} n ON n.nuts_id = v.nuts_id)')
+      uri = QgsDataSourceUri()
+      uri.setConnection(self.dbHost, self.dbPort, self.dbName, self.dbUsername, self.dbPassword)
+      uri.setDataSource('', sql, "wkb_geometry", filter, "nuts_id")
+      sources.append((uri, minScaleDenom, maxScaleDenom))
+    return sources
+
+  def getQgisNutsDataSources(self, n):
+    """
+    Data source of the NUTS of a level with the scale band it is displayed in,
+    one per scale band when using geometry resolutions.
 
-    renderer = QgsGraduatedSymbolRenderer('value', [])
-    # renderer.setClassAttribute('value')
-    renderer.setMode(QgsGraduatedSymbolRenderer.EqualInterval)
+    :rtype: list
+    """
+    sources = []
+    for r, (minScaleDenom, tolerance) in enumerate(self.geometryResolutions or [(0, 0)]):
+      maxScaleDenom = self.geometryResolutions[r + 1][0] if r + 1 < len(self.geometryResolutions) else None
+      uri = QgsDataSourceUri()
+      uri.setConnection(self.dbHost, self.dbPort, self.dbName, self.dbUsername, self.dbPassword)
+      uri.setDataSource(self.dbSchema, self.mapBuilder.getNutsTable(n, r), "wkb_geometry", f'"levl_code" = \'{n}\'', "nuts_id")
+      sources.append((uri, minScaleDenom, maxScaleDenom))
+    return sources
 
-    if min == max:
-        nbOfClasses = 1
+  def __init__(self, dataSource=None, **options):
+    """
+    Publish indicators using the given data source,
+    by default the PostgreSQL database through QGIS when available.
 
-    renderer.updateClasses(vlayer,QgsGraduatedSymbolRenderer.EqualInterval, nbOfClasses)
-    style = QgsStyle().defaultStyle()
-    # ramp = style.addColorRamp("mosesPalette", self.palette)
+    Options override the class attributes (eg. map, context, isAddingLayerToQgisProject).
+    """
+    for name, value in options.items():
+      if not hasattr(self, name):
+        raise AttributeError(f"Unknown publication option '{name}'")
+      setattr(self, name, value)
 
-    renderer.updateColorRamp(self.palette)
-    vlayer.setRenderer(renderer)
+    if dataSource is None:
+      if QGIS_AVAILABLE:
+        dataSource = QgisDataSource(self.dbHost, self.dbPort, self.dbName, self.dbUsername, self.dbPassword, self.dbSchema)
+      else:
+        dataSource = DbApiDataSource.connect(self.dbHost, self.dbPort, self.dbName, self.dbUsername, self.dbPassword, self.dbSchema)
+    if self.indicatorCube is not None and not isinstance(dataSource, CubeDataSource):
+      dataSource = CubeDataSource(dataSource, self.indicatorCube)
+    self.dataSource = dataSource
+    self.palette = ColorBrewerPalette(self.colorScheme, self.classificationNbOfClasses)
+    self.classifier = Classifier(self.classificationMethod, self.classificationNbOfClasses)
+    self.legendRenderer = LegendRenderer(self.legendFolder, self.legendBaseUrl) if self.isBuildingLegends else None
+    self.vectorExporter = VectorExporter(self.vectorFolder, self.vectorBaseUrl) if self.isExportingVectors else None
 
-    root = QgsProject.instance().layerTreeRoot()
-    layer = root.findLayer(vlayer.id())
-    clone = layer.clone()
-    group.insertChildNode(-1, clone)
-    root.removeChildNode(layer)
+    if self.isParameterizedMode and (self.mapfileIncludeMode is not None or self.isBuildingActivityMapfiles):
+      raise ValueError('Parameterized mode does not support included or activity mapfiles.')
+    if self.isParameterizedMode and self.isBuildingCapabilities:
+      raise ValueError('Parameterized mode does not support static capabilities.')
+    if self.isBuildingCapabilities and self.wmsTimeLayerMode \
+        and urllib.parse.urlparse(self.wmsBaseUrl).path == urllib.parse.urlparse(self.wmsTimeBaseUrl).path:
+      raise ValueError('Static capabilities require distinct wmsBaseUrl and wmsTimeBaseUrl paths.')
+    if self.isParameterizedMode and self.isBuildingTileCache:
+      raise ValueError('Parameterized mode does not support tile cache configuration.')
+    if self.isParameterizedMode and self.isUsingBaseLayers:
+      raise ValueError('Parameterized mode does not support base layers.')
+    if self.isParameterizedMode and self.wmsTimeLayerMode:
+      raise ValueError('Parameterized mode does not support time layers.')
+    if self.isOptimizingFeatureInfo and not self.isUsingBaseLayers:
+      raise ValueError('Feature info optimization requires base layers.')
+    if self.isOptimizingFeatureInfo and len(self.geometryResolutions) > 0:
+      raise ValueError('Feature info optimization does not support geometry resolutions.')
+    unknownItems = set(self.featureInfoItems) - set(MapfileBuilder.FEATURE_ITEMS)
+    if self.isOptimizingFeatureInfo and len(unknownItems) > 0:
+      raise ValueError(f"Feature info items {', '.join(sorted(unknownItems))} are not one of {', '.join(MapfileBuilder.FEATURE_ITEMS)}.")
 
-    return vlayer
+    minScaleDenoms = [minScaleDenom for minScaleDenom, tolerance in self.geometryResolutions]
+    if len(minScaleDenoms) > 0 and (minScaleDenoms[0] != 0 or minScaleDenoms != sorted(set(minScaleDenoms))):
+      raise ValueError('Geometry resolutions must start at scale 0 and be sorted by scale.')
+    if self.layerSrid not in MapfileBuilder.UNITS:
+      raise ValueError(f"Layer SRS EPSG:{self.layerSrid} is not one of {', '.join(f'EPSG:{srid}' for srid in MapfileBuilder.UNITS)}.")
 
-  def __init__(self):
-    # TODO: Move to property file
-    projectName = "MOSES project data visualization service"
-    projectDescription = "Publishing indicators by NUTS level on marine coastline"
-    projectUrl = "http://mosesproject.eu/"
-    wmsBaseUrl = "http://www.ifremer.fr/services/wms/moses"
-    wmsTimeBaseUrl = "http://www.ifremer.fr/services/wms/moses"
-    # wmsBaseUrl = "http://localhost/cgi-bin/mapserv?map=/data/dev/moses/moses.map"
-    # wmsTimeBaseUrl = "http://localhost/cgi-bin/mapserv?map=/data/dev/moses/moses.map"
-    debug = 'on'
-
-    map = 'O:/wms/moses.map'
-    maptime = 'O:/wms/moses-time.map'
-    context = 'V:/moses/moses.xml'
-    contexttime = 'V:/moses/moses-time.xml'
-    # map = '/data/dev/moses/moses.map'
-    # maptime = '/data/dev/moses/moses-time.map'
-    # context = '/data/dev/moses/moses.xml'
-    # contexttime = '/data/dev/moses/moses-time.xml'
-
-    start_time = time.time()
+    if self.isAddingLayerToQgisProject and not importQgis():
+      print('QGIS is not available, layers will not be added to the project.')
+      self.isAddingLayerToQgisProject = False
 
-    # Load layers on map
-    # https://gis.stackexchange.com/questions/277040/load-a-postgis-layer-into-a-qgis-map
-    lValue = self.getTable(CONST.LAYERNAME.ivalue)
-    lActivities = self.getTable(CONST.LAYERNAME.activities)
-    lIndicators = self.getTable(CONST.LAYERNAME.indicators)
+    self.publish()
 
-    # Loop on all
-    layerCount = 0
-    layerWithDataCount = 0
-    years = lValue.uniqueValues(lValue.fields().indexOf("year"))
-    if len(years) == 0:
-      print('No years found.')
-      return
+  def __getstate__(self):
+    # Workers only render layers, data source and open outputs stay in the main process
+    state = dict(self.__dict__)
+    for name in ('dataSource', 'contextBuilder', 'contextTimeBuilder', 'mapBuilder', 'mapTimeBuilder',
+                 'layerWriter', 'timeLayerWriter', 'qgisProjectBuilder', 'instrumentation',
+                 'capabilitiesBuilder', 'capabilitiesTimeBuilder', 'tileCacheBuilder'):
+      state.pop(name, None)
+    return state
 
-    contextBuilder = ContextBuilder(context)
-    contextBuilder.writeHeader()
-    contextBuilderByActivity = {}
+  def createBuilders(self):
+    self.contextBuilder = ContextBuilder(self.context, self.wmsBaseUrl)
+    if self.isParameterizedMode:
+      self.mapBuilder = ParameterizedMapfileBuilder(self.map, self.classes, self.projectName, self.projectDescription, self.projectUrl, self.wmsBaseUrl, self.debug,
+                                                    self.dbHost, self.dbPort, self.dbName, self.dbUsername, self.dbPassword, self.dbSchema,
+                                                    self.isUsingLevelTables, self.geometryResolutions, srid=self.layerSrid)
+    else:
+      self.mapBuilder = MapfileBuilder(self.map, self.projectName, self.projectDescription, self.projectUrl, self.wmsBaseUrl, self.debug,
+                                       self.dbHost, self.dbPort, self.dbName, self.dbUsername, self.dbPassword, self.dbSchema,
+                                       self.isUsingLevelTables, self.geometryResolutions, self.layerSrid, self.isUsingBaseLayers,
+                                       self.getFeatureInfoItems(), self.featureInfoMaxFeatures)
+    if not self.isBuildingMapfile:
+      self.mapBuilder.sink = NullSink(self.map)
+      if self.isParameterizedMode:
+        # The classes SQL script goes with the mapfile
+        self.mapBuilder.mapSink = NullSink(self.map)
+    self.skipContexts(self.contextBuilder)
+    self.capabilitiesBuilder = self.createCapabilitiesBuilder(self.map, self.wmsBaseUrl)
+    self.layerWriter = LayerWriter(self.mapBuilder, [self.contextBuilder], self.capabilitiesBuilder)
     if self.wmsTimeLayerMode:
-        contextTimeBuilder = ContextBuilder(contexttime)
-        contextTimeBuilder.writeHeader()
-        contextTimeBuilderByActivity = {}
-    mapBuilder = MapfileBuilder(map, projectName, projectDescription, projectUrl, wmsBaseUrl, debug);
-    mapBuilder.writeHeader()
-    mapTimeBuilder = MapfileBuilder(maptime, projectName, projectDescription, projectUrl, wmsTimeBaseUrl, debug);
-    mapTimeBuilder.writeHeader()
+      self.contextTimeBuilder = ContextBuilder(self.contexttime, self.wmsTimeBaseUrl)
+      self.skipContexts(self.contextTimeBuilder)
+      self.mapTimeBuilder = MapfileBuilder(self.maptime, self.projectName, self.projectDescription, self.projectUrl, self.wmsTimeBaseUrl, self.debug,
+                                           self.dbHost, self.dbPort, self.dbName, self.dbUsername, self.dbPassword, self.dbSchema,
+                                           self.isUsingLevelTables, self.geometryResolutions, self.layerSrid, self.isUsingBaseLayers,
+                                           self.getFeatureInfoItems(), self.featureInfoMaxFeatures)
+      self.capabilitiesTimeBuilder = self.createCapabilitiesBuilder(self.maptime, self.wmsTimeBaseUrl)
+      self.timeLayerWriter = LayerWriter(self.mapTimeBuilder, [self.contextTimeBuilder], self.capabilitiesTimeBuilder)
+
+  def getFeatureInfoItems(self):
+    """
+    Feature info items of the mapfile builders, None reading all attributes.
+
+    :rtype: tuple
+    """
+    return self.featureInfoItems if self.isOptimizingFeatureInfo else None
+
+  def skipContexts(self, *contextBuilders):
+    # Entries are still rendered for the manifest
+    if not self.isBuildingContexts:
+      for contextBuilder in contextBuilders:
+        contextBuilder.sink = NullSink(contextBuilder.file)
+
+  def createCapabilitiesBuilder(self, map, wmsUrl):
+    """
+    Capabilities of a mapfile, None when not building capabilities.
+
+    :rtype: CapabilitiesBuilder
+    """
+    if not self.isBuildingCapabilities:
+      return None
+    return CapabilitiesBuilder(os.path.splitext(map)[0] + '-capabilities.xml', wmsUrl, self.projectName, self.layerSrid)
+
+  def publish(self):
+    self.instrumentation = Instrumentation(self.progressInterval)
+    instrumentation = self.instrumentation
+
+    # Collect statistics of all combinations having data at once
+    with instrumentation.timer('query.statistics'):
+      statistics = self.dataSource.getIndicatorStatistics(self.nutsLevels)
+    if len(statistics) == 0:
+      print('No indicator values found.')
+      return
+    with instrumentation.timer('query.indicatorLabels'):
+      indicatorLabels = self.dataSource.getIndicatorLabels()
+    with instrumentation.timer('query.activities'):
+      activities = self.dataSource.getActivities()
+    # Filtered out layers are copied from the previous run, so that outputs keep all layers
+    isFiltered = self.activityIds is not None or self.indicatorIds is not None or self.selectedNutsLevels is not None
+    # Layer extents are computed from the bounding boxes of the NUTS having data
+    with instrumentation.timer('query.nutsExtents'):
+      self.nutsExtents = self.dataSource.getNutsExtents()
+    # Classes are shared by the mapfile and the QGIS layers
+    with instrumentation.timer('classification'):
+      classes = self.classifyStatistics(statistics)
+
+    manifest = LayerManifest(self.manifest if self.isIncremental else None, self.getManifestSignature())
+
+    if self.vectorExporter is not None:
+      with instrumentation.timer('write.vectors'):
+        self.exportVectors(statistics, classes, activities, indicatorLabels)
+
+    # Workers get the publication before outputs are opened, they only return fragments
+    executor = None
+    if self.numberOfWorkers > 1:
+      executor = concurrent.futures.ProcessPoolExecutor(self.numberOfWorkers,
+                                                        mp_context=multiprocessing.get_context('spawn'),
+                                                        initializer=initActivityWorker,
+                                                        initargs=(self, manifest, indicatorLabels))
+      # Spawned workers are only started by submitted tasks, so all of them are started
+      # now and start up while the headers are written
+      for x in range(self.numberOfWorkers):
+        executor.submit(warmUpActivityWorker)
+
+    self.createBuilders()
+    if self.isAddingLayerToQgisProject:
+      self.qgisProjectBuilder = QgisProjectBuilder()
+      # Combinations of the temporal layer of each level
+      self.qgisTemporalLayers = {}
+    if self.isOptimizingSchema or len(self.geometryResolutions) > 0 or self.layerSrid != 4326 or self.isOptimizingFeatureInfo:
+      with instrumentation.timer('schema'):
+        self.optimizeSchema(statistics)
+
+    self.tileCacheBuilder = None
+    if self.isBuildingTileCache:
+      # Tiles are seeded over each polygon of multipart NUTS
+      with instrumentation.timer('query.nutsPartExtents'):
+        nutsPartExtents = self.dataSource.getNutsPartExtents(set(self.nutsLevels) & set(self.tileCacheZoomLevels))
+      mapName = os.path.splitext(self.map)[0]
+      self.tileCacheBuilder = TileCacheBuilder(mapName + '-mapcache.xml', mapName + '-seed.csv', self.wmsBaseUrl,
+                                               self.tileCacheFolder, self.nutsExtents, self.tileCacheZoomLevels,
+                                               nutsPartExtents)
+      self.tileCacheBuilder.writeHeader()
+
+    # Capabilities of all services, for the server configuration
+    self.capabilitiesServices = []
+    with instrumentation.timer('write.headers'):
+      self.contextBuilder.writeHeader()
+      self.mapBuilder.writeHeader()
+      for capabilitiesBuilder in (self.capabilitiesBuilder, getattr(self, 'capabilitiesTimeBuilder', None)):
+        if capabilitiesBuilder is not None:
+          capabilitiesBuilder.writeHeader()
+          self.capabilitiesServices.append((capabilitiesBuilder.wmsUrl, capabilitiesBuilder.file))
+      if self.isParameterizedMode:
+        self.writeParameterizedLayers(statistics, classes)
+      if self.wmsTimeLayerMode:
+        self.contextTimeBuilder.writeHeader()
+        self.mapTimeBuilder.writeHeader()
+      if self.isUsingBaseLayers:
+        self.writeBaseLayers(self.mapBuilder, self.capabilitiesBuilder)
+        if self.wmsTimeLayerMode:
+          self.writeBaseLayers(self.mapTimeBuilder, self.capabilitiesTimeBuilder)
 
     # removeAllMapLayers ?
 
-    #nutsLevels = {1}
-    nutsLevels = {0, 1, 2, 3}
+    progressTotal = sum(len(levelStatistics)
+                        for activityStatistics in statistics.values()
+                        for indicatorStatistics in activityStatistics.values()
+                        for levelStatistics in indicatorStatistics.values())
+    progressCurrent = 0
+
     # ... activities
-    requestActivities = QgsFeatureRequest()
-    requestActivities.addOrderBy("id")
+    if executor is not None:
+      # Activities are built in parallel and merged in the same order as a serial run
+      fragmentsByActivity = executor.map(buildActivityInWorker,
+                                         [(activity, statistics.get(activity[0], {}), classes.get(activity[0], {}))
+                                          for activity in activities])
+    else:
+      fragmentsByActivity = (self.buildActivity(activity, statistics.get(activity[0], {}), classes.get(activity[0], {}),
+                                                indicatorLabels, manifest)
+                             for activity in activities)
 
-    uniqueActivities = lActivities.uniqueValues(lActivities.fields().indexOf("id"))
-    uniqueIndicators = lIndicators.uniqueValues(lIndicators.fields().indexOf("id"))
-    progressTotal = len(nutsLevels) * len(uniqueIndicators) * len(uniqueActivities) * len(years)
-    progressCurrent = 0
-    numberOfLayers = 0
-
-    # for a in lActivities.uniqueValues(lActivities.fields().indexOf("id")):
-    for activityFeature in lActivities.getFeatures(requestActivities):
-      # TODO: Get label
-      # Add one group per activity
-      # help(QgsProject.instance().layerTreeRoot())
-      # layerTreeRoot
-      activityId = activityFeature.attribute('id')
-      activitySector = activityFeature.attribute('sector').replace('/', '-')
-      activityLabel = activityFeature.attribute('name')
-      #activityFullLabel = f'{activityLabel} (NACE code: {activityId})'
-      activityFullLabel = f'{activityLabel}'
-      activityGroupLayerName = f'{activityFullLabel}'
-      # activityGroupLayerName = f'{activityId}.{activityLabel}'
-
-
-      contextBuilderByActivity[activityId] = ContextBuilder(context.replace('.xml', f'{activityId.replace(",", "")}.xml'))
-      contextBuilderByActivity[activityId].writeHeader();
+    try:
+      for fragments in fragmentsByActivity:
+        self.writeActivity(fragments)
+        manifest.update(fragments.manifestLayers)
+        instrumentation.merge(fragments.instrumentation)
+        instrumentation.count('activities')
+        progressCurrent = progressCurrent + fragments.instrumentation.counters.get('layers', 0)
+        instrumentation.progress(progressCurrent, progressTotal)
+    finally:
+      if executor is not None:
+        executor.shutdown()
+
+    with instrumentation.timer('write.footers'):
+      self.mapBuilder.writeFooter()
+      self.contextBuilder.writeFooter()
       if self.wmsTimeLayerMode:
-          contextTimeBuilderByActivity[activityId] = ContextBuilder(context.replace('.xml', f'{activityId.replace(",", "")}-time.xml'))
-          contextTimeBuilderByActivity[activityId].writeHeader();
-
-      activityGroupLayer = QgsProject.instance().layerTreeRoot().findGroup(activityGroupLayerName)
-      if activityGroupLayer is None:
-        activityGroupLayer = QgsProject.instance().layerTreeRoot().addGroup(activityGroupLayerName)
-
-
-      for indicator in uniqueIndicators:
-        indicatorFullLabel = self.getIndicatorFullLabel(indicator, lIndicators)
-
-        # TODO: Collect min/max value over all years ?
-        for nutsLevel in nutsLevels:
-          # TODO: Use infinity
-          ivMinForAllYears = 9999999
-          ivMaxForAllYears = -9999999
-          listOfYears = []
-          counterForAllYears = 0
-
-          for year in years:
-            progressCurrent = progressCurrent + 1
-            print(f"{progressCurrent:>15}/{progressTotal:<15} - {progressCurrent / progressTotal:.0%}")
-
-            print(f"Processing {activityId} / {indicator} / {nutsLevel} / {year} ")
-            # Check if any data for this combination
-            query = f'"activity_id" = \'{activityId}\' AND "indicator_id" = \'{indicator}\' AND "year" = \'{year}\' AND "nuts_level" = \'{nutsLevel}\''
-            request = QgsFeatureRequest().setFilterExpression(query)
-            request.addOrderBy("value")
-            selection = lValue.getFeatures(request)
-            nbFeatures = sum(1 for _ in selection)
-            selection = lValue.getFeatures(request)
-
-            if nbFeatures > 0:
-              listOfYears.append(year)
-              indicatorGroupLayerName = indicatorFullLabel
-              indicatorGroupLayer = activityGroupLayer.findGroup(indicatorGroupLayerName)
-              if indicatorGroupLayer  is None:
-                  indicatorGroupLayer = activityGroupLayer.addGroup(indicatorGroupLayerName)
-
-              nutsGroupLayerName = f'Nuts{nutsLevel}'
-              nutsGroupLayer = indicatorGroupLayer.findGroup(nutsGroupLayerName)
-              if nutsGroupLayer is None:
-                  nutsGroupLayer = indicatorGroupLayer.addGroup(nutsGroupLayerName)
-
-              # Collect min/max value
-              ivMin = None
-              ivMax = None
-              counter = 0
-              listOfNutsIdsWithData = []
-              for k in selection:
-                v = k.attribute("value")
-                listOfNutsIdsWithData.append(k.attribute("nuts_id"))
-                counter = counter + 1
-                counterForAllYears = counterForAllYears + 1
-                if counter == 1:
-                  ivMin = k.attribute("value")
-                  ivMinForAllYears=min(ivMin, ivMinForAllYears)
-                  # print(k.attribute("year"))
-                ivMax = k.attribute("value")
-                ivMaxForAllYears=max(ivMax, ivMaxForAllYears)
-
-              # print("Found {0}".format(len(list(selection))))
-              # print(selection)
-              # TODO: Handle min=max=0 ?
-              print(
-                f"Indicator with {nbFeatures} values for level {nutsLevel}, indicator {activityId}/{indicator}, year {year} min={ivMin}/max={ivMax}")
-              # TODO: Define how to classify ?
-              # TODO? Could be relevant to build the classification using QGIS
-              classes = self.buildClassification(ivMin, ivMax, counter, self.classificationNbOfClasses)
+        self.mapTimeBuilder.writeFooter()
+        self.contextTimeBuilder.writeFooter()
+    if self.isBuildingCapabilities:
+      with instrumentation.timer('write.capabilities'):
+        self.capabilitiesBuilder.writeFooter()
+        if self.wmsTimeLayerMode:
+          self.capabilitiesTimeBuilder.writeFooter()
+        CapabilitiesBuilder.writeServerConfig(self.capabilitiesConfig, self.capabilitiesAlias, self.capabilitiesServices)
+      print(f"Capabilities server configuration written to {self.capabilitiesConfig}.")
+    if self.tileCacheBuilder is not None:
+      with instrumentation.timer('write.tileCache'):
+        self.tileCacheBuilder.writeFooter()
+      print(f"Tile cache configuration written to {self.tileCacheBuilder.file}, "
+            f"{self.tileCacheBuilder.numberOfTiles} tiles to seed listed in {self.tileCacheBuilder.seedFile}.")
+    with instrumentation.timer('manifest.save'):
+      if isFiltered:
+        manifest.keepPrevious()
+      manifest.save()
+
+    if self.isAddingLayerToQgisProject:
+      if self.qgisLayerMode == 'temporal':
+        with instrumentation.timer('qgis.layers'):
+          self.addTemporalLayers()
+      if self.isUsingBaseLayers:
+        with instrumentation.timer('qgis.layers'):
+          self.addBaseLayers()
+      with instrumentation.timer('qgis.tree'):
+        self.qgisProjectBuilder.build()
+      if self.qgisProjectFile is not None:
+        with instrumentation.timer('qgis.write'):
+          self.qgisProjectBuilder.project.write(self.qgisProjectFile)
+        print(f"QGIS project written to {self.qgisProjectFile}.")
+
+    print( 'Execution time: %.3f' % (time.perf_counter() - instrumentation.start))
+    print(f"Number of layers added to mapfile: {instrumentation.counters.get('layers', 0)}.")
+    print(f"Number of time layers added to mapfile: {instrumentation.counters.get('timeLayers', 0)}.")
+    print(f"Number of unchanged layers reused from previous run: {instrumentation.counters.get('unchangedLayers', 0)}, "
+          f"time layers: {instrumentation.counters.get('unchangedTimeLayers', 0)}.")
+    if isFiltered:
+      print(f"Number of filtered out layers copied from previous run: {instrumentation.counters.get('keptLayers', 0)}, "
+            f"time layers: {instrumentation.counters.get('keptTimeLayers', 0)}.")
+    if self.instrumentationReport is not None:
+      instrumentation.save(self.instrumentationReport)
+      print(f"Instrumentation report written to {self.instrumentationReport}.")
+
+  def exportVectors(self, statistics, classes, activities, indicatorLabels):
+    """
+    Export the geometries of each level and the values of each activity and indicator.
+    """
+    nutsIdsWithData = {}
+    for activityStatistics in statistics.values():
+      for indicatorStatistics in activityStatistics.values():
+        for nutsLevel, levelStatistics in indicatorStatistics.items():
+          nutsIdsWithData.setdefault(nutsLevel, set()).update(nutsId for s in levelStatistics.values() for nutsId in s.nutsIds)
+    for nutsLevel in sorted(nutsIdsWithData):
+      self.vectorExporter.writeGeometries(nutsLevel, self.dataSource.getNutsGeometries(nutsLevel), nutsIdsWithData[nutsLevel])
+
+    activityLabels = {activityId: name for activityId, sector, name in activities}
+    for activityId, activityStatistics in sorted(statistics.items()):
+      for indicator, indicatorStatistics in sorted(activityStatistics.items()):
+        self.vectorExporter.writeValues(activityId, indicator, indicatorStatistics, classes[activityId][indicator],
+                                        activityLabels.get(activityId), indicatorLabels.get(indicator))
+    self.vectorExporter.writeManifest()
+    print(f"Vector data of {len(self.vectorExporter.indicators)} indicators written to {self.vectorFolder}.")
+
+  def isSelected(self, activityId, indicator, nutsLevel):
+    """
+    True if the layers of an activity, indicator and NUTS level are published by the run,
+    those filtered out being copied from the previous run.
+
+    :rtype: bool
+    """
+    return (self.activityIds is None or activityId in self.activityIds) \
+        and (self.indicatorIds is None or indicator in self.indicatorIds) \
+        and (self.selectedNutsLevels is None or nutsLevel in self.selectedNutsLevels)
+
+  def getKeptLayer(self, manifest, layerCode, activityId, indicator, nutsLevel):
+    """
+    Hash and blocks of a filtered out layer in the previous run, None when the layer
+    is published by the run or was not part of the previous run.
+
+    :rtype: dict
+    """
+    if self.isSelected(activityId, indicator, nutsLevel):
+      return None
+    return manifest.getPrevious(layerCode)
+
+  def buildActivity(self, activity, activityStatistics, activityClasses, indicatorLabels, manifest):
+    """
+    Render the mapfile blocks and context entries of all layers of an activity.
+    Nothing is written, so that activities can be built in parallel.
+
+    :rtype: ActivityFragments
+    """
+    activityId, activitySector, activityLabel = activity
+    activitySector = activitySector.replace('/', '-')
+    #activityFullLabel = f'{activityLabel} (NACE code: {activityId})'
+    activityFullLabel = f'{activityLabel}'
+    fragments = ActivityFragments(activityId, activityFullLabel, Instrumentation(self.progressInterval))
+    instrumentation = fragments.instrumentation
+    activityContextBuilder, activityContextTimeBuilder = self.createActivityContextBuilders(activityId)
+
+    # Only visit combinations having data
+    for indicator in sorted(activityStatistics):
+      indicatorFullLabel = indicatorLabels.get(indicator)
+      indicatorStatistics = activityStatistics[indicator]
+
+      for nutsLevel in sorted(indicatorStatistics):
+        levelStatistics = indicatorStatistics[nutsLevel]
+        listOfYears = []
+
+        for year in sorted(levelStatistics):
+          yearStatistics = levelStatistics[year]
+          combinationStart = time.perf_counter()
+
+          listOfYears.append(year)
+
+          nbFeatures = yearStatistics.count
+          ivMin = yearStatistics.min
+          ivMax = yearStatistics.max
+          listOfNutsIdsWithData = yearStatistics.nutsIds
+
+          #  NUTS3.311.V16110.2013
+          layerCode = f"MOSES.{activitySector}.{activityId.replace(',', '')}.{indicator}.NUTS{nutsLevel}.{year}"
+          if self.isVerbose:
+            # TODO: Handle min=max=0 ?
+            print(
+              f"Indicator with {nbFeatures} values for level {nutsLevel}, indicator {activityId}/{indicator}, year {year} min={ivMin}/max={ivMax}")
+            print(f'Layer code is {layerCode}')
+          layerTitle = f"Moses indicator for nuts level {nutsLevel} activity {activityId} indicator {indicator} in {year}"
+
+          layerAbstract=f'{",".join(listOfNutsIdsWithData)} provides information on this indicator.' if len(listOfNutsIdsWithData) > 0 else ''
+          layerExtent = self.getExtent(listOfNutsIdsWithData)
+
+          keptLayer = self.getKeptLayer(manifest, layerCode, activityId, indicator, nutsLevel)
+          if keptLayer is not None:
+            layerHash, blocks = keptLayer['hash'], keptLayer['blocks']
+            instrumentation.count('keptLayers')
+          else:
+            with instrumentation.timer('manifest.hash'):
+              layerHash = manifest.hash(vars(yearStatistics), layerTitle, layerAbstract, layerExtent, activityFullLabel, indicatorFullLabel)
+            blocks = manifest.get(layerCode, layerHash)
+          isLayerChanged = blocks is None
+          classes = activityClasses[indicator][nutsLevel][year]
+          # Legends are also checked for unchanged layers, so that a missing file is written again
+          layerLegend = self.getLegend(classes, instrumentation)
+          layerVectorData = None if self.vectorExporter is None else self.vectorExporter.getVectorData(activityId, indicator)
+          baseLayer = MapfileBuilder.getBaseLayerName(nutsLevel) if self.isUsingBaseLayers else None
+          if isLayerChanged:
+            if self.isVerbose:
               for c in classes:
                 print(f"  * Classe #{c}. {classes[c].label}")
 
-              #  NUTS3.311.V16110.2013
-              layerCode = f"MOSES.{activitySector}.{activityId.replace(',', '')}.{indicator}.NUTS{nutsLevel}.{year}"
-              print(f'Layer code is {layerCode}')
-              layerTitle = f"Moses indicator for nuts level {nutsLevel} activity {activityId} indicator {indicator} in {year}"
+            record = LayerRecord(layerCode, layerTitle, layerAbstract, nutsLevel, activityId, indicator, year, classes,
+                                 activityFullLabel, indicatorFullLabel, extent=layerExtent, legend=layerLegend,
+                                 vectorData=layerVectorData, baseLayer=baseLayer)
+            if self.isParameterizedMode:
+              record.wmsName = f'MOSES.NUTS{nutsLevel}'
+              record.wmsParameters = {'activity': activityId, 'indicator': indicator, 'year': year}
+            with instrumentation.timer('render.layer'):
+              blocks = self.layerWriter.renderLayer(record, [activityContextBuilder])
+          elif keptLayer is None:
+            instrumentation.count('unchangedLayers')
+          fragments.manifestLayers[layerCode] = {'hash': layerHash, 'blocks': blocks}
 
-              layerAbstract=f'{",".join(listOfNutsIdsWithData)} provides information on this indicator.' if len(listOfNutsIdsWithData) > 0 else ''
+          fragments.layerBlocks.append((nutsLevel, blocks))
+          fragments.qgisLayers.append((layerCode, nutsLevel, indicator, year, indicatorFullLabel, classes, layerExtent, isLayerChanged))
+          if self.isBuildingTileCache:
+            fragments.tileLayers.append((layerCode, nutsLevel, listOfNutsIdsWithData, layerExtent, baseLayer))
+          instrumentation.count('layers')
+          instrumentation.addCombination(layerCode, time.perf_counter() - combinationStart)
 
-              if self.isBuildingMapfile:
-                mapBuilder.writeLayer(layerCode, layerTitle, layerAbstract, nutsLevel, activityId, indicator, year, classes, self.dbHost,
-                                      self.dbPort, self.dbName, self.dbUsername, self.dbPassword, self.dbSchema, activityFullLabel, indicatorFullLabel)
-                contextBuilder.writeLayer(layerCode, wmsBaseUrl, activityFullLabel, indicatorFullLabel, year)
-                contextBuilderByActivity[activityId].writeLayer(layerCode, wmsBaseUrl, activityFullLabel, indicatorFullLabel, year)
 
+        # Create a time layer
+        if self.wmsTimeLayerMode:
+            layerCode = f"MOSES.{activitySector}.{activityId.replace(',', '')}.{indicator}.NUTS{nutsLevel}"
+            if self.isVerbose:
+              print(f'Time layer code is {layerCode}')
+            layerTitle = f"Moses indicator for nuts level {nutsLevel} activity {activityId} indicator {indicator}"
 
-              if self.isAddingLayerToQgisProject:
-                # TODO: Add layer with proper SQL filter to current project
-                self.addFilteredLayer(layerCode, nutsLevel, activityId, indicator, year, nutsGroupLayer, self.classificationNbOfClasses, ivMin, ivMax)
-              numberOfLayers = numberOfLayers + 1
+            layerExtent = self.getExtent({nutsId for s in levelStatistics.values() for nutsId in s.nutsIds})
+            keptLayer = self.getKeptLayer(manifest, layerCode, activityId, indicator, nutsLevel)
+            if keptLayer is not None:
+              layerHash, blocks = keptLayer['hash'], keptLayer['blocks']
+              instrumentation.count('keptTimeLayers')
+            else:
+              with instrumentation.timer('manifest.hash'):
+                layerHash = manifest.hash([vars(s) for s in levelStatistics.values()], listOfYears, layerTitle, layerAbstract,
+                                          layerExtent, activityFullLabel, indicatorFullLabel)
+              blocks = manifest.get(layerCode, layerHash)
+            classes = activityClasses[indicator][nutsLevel][None]
+            layerLegend = self.getLegend(classes, instrumentation)
+            if blocks is None:
+              record = LayerRecord(layerCode, layerTitle, layerAbstract, nutsLevel, activityId, indicator, year, classes,
+                                   activityFullLabel, indicatorFullLabel, True, 'moses_indicator_values_date', listOfYears,
+                                   layerExtent, layerLegend,
+                                   None if self.vectorExporter is None else self.vectorExporter.getVectorData(activityId, indicator),
+                                   MapfileBuilder.getBaseLayerName(nutsLevel) if self.isUsingBaseLayers else None)
+              with instrumentation.timer('render.timeLayer'):
+                blocks = self.timeLayerWriter.renderLayer(record, [activityContextTimeBuilder])
+            elif keptLayer is None:
+              instrumentation.count('unchangedTimeLayers')
+            instrumentation.count('timeLayers')
+            fragments.manifestLayers[layerCode] = {'hash': layerHash, 'blocks': blocks}
+            fragments.timeLayerBlocks.append((nutsLevel, blocks))
 
+    return fragments
 
-          # Create a time layer
-          if self.wmsTimeLayerMode and ivMinForAllYears != -ivMaxForAllYears:
-              layerCode = f"MOSES.{activitySector}.{activityId.replace(',', '')}.{indicator}.NUTS{nutsLevel}"
-              print(f'Time layer code is {layerCode}')
-              layerTitle = f"Moses indicator for nuts level {nutsLevel} activity {activityId} indicator {indicator}"
-              classes = self.buildClassification(ivMinForAllYears, ivMaxForAllYears, counterForAllYears, self.classificationNbOfClasses)
+  def writeActivity(self, fragments):
+    """
+    Write the layers of an activity in the mapfiles, the global contexts
+    and the activity contexts and add them to the QGIS project.
+    """
+    activityId = fragments.activityId
+    contextBuilder, contextTimeBuilder = self.createActivityContextBuilders(activityId)
 
-              mapTimeBuilder.writeLayer(layerCode, layerTitle, layerAbstract, nutsLevel, activityId, indicator, year, classes, self.dbHost,
-                                      self.dbPort, self.dbName, self.dbUsername, self.dbPassword, self.dbSchema, activityFullLabel, indicatorFullLabel, True, 'moses_indicator_values_date', listOfYears)
+    with self.instrumentation.timer('write.layers'):
+      self.writeActivityFiles(fragments, contextBuilder, contextTimeBuilder)
 
-              contextTimeBuilder.writeLayer(layerCode, wmsTimeBaseUrl, activityFullLabel, indicatorFullLabel, '')
-              contextTimeBuilderByActivity[activityId].writeLayer(layerCode, wmsTimeBaseUrl, activityFullLabel, indicatorFullLabel, '')
+    if self.tileCacheBuilder is not None:
+      with self.instrumentation.timer('write.tileCache'):
+        for layerCode, nutsLevel, nutsIds, layerExtent, baseLayer in fragments.tileLayers:
+          self.tileCacheBuilder.addLayer(layerCode, nutsLevel, nutsIds, layerExtent, baseLayer)
 
+    if self.isAddingLayerToQgisProject and self.qgisLayerMode == 'temporal':
+      # Layers are created once all activities are known
+      for layerCode, nutsLevel, indicator, year, indicatorFullLabel, classes, layerExtent, isLayerChanged in fragments.qgisLayers:
+        self.qgisTemporalLayers.setdefault(nutsLevel, []) \
+          .append((activityId, indicator, year, indicatorFullLabel, classes, layerExtent))
+    elif self.isAddingLayerToQgisProject:
+      with self.instrumentation.timer('qgis.layers'):
+        for layerCode, nutsLevel, indicator, year, indicatorFullLabel, classes, layerExtent, isLayerChanged in fragments.qgisLayers:
+          if not isLayerChanged and self.qgisProjectBuilder.hasLayer(layerCode):
+            continue
 
-      #break
-        #break
-      #break
-      contextBuilderByActivity[activityId].writeFooter();
-      if self.wmsTimeLayerMode:
-        contextTimeBuilderByActivity[activityId].writeFooter();
-      # print (f'Processing activity \'{a}\' > indicator \'{i}\' > year \'{y}\' ...')
+          # One group per activity, indicator and level
+          # activityGroupLayerName = f'{activityId}.{activityLabel}'
+          groupPath = (f'{fragments.activityFullLabel}', indicatorFullLabel, f'Nuts{nutsLevel}')
+          for vlayer in self.createFilteredLayers(layerCode, nutsLevel, activityId, indicator, year, classes, layerExtent):
+            self.qgisProjectBuilder.addLayer(groupPath, vlayer)
+            self.instrumentation.count('qgisLayers')
+
+  def addTemporalLayers(self):
+    """
+    Add the temporal layer of each level to the QGIS project, set the project
+    time range to the years and the project variables to the first combination
+    when not set.
+    """
+    from qgis.PyQt.QtCore import QDate, QDateTime, QTime
+
+    project = self.qgisProjectBuilder.project
+    years = []
+    for nutsLevel, layers in sorted(self.qgisTemporalLayers.items()):
+      extents = numpy.array([extent for a, i, y, label, classes, extent in layers if extent is not None])
+      extent = tuple(extents[:, :2].min(axis=0).tolist() + extents[:, 2:].max(axis=0).tolist()) if len(extents) > 0 else None
+      for vlayer in self.createTemporalLayers(nutsLevel, [layer[:5] for layer in layers], extent):
+        self.qgisProjectBuilder.addLayer(('MOSES',), vlayer)
+        self.instrumentation.count('qgisLayers')
+      years.extend(int(y) for a, i, y, label, classes, extent in layers)
+    if len(years) == 0:
+      return
+
+    project.timeSettings().setTemporalRange(QgsDateTimeRange(QDateTime(QDate(min(years), 1, 1), QTime(0, 0, 0)),
+                                                             QDateTime(QDate(max(years), 12, 31), QTime(23, 59, 59))))
+    scope = QgsExpressionContextUtils.projectScope(project)
+    a, i = next((a, i) for layers in self.qgisTemporalLayers.values() for a, i, y, label, classes, extent in layers)
+    if not scope.hasVariable('moses_activity'):
+      QgsExpressionContextUtils.setProjectVariable(project, 'moses_activity', a)
+    if not scope.hasVariable('moses_indicator'):
+      QgsExpressionContextUtils.setProjectVariable(project, 'moses_indicator', i)
+
+  def addBaseLayers(self):
+    """
+    Add the "No data" base layer of each level to the QGIS project, in a group
+    after the indicator layers, so that it is drawn below them.
+    """
+    for nutsLevel in sorted(self.nutsLevels):
+      for vlayer in self.createBaseLayers(nutsLevel):
+        self.qgisProjectBuilder.addLayer((MapfileBuilder.BASE_LAYER_GROUP,), vlayer)
+        self.instrumentation.count('qgisLayers')
+
+  def writeBaseLayers(self, mapBuilder, capabilitiesBuilder=None):
+    """
+    Write the "No data" base layer of each level first in a mapfile and its capabilities.
+    """
+    for nutsLevel in sorted(self.nutsLevels):
+      mapBuilder.writeBaseLayer(nutsLevel)
+      if capabilitiesBuilder is not None:
+        capabilitiesBuilder.addLayer(capabilitiesBuilder.renderBaseLayer(mapBuilder.getBaseLayerName(nutsLevel),
+                                                                         f'NUTS level {nutsLevel}'))
+
+  def writeActivityFiles(self, fragments, contextBuilder, contextTimeBuilder):
+    """
+    Write the layers of an activity in the mapfiles and the contexts.
+    """
+    activityId = fragments.activityId
+    activityMapBuilder = None
+    if self.isBuildingActivityMapfiles and self.isBuildingMapfile:
+      activityMapBuilder = MapfileBuilder(self.getActivityFile(self.map, activityId), self.projectName, self.projectDescription, self.projectUrl,
+                                          contextBuilder.wmsUrl, self.debug,
+                                          self.dbHost, self.dbPort, self.dbName, self.dbUsername, self.dbPassword, self.dbSchema,
+                                          self.isUsingLevelTables, self.geometryResolutions, self.layerSrid, self.isUsingBaseLayers,
+                                          self.getFeatureInfoItems(), self.featureInfoMaxFeatures)
+      activityMapBuilder.writeHeader()
+    activityCapabilitiesBuilder = None
+    if activityMapBuilder is not None and self.isBuildingCapabilities:
+      activityCapabilitiesBuilder = self.createCapabilitiesBuilder(activityMapBuilder.file, contextBuilder.wmsUrl)
+      activityCapabilitiesBuilder.writeHeader()
+      self.capabilitiesServices.append((activityCapabilitiesBuilder.wmsUrl, activityCapabilitiesBuilder.file))
+    if activityMapBuilder is not None and self.isUsingBaseLayers:
+      self.writeBaseLayers(activityMapBuilder, activityCapabilitiesBuilder)
 
-    mapBuilder.writeFooter()
+    contextBuilder.writeHeader()
+    self.writeActivityLayers(self.layerWriter, fragments.layerBlocks, activityId, contextBuilder, activityMapBuilder,
+                             activityCapabilitiesBuilder)
     contextBuilder.writeFooter()
+    if activityMapBuilder is not None:
+      activityMapBuilder.writeFooter()
+    if activityCapabilitiesBuilder is not None:
+      activityCapabilitiesBuilder.writeFooter()
+
     if self.wmsTimeLayerMode:
-      mapTimeBuilder.writeFooter()
+      contextTimeBuilder.writeHeader()
+      self.writeActivityLayers(self.timeLayerWriter, fragments.timeLayerBlocks, activityId, contextTimeBuilder)
       contextTimeBuilder.writeFooter()
 
-    elapsed_time = time.time() - start_time
-    print( 'Execution time: %.3f' % (elapsed_time))
-    print(f"Number of layers added to mapfile: {numberOfLayers}.")
-
-  def getIndicatorFullLabel(self, indicator, lIndicators):
-    query = f'"id" = \'{indicator}\''
-    request = QgsFeatureRequest().setFilterExpression(query)
-    feature = lIndicators.getFeatures(request)
-    for f in feature:
-        name = f.attribute('name')
-        if f.attribute('unit') == '-':
-            return f.attribute('name')
-        else:
-            return '{name} ({unit})'.format(name=f.attribute('name'), unit=f.attribute('unit'))
+  def optimizeSchema(self, statistics):
+    """
+    Write the schema script derived from the layer queries
+    and check the query plans of a sample of layers.
+    """
+    optimizer = SchemaOptimizer(self.schemaSql, self.dbSchema, self.nutsLevels, self.isUsingLevelTables, self.geometryResolutions,
+                                self.layerSrid, self.mapBuilder.featureInfoItems)
+    optimizer.addQueryShapes(self.mapBuilder.getQueryShapes('moses_indicator_values'))
+    if self.wmsTimeLayerMode:
+      optimizer.addQueryShapes(self.mapTimeBuilder.getQueryShapes('moses_indicator_values_date', True))
+    optimizer.write()
+    print(f'Schema script written to {self.schemaSql}.')
+
+    if self.isVerifyingQueryPlans:
+      connection = getattr(self.dataSource, 'connection', None)
+      if connection is None:
+        connection = DbApiDataSource.connect(self.dbHost, self.dbPort, self.dbName, self.dbUsername, self.dbPassword, self.dbSchema).connection
+      optimizer.verifyQueryPlans(connection, self.getSampleQueries(statistics))
+
+  def getSampleQueries(self, statistics):
+    """
+    Layer queries of combinations evenly picked in the sorted statistics,
+    so that the same sample is checked on each run.
+
+    :rtype: list
+    """
+    combinations = sorted((nutsLevel, activityId, indicator, year)
+                          for activityId, activityStatistics in statistics.items()
+                          for indicator, indicatorStatistics in activityStatistics.items()
+                          for nutsLevel, levelStatistics in indicatorStatistics.items()
+                          for year in levelStatistics)
+    step = max(1, len(combinations) // self.queryPlanSampleSize)
+    queries = []
+    for nutsLevel, activityId, indicator, year in combinations[::step][:self.queryPlanSampleSize]:
+      # Query of each scale band
+      for r in range(max(1, len(self.geometryResolutions))):
+        nutsTable = self.mapBuilder.getNutsTable(nutsLevel, r)
+        queries.append(self.mapBuilder.renderQuery(nutsLevel, activityId, indicator, year, 'moses_indicator_values', False, nutsTable))
+        if self.wmsTimeLayerMode:
+          queries.append(self.mapTimeBuilder.renderQuery(nutsLevel, activityId, indicator, year, 'moses_indicator_values_date', True, nutsTable))
+    return queries
+
+  def writeParameterizedLayers(self, statistics, classes):
+    """
+    Write one parameterized layer per NUTS level having data, the first combination
+    of the level being the default one. Layers have as many classes as the combination
+    of the level having the most, named after the classes of the default combination.
+    """
+    for nutsLevel in sorted(self.nutsLevels):
+      defaults = sorted((activityId, indicator, year)
+                        for activityId, activityStatistics in statistics.items()
+                        for indicator, indicatorStatistics in activityStatistics.items()
+                        for year in indicatorStatistics.get(nutsLevel, {}))
+      if len(defaults) == 0:
+        continue
+      activityId, indicator, year = defaults[0]
+      defaultClasses = classes[activityId][indicator][nutsLevel][year]
+      nbOfClasses = max(len(classes[a][i][nutsLevel][y]) for a, i, y in defaults)
+      classLabels = [defaultClasses[x].label if x in defaultClasses else f'Class {x + 1}' for x in range(nbOfClasses)]
+      self.mapBuilder.writeParameterizedLayer(nutsLevel, activityId, indicator, year, classLabels)
+
+  def getActivityFile(self, file, activityId, suffix=''):
+    """
+    File of an activity next to the global one (eg. moses.xml > moses031-time.xml).
+
+    :rtype: str
+    """
+    extension = os.path.splitext(file)[1]
+    return file.replace(extension, f'{activityId.replace(",", "")}{suffix}{extension}')
+
+  def createActivityContextBuilders(self, activityId):
+    """
+    Contexts of an activity, using the activity mapfile service if any.
+
+    :rtype: tuple
+    """
+    wmsUrl = self.wmsBaseUrl
+    if self.isBuildingActivityMapfiles:
+      wmsUrl = self.wmsActivityBaseUrl.format(activity=activityId.replace(',', ''))
+    contextBuilder = ContextBuilder(self.getActivityFile(self.context, activityId), wmsUrl)
+    contextTimeBuilder = None
+    if self.wmsTimeLayerMode:
+      contextTimeBuilder = ContextBuilder(self.getActivityFile(self.context, activityId, '-time'), self.wmsTimeBaseUrl)
+      self.skipContexts(contextTimeBuilder)
+    self.skipContexts(contextBuilder)
+    return contextBuilder, contextTimeBuilder
+
+  def writeActivityLayers(self, layerWriter, layerBlocks, activityId, contextBuilder, activityMapBuilder=None,
+                          activityCapabilitiesBuilder=None):
+    """
+    Write layer blocks of an activity to the main mapfile or to the mapfiles it includes,
+    to the activity mapfile, to the contexts and to the capabilities.
+    """
+    includedSinks = {}
+    for nutsLevel, blocks in layerBlocks:
+      mapSinks = []
+      # Nothing is included by a mapfile which is not written
+      if self.mapfileIncludeMode is None or isinstance(layerWriter.mapBuilder.sink, NullSink):
+        mapSinks.append(layerWriter.mapBuilder.sink)
+      else:
+        suffix = '-layers' if self.mapfileIncludeMode == 'activity' else f'-nuts{nutsLevel}-layers'
+        if suffix not in includedSinks:
+          includedSinks[suffix] = OutputSink(self.getActivityFile(layerWriter.mapBuilder.file, activityId, suffix))
+          includedSinks[suffix].open()
+          # Included file is relative to the main mapfile
+          layerWriter.mapBuilder.writeInclude(os.path.basename(includedSinks[suffix].file))
+        mapSinks.append(includedSinks[suffix])
+      if activityMapBuilder is not None:
+        mapSinks.append(activityMapBuilder.sink)
+      layerWriter.writeBlocks(blocks, [contextBuilder], mapSinks,
+                              [] if activityCapabilitiesBuilder is None else [activityCapabilitiesBuilder])
+
+    for sink in includedSinks.values():
+      sink.close()
+
+  def getManifestSignature(self):
+    """
+    Hash of the templates and settings shared by all layers.
+    When it changes, all layers are rebuilt.
+
+    :rtype: str
+    """
+    return LayerManifest.hash(MapfileBuilder.LAYER, MapfileBuilder.QUERY, MapfileBuilder.FEATURE_QUERY, MapfileBuilder.FEATUREINFO, MapfileBuilder.SCALETOKEN, MapfileBuilder.CATEGORY, MapfileBuilder.TIME, ContextBuilder.LAYER, ContextBuilder.BOUNDINGBOX,
+                              CapabilitiesBuilder.LAYER, CapabilitiesBuilder.BOUNDINGBOX, CapabilitiesBuilder.DIMENSION, self.isBuildingCapabilities,
+                              MapfileBuilder.LEGEND, ContextBuilder.STYLELIST, self.isBuildingLegends, self.legendBaseUrl,
+                              ContextBuilder.VECTORDATA, self.isExportingVectors, self.vectorBaseUrl, self.isUsingBaseLayers,
+                              self.isOptimizingFeatureInfo, self.featureInfoItems, self.featureInfoMaxFeatures,
+                              self.projectName, self.wmsBaseUrl, self.wmsTimeBaseUrl,
+                              self.isBuildingActivityMapfiles, self.wmsActivityBaseUrl, self.isParameterizedMode, self.isUsingLevelTables, self.geometryResolutions, self.layerSrid,
+                              self.dbHost, self.dbPort, self.dbName, self.dbUsername, self.dbPassword, self.dbSchema,
+                              self.classificationMethod, self.classificationNbOfClasses, self.classificationLabelPrecision, self.colorScheme)
+
+
+class ActivityFragments:
+  """
+  Rendered layers of one activity, built in the main process
+  or in a worker and then written in activity order.
+  """
+
+  def __init__(self, activityId, activityFullLabel, instrumentation):
+    self.activityId = activityId
+    self.activityFullLabel = activityFullLabel
+    self.layerBlocks = []
+    self.timeLayerBlocks = []
+    self.qgisLayers = []
+    # Layers of the tile cache with their NUTS having data
+    self.tileLayers = []
+    self.manifestLayers = {}
+    # Timers and counters of the activity, merged in the publication ones
+    self.instrumentation = instrumentation
+
+
+# Publication and previous run manifest of a worker process
+workerState = None
+
+
+def initActivityWorker(publication, manifest, indicatorLabels):
+  global workerState
+  publication.createBuilders()
+  workerState = (publication, manifest, indicatorLabels)
+
+
+def warmUpActivityWorker():
+  return os.getpid()
+
+
+def buildActivityInWorker(job):
+  publication, manifest, indicatorLabels = workerState
+  activity, activityStatistics, activityClasses = job
+  return publication.buildActivity(activity, activityStatistics, activityClasses, indicatorLabels, manifest)
+
+
+def createDataSource(config, options):
+  """
+  Data source of a configuration: {"type": "postgresql"} (psycopg2, default), {"type": "qgis"},
+  {"type": "csv", "folder": ...}, {"type": "sqlite", "file": ...}. Database settings are
+  read from the publication options.
+
+  :rtype: DataSource
+  """
+  database = [options.get(name, getattr(MosesPublication, name))
+              for name in ('dbHost', 'dbPort', 'dbName', 'dbUsername', 'dbPassword', 'dbSchema')]
+  sourceType = config.get('type', 'postgresql')
+  if sourceType == 'postgresql':
+    return DbApiDataSource.connect(*database)
+  if sourceType == 'qgis':
+    if not importQgis():
+      raise ValueError('QGIS is not available.')
+    return QgisDataSource(*database)
+  if sourceType == 'csv':
+    return FileDataSource(config['folder'], config.get('encoding', 'latin-1'))
+  if sourceType == 'sqlite':
+    return SqliteDataSource(config['file'])
+  raise ValueError(f"Unknown data source type '{sourceType}'")
+
+
+# Stages which can be selected on the command line and their option
+STAGES = {'mapfile': 'isBuildingMapfile',
+          'time': 'wmsTimeLayerMode',
+          'contexts': 'isBuildingContexts',
+          'qgis': 'isAddingLayerToQgisProject',
+          'tiles': 'isBuildingTileCache'}
+
+
+def main(arguments=None):
+  parser = argparse.ArgumentParser(description='Publish MOSES indicators as mapfiles, OWS contexts and a QGIS project.')
+  parser.add_argument('--config', help='JSON file of publication options (eg. {"map": "/data/moses.map", "nutsLevels": [0, 1]}), '
+                                       'with an optional "dataSource" entry')
+  parser.add_argument('--stages', help=f'Comma separated stages to run among {", ".join(STAGES)}, all configured ones by default')
+  parser.add_argument('--activity', action='append', dest='activityIds', help='Only refresh the layers of this activity (eg. 03,1), repeatable')
+  parser.add_argument('--indicator', action='append', dest='indicatorIds', help='Only refresh the layers of this indicator, repeatable')
+  parser.add_argument('--level', action='append', type=int, dest='selectedNutsLevels', help='Only refresh the layers of this NUTS level, repeatable')
+  parser.add_argument('--workers', type=int, dest='numberOfWorkers')
+  args = parser.parse_args(arguments)
+
+  options = {}
+  if args.config is not None:
+    with open(args.config) as configFile:
+      options = json.load(configFile)
+  sourceConfig = options.pop('dataSource', None)
+  if 'nutsLevels' in options:
+    options['nutsLevels'] = set(options['nutsLevels'])
+  if 'tileCacheZoomLevels' in options:
+    options['tileCacheZoomLevels'] = {int(level): tuple(zooms) for level, zooms in options['tileCacheZoomLevels'].items()}
+
+  if args.stages is not None:
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip() != '']
+    unknownStages = set(stages) - set(STAGES)
+    if len(unknownStages) > 0:
+      parser.error(f'Unknown stages {", ".join(sorted(unknownStages))}')
+    for stage, option in STAGES.items():
+      options[option] = stage in stages
+
+  for name in ('activityIds', 'indicatorIds', 'numberOfWorkers'):
+    if getattr(args, name) is not None:
+      options[name] = getattr(args, name)
+  if args.selectedNutsLevels is not None:
+    options['selectedNutsLevels'] = set(args.selectedNutsLevels)
+
+  # QGIS is only loaded for the project stage
+  if options.get('isAddingLayerToQgisProject', MosesPublication.isAddingLayerToQgisProject) and importQgis() \
+      and QgsApplication.instance() is None:
+    qgisApplication = QgsApplication([], False)
+    qgisApplication.initQgis()
+
+  dataSource = createDataSource(sourceConfig, options) if sourceConfig is not None else None
+  MosesPublication(dataSource, **options)
 
 
-MosesPublication()
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,90 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from moses_mapfile import FileDataSource, MosesPublication, SqliteDataSource
+
+# CSV extracts of 2 activities and indicators for NUTS of all levels, with bounding boxes
+DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'moses')
+
+
+def writeSqlite(source, file):
+  """
+  Write the tables read by SqliteDataSource from a CSV data source.
+  """
+  connection = sqlite3.connect(file)
+  connection.execute('CREATE TABLE moses_activities (id TEXT PRIMARY KEY, sector TEXT, name TEXT)')
+  connection.execute('CREATE TABLE moses_indicators (id TEXT PRIMARY KEY, name TEXT, unit TEXT)')
+  connection.execute('''CREATE TABLE nuts (nuts_id TEXT PRIMARY KEY, levl_code INTEGER,
+                          xmin REAL, ymin REAL, xmax REAL, ymax REAL)''')
+  connection.execute('''CREATE TABLE moses_indicator_values (nuts_id TEXT, nuts_level TEXT, activity_id TEXT,
+                          indicator_id TEXT, unit TEXT, year TEXT, value REAL, status TEXT, data_source TEXT,
+                          website TEXT, remarks TEXT)''')
+  connection.executemany('INSERT INTO moses_activities VALUES (?, ?, ?)', source.getActivities())
+  connection.executemany('INSERT INTO moses_indicators VALUES (?, ?, ?)',
+                         [(row['ind_id'], row['ind_name'], row['ind_unit']) for row in source.readCsv(source.indicatorsFile)])
+  connection.executemany('INSERT INTO nuts VALUES (?, ?, ?, ?, ?, ?)',
+                         [(row['nuts_id'], int(row['levl_code']), row['xmin'], row['ymin'], row['xmax'], row['ymax'])
+                          for row in source.readCsv(source.nutsFile)])
+  connection.executemany('INSERT INTO moses_indicator_values VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         [(nutsId, str(nutsLevel), activityId, indicator, '', year, value, status, '', '', '')
+                          for activityId, indicator, nutsLevel, year, nutsId, value, status in source.getIndicatorValues()])
+  connection.commit()
+  connection.close()
+
+
+def getOutputOptions(folder):
+  """
+  Options writing the mapfiles and contexts of a publication in a folder, without QGIS.
+
+  :rtype: dict
+  """
+  return {'map': os.path.join(folder, 'moses.map'),
+          'maptime': os.path.join(folder, 'moses-time.map'),
+          'context': os.path.join(folder, 'moses.xml'),
+          'contexttime': os.path.join(folder, 'moses-time.xml'),
+          'isAddingLayerToQgisProject': False}
+
+
+def readOutputs(folder):
+  """
+  Content of the files written in a folder by relative path.
+
+  :rtype: dict
+  """
+  outputs = {}
+  for root, folders, files in os.walk(folder):
+    for file in files:
+      path = os.path.join(root, file)
+      with open(path, 'rb') as outputFile:
+        outputs[os.path.relpath(path, folder)] = outputFile.read()
+  return outputs
+
+
+@pytest.fixture
+def csvSource():
+  return FileDataSource(DATA_FOLDER)
+
+
+@pytest.fixture
+def sqliteSource(tmp_path, csvSource):
+  file = str(tmp_path / 'moses.sqlite')
+  writeSqlite(csvSource, file)
+  return SqliteDataSource(file)
+
+
+@pytest.fixture
+def publish(tmp_path):
+  """
+  Publish a data source (the CSV fixture by default) in a folder of the test,
+  returning the publication.
+  """
+  def publish(name, dataSource=None, **options):
+    folder = str(tmp_path / name)
+    os.makedirs(folder, exist_ok=True)
+    return MosesPublication(dataSource or FileDataSource(DATA_FOLDER), **{**getOutputOptions(folder), **options})
+  return publish
@@ -0,0 +1,237 @@
+import os
+import re
+import shutil
+
+import pytest
+
+from conftest import DATA_FOLDER
+from moses_mapfile import BulkLoader, CopyStream, FileDataSource, SchemaOptimizer
+
+# PostgreSQL database in which the tests create and drop their schema (eg. 'dbname=moses_test user=postgres')
+DSN = os.environ.get('MOSES_TEST_DSN')
+SCHEMA = 'moses_bulkloader_test'
+
+# MOSES tables of the DB script, geometries being text so that PostGIS is not required
+TABLES = """
+CREATE TABLE {dbSchema}.nuts (nuts_id text PRIMARY KEY, levl_code integer, nuts_name text, cntr_code text,
+                              wkb_geometry text);
+CREATE TABLE {dbSchema}.moses_status (id text PRIMARY KEY, name text);
+CREATE TABLE {dbSchema}.moses_activities (id text PRIMARY KEY, sector text, section text, div text, name text);
+CREATE TABLE {dbSchema}.moses_indicators (id text PRIMARY KEY, name text, unit text);
+CREATE TABLE {dbSchema}.moses_indicator_values (nuts_id text, nuts_level text, activity_id text, indicator_id text,
+                                                unit text, year text, value numeric, status text, data_source text,
+                                                website text, remarks text);
+CREATE TABLE {dbSchema}.moses_indicator_values_date (nuts_id text, nuts_level text, activity_id text,
+                                                     indicator_id text, unit text, year date, value numeric,
+                                                     status text, data_source text, website text, remarks text);
+CREATE TABLE {dbSchema}.moses_indicator_values_with_nuts_m AS
+  SELECT i.*, nuts_name, cntr_code, levl_code, wkb_geometry
+    FROM {dbSchema}.nuts n, {dbSchema}.moses_indicator_values i
+   WHERE n.nuts_id = i.nuts_id;
+"""
+
+QUERY_TABLE = SchemaOptimizer.getQueryTable('moses_indicator_values', 2)
+
+
+class FakeCursor:
+  """
+  Cursor recording the statements and the COPY payloads, answering the
+  queries of the loader with the NUTS, existing tables and their columns.
+  """
+
+  def __init__(self, connection):
+    self.connection = connection
+    self.result = []
+    self.rowcount = -1
+
+  def execute(self, sql):
+    sql = ' '.join(sql.split())
+    self.connection.statements.append(sql)
+    if sql.startswith('SELECT nuts_id, levl_code'):
+      self.result = self.connection.nuts
+    elif sql.startswith('SELECT to_regclass'):
+      table = re.search(r"'\w+\.(\w+)'", sql).group(1)
+      self.result = [(table in self.connection.tables,)]
+    elif sql.startswith('SELECT column_name'):
+      table = re.search(r"table_name = '(\w+)'", sql).group(1)
+      self.result = [(column,) for column in self.connection.tables[table]]
+
+  def fetchall(self):
+    return self.result
+
+  def fetchone(self):
+    return self.result[0]
+
+  def copy_expert(self, sql, file):
+    self.connection.statements.append(sql)
+    # Read in small chunks as psycopg2 does with its buffer size
+    chunks = []
+    chunk = file.read(64)
+    while chunk:
+      chunks.append(chunk)
+      chunk = file.read(64)
+    payload = ''.join(chunks)
+    self.connection.payloads[re.match(r'COPY \w+\.(\w+)', sql).group(1)] = payload
+    self.rowcount = payload.count('\n')
+
+  def close(self):
+    pass
+
+
+class FakeConnection:
+
+  def __init__(self, nuts, tables):
+    self.nuts = nuts
+    self.tables = tables
+    self.statements = []
+    self.payloads = {}
+    self.committed = False
+    self.rolledBack = False
+
+  def cursor(self):
+    return FakeCursor(self)
+
+  def commit(self):
+    self.committed = True
+
+  def rollback(self):
+    self.rolledBack = True
+
+
+@pytest.fixture
+def fakeConnection(csvSource):
+  # FR522 is not in the NUTS table, the level 2 tables of the values were created by the schema script
+  nuts = [(row['nuts_id'], int(row['levl_code'])) for row in csvSource.readCsv(csvSource.nutsFile) if row['nuts_id'] != 'FR522']
+  tables = {'moses_indicator_values_level2': ['nuts_id', 'year', 'value'],
+            'moses_indicator_values_query_level2': ['nuts_id', 'year', 'value', 'wkb_geometry_3857']}
+  return FakeConnection(nuts, tables)
+
+
+def testCopyStream():
+  stream = CopyStream([('FR51', None, 'a\tb'), ('back\\slash', 'line\nbreak', 402.0)])
+  assert stream.read(5) == 'FR51\t'
+  assert stream.read() == '\\N\ta\\tb\nback\\\\slash\tline\\nbreak\t402.0\n'
+  assert stream.read(10) == ''
+
+
+def testLoadCopiesUnpivotedValues(fakeConnection, capsys):
+  counts = BulkLoader(fakeConnection, 'moses', FileDataSource(DATA_FOLDER)).load()
+  payloads = fakeConnection.payloads
+  assert payloads['moses_status'] == '-\t\ne\testimated\np\tprovisional\n'
+  assert payloads['moses_activities'] == '03,1\tFisheries/Aquaculture\tA\t03\tFishing\n' \
+                                         '50,1\tTransport\tH\t50\tSea and coastal passenger water transport\n'
+  assert payloads['moses_indicators'] == 'V11110\tNumber of enterprises\t-\nV12120\tTurnover\tEUR\n'
+
+  rows = [line.split('\t') for line in payloads['moses_indicator_values'].splitlines()]
+  assert all(len(row) == len(BulkLoader.VALUE_COLUMNS) for row in rows)
+  # One row per year having a value with the status name, as the SQL script does,
+  # values without status getting the empty name of the '-' status
+  assert [row[:8] for row in rows if row[0] == 'FR'] == [
+    ['FR', '0', '03,1', 'V11110', '-', '2013', '3541', ''],
+    ['FR', '0', '03,1', 'V11110', '-', '2014', '3610', ''],
+    ['FR', '0', '03,1', 'V11110', '-', '2015', '3702', 'provisional'],
+    ['FR', '0', '50,1', 'V12120', 'EUR', '2013', '2875000000', ''],
+    ['FR', '0', '50,1', 'V12120', 'EUR', '2014', '2930000000', ''],
+    ['FR', '0', '50,1', 'V12120', 'EUR', '2015', '3011000000', 'estimated']]
+  assert ['BE', '0', '03,1', 'V11110', '-', '2014', '130', 'estimated'] in [row[:8] for row in rows]
+  assert rows[0][8:] == ['Eurostat', 'http://ec.europa.eu/eurostat', '']
+  # Decimal commas are read, BE1 has no 2013 value
+  assert ['FR1', '1', '03,1', 'V11110', '-', '2014', '27.5', ''] in [row[:8] for row in rows]
+  assert [row[5] for row in rows if row[0] == 'BE1' and row[2] == '50,1'] == ['2014']
+  # The 3 values of the unknown NUTS are skipped
+  assert 'FR522' not in {row[0] for row in rows}
+  assert counts['skipped'] == 3
+  assert counts['moses_indicator_values'] == len(rows)
+  assert f'Loaded {len(rows)} indicator values (3 skipped with unknown NUTS or status).' in capsys.readouterr().out
+  assert fakeConnection.committed
+
+
+def testLoadStatements(fakeConnection):
+  BulkLoader(fakeConnection, 'moses', FileDataSource(DATA_FOLDER), nutsLevels=(2,)).load()
+  statements = fakeConnection.statements
+  assert statements[:6] == [
+    'SELECT nuts_id, levl_code FROM moses.nuts',
+    "SELECT to_regclass('moses.moses_indicator_values_level2') IS NOT NULL",
+    "SELECT to_regclass('moses.moses_indicator_values_query_level2') IS NOT NULL",
+    "SELECT column_name FROM information_schema.columns WHERE table_schema = 'moses' "
+    "AND table_name = 'moses_indicator_values_query_level2' ORDER BY ordinal_position",
+    "SELECT to_regclass('moses.moses_indicator_values_date_level2') IS NOT NULL",
+    "SELECT to_regclass('moses.moses_indicator_values_date_query_level2') IS NOT NULL"]
+  tables = ['moses.moses_status', 'moses.moses_activities', 'moses.moses_indicators', 'moses.moses_indicator_values',
+            'moses.moses_indicator_values_date', 'moses.moses_indicator_values_with_nuts_m',
+            'moses.moses_indicator_values_level2', 'moses.moses_indicator_values_query_level2']
+  # Tables are emptied at once, then filled, derived tables last
+  assert statements[6:] == [
+    'TRUNCATE ' + ', '.join(tables),
+    'COPY moses.moses_status (id, name) FROM STDIN',
+    'COPY moses.moses_activities (id, sector, section, div, name) FROM STDIN',
+    'COPY moses.moses_indicators (id, name, unit) FROM STDIN',
+    'COPY moses.moses_indicator_values (' + ', '.join(BulkLoader.VALUE_COLUMNS) + ') FROM STDIN',
+    "INSERT INTO moses.moses_indicator_values_date SELECT nuts_id, nuts_level, activity_id, indicator_id, unit, "
+    "TO_DATE(year, 'YYYY') AS year, value, status, data_source, website, remarks FROM moses.moses_indicator_values",
+    'INSERT INTO moses.moses_indicator_values_with_nuts_m SELECT i.*, nuts_name, cntr_code, levl_code, wkb_geometry '
+    'FROM moses.nuts n, moses.moses_indicator_values i WHERE n.nuts_id = i.nuts_id',
+    'INSERT INTO moses.moses_indicator_values_level2 SELECT t.* FROM moses.moses_indicator_values t '
+    "JOIN moses.nuts n ON n.nuts_id = t.nuts_id WHERE n.levl_code = '2'",
+    'INSERT INTO moses.moses_indicator_values_query_level2 (nuts_id, year, value, wkb_geometry_3857) '
+    'SELECT t.nuts_id, t.year, t.value, n.wkb_geometry_3857 FROM moses.moses_indicator_values t '
+    "JOIN moses.nuts n ON n.nuts_id = t.nuts_id WHERE n.levl_code = '2'"] + \
+    [f'ANALYZE {table}' for table in tables]
+
+
+def testLoadRollsBackOnError(fakeConnection):
+  fakeConnection.nuts = None
+  with pytest.raises(TypeError):
+    BulkLoader(fakeConnection, 'moses', FileDataSource(DATA_FOLDER)).load()
+  assert fakeConnection.rolledBack and not fakeConnection.committed
+
+
+@pytest.fixture
+def connection(csvSource):
+  psycopg2 = pytest.importorskip('psycopg2')
+  if DSN is None:
+    pytest.skip('MOSES_TEST_DSN is not set')
+  connection = psycopg2.connect(DSN)
+  cursor = connection.cursor()
+  cursor.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}')
+  cursor.execute(TABLES.format(dbSchema=SCHEMA))
+  cursor.executemany(f'INSERT INTO {SCHEMA}.nuts VALUES (%s, %s, %s, %s, %s)',
+                     [(row['nuts_id'], int(row['levl_code']), row['nuts_id'], row['nuts_id'][:2], f"POINT {row['nuts_id']}")
+                      for row in csvSource.readCsv(csvSource.nutsFile)])
+  cursor.execute(SchemaOptimizer.QUERY_TABLE.format(dbSchema=SCHEMA, queryTable=QUERY_TABLE, table='moses_indicator_values',
+                                                    items='t.year, t.value, t.unit, t.status',
+                                                    geometryColumn='wkb_geometry', level=2))
+  connection.commit()
+  yield connection
+  connection.rollback()
+  cursor.execute(f'DROP SCHEMA {SCHEMA} CASCADE')
+  connection.commit()
+  connection.close()
+
+
+def readQueryTable(connection):
+  cursor = connection.cursor()
+  cursor.execute(f'''SELECT nuts_id, activity_id, indicator_id, year, value, wkb_geometry FROM {SCHEMA}.{QUERY_TABLE}
+                      ORDER BY nuts_id, activity_id, indicator_id, year''')
+  return [(nutsId, activityId, indicator, year, float(value), geometry)
+          for nutsId, activityId, indicator, year, value, geometry in cursor.fetchall()]
+
+
+def testLoadRefreshesQueryTables(connection, tmp_path):
+  folder = str(tmp_path / 'release')
+  shutil.copytree(DATA_FOLDER, folder)
+  BulkLoader(connection, SCHEMA, FileDataSource(folder)).load()
+  rows = readQueryTable(connection)
+  assert ('FR51', '03,1', 'V11110', '2013', 402.0, 'POINT FR51') in rows
+  assert {row[0] for row in rows} == {'BE10', 'FR10', 'FR51', 'FR52'}
+
+  valuesFile = os.path.join(folder, 'moses_values.csv')
+  with open(valuesFile) as csvFile:
+    values = csvFile.read()
+  with open(valuesFile, 'w') as csvFile:
+    csvFile.write(values.replace('FR51;03,1;V11110;-;402;', 'FR51;03,1;V11110;-;420;'))
+  BulkLoader(connection, SCHEMA, FileDataSource(folder)).load()
+  reloadedRows = readQueryTable(connection)
+  assert ('FR51', '03,1', 'V11110', '2013', 420.0, 'POINT FR51') in reloadedRows
+  assert ('FR51', '03,1', 'V11110', '2013', 402.0, 'POINT FR51') not in reloadedRows
+  assert len(reloadedRows) == len(rows)
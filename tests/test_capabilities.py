@@ -0,0 +1,28 @@
+import xml.etree.ElementTree
+
+import pytest
+
+WMS = '{http://www.opengis.net/wms}'
+
+
+def testCapabilitiesRequireDistinctTimeUrl(publish):
+  with pytest.raises(ValueError):
+    publish('output', isBuildingCapabilities=True)
+
+
+def testCapabilities(publish, tmp_path):
+  folder = tmp_path / 'output'
+  publish('output', isBuildingCapabilities=True, capabilitiesConfig=str(tmp_path / 'moses-capabilities.conf'),
+          wmsTimeBaseUrl='http://www.ifremer.fr/services/wms/moses-time', layerSrid=3857,
+          schemaSql=str(tmp_path / 'moses-schema.sql'))
+  for file in ('moses-capabilities.xml', 'moses-time-capabilities.xml'):
+    root = xml.etree.ElementTree.parse(str(folder / file)).getroot()
+    layers = [layer for layer in root.iter(WMS + 'Layer') if layer.find(WMS + 'Name') is not None]
+    assert len(layers) > 0
+    for layer in layers:
+      assert [crs.text for crs in layer.findall(WMS + 'CRS')] == ['EPSG:3857']
+      assert 'EPSG:3857' in [box.get('CRS') for box in layer.findall(WMS + 'BoundingBox')]
+  with open(str(tmp_path / 'moses-capabilities.conf')) as configFile:
+    config = configFile.read()
+  assert 'RewriteRule ^/services/wms/moses$ /moses-capabilities/moses-capabilities.xml' in config
+  assert 'RewriteRule ^/services/wms/moses\\-time$ /moses-capabilities/moses-time-capabilities.xml' in config
@@ -0,0 +1,65 @@
+import numpy
+import pytest
+
+from moses_mapfile import Classifier, ColorBrewerPalette
+
+
+def testEqualInterval():
+  assert Classifier('equalInterval', 5).classify([[0, 3, 10]]) == [[(0.0, 2.0), (2.0, 4.0), (4.0, 6.0), (6.0, 8.0), (8.0, 10.0)]]
+
+
+def testQuantile():
+  breaks = Classifier('quantile', 4).classify([[1, 2, 3, 4, 5], [0, 10]])
+  assert breaks[0] == [(1.0, 2.0), (2.0, 3.0), (3.0, 4.0), (4.0, 5.0)]
+  # Arrays of other lengths are classified in the same call
+  assert breaks[1] == [(0.0, 2.5), (2.5, 5.0), (5.0, 7.5), (7.5, 10.0)]
+
+
+def testJenks():
+  values = [1, 2, 3, 10, 11, 12, 20, 21, 22]
+  assert Classifier('jenks', 3).classify([values]) == [[(1.0, 10.0), (10.0, 20.0), (20.0, 22.0)]]
+  # Less distinct values than classes
+  assert Classifier('jenks', 5).classify([[1, 1, 2]]) == [[(1.0, 2.0), (2.0, 2.0)]]
+
+
+def testEqualValuesMakeOneClass():
+  for method in Classifier.METHODS:
+    assert Classifier(method, 5).classify([[7, 7, 7]]) == [[(7.0, 7.0)]]
+
+
+def testJenksBlocksGiveTheSameClasses():
+  values = numpy.sort(numpy.random.default_rng(1).lognormal(size=500))
+  starts = Classifier.jenksClassStarts(values, 5, 1000)
+  for blockSize in (1, 7, 64):
+    assert Classifier.jenksClassStarts(values, 5, blockSize) == starts
+
+
+def testJenksSamplesLargeArrays():
+  values = numpy.sort(numpy.random.default_rng(1).lognormal(size=Classifier.JENKS_MAX_VALUES * 4))
+  sample = values[numpy.linspace(0, len(values) - 1, Classifier.JENKS_MAX_VALUES).round().astype(int)]
+  breaks = Classifier('jenks', 5).classify([values])
+  assert breaks == Classifier('jenks', 5).classify([sample])
+  assert breaks[0][0][0] == values[0] and breaks[0][-1][1] == values[-1]
+
+
+def testUnknownMethod():
+  with pytest.raises(ValueError):
+    Classifier('natural', 5)
+
+
+def testClassLabelsAreRounded(publish):
+  publication = publish('labels')
+  classes = publication.buildClassification([(120.0, 1488.4), (1488.4, 2172.6000000000004), (2172.6000000000004, 2875000000.0)])
+  assert [c.label for c in classes.values()] == ['120 - 1488.4', '1488.4 - 2172.6', '2172.6 - 2875000000']
+  # Expressions keep the bounds
+  assert classes[1].max == 2172.6000000000004
+  publication = publish('precision', classificationLabelPrecision=2)
+  assert publication.buildClassification([(0.000123456, 1234.5)])[0].label == '0.00012 - 1200'
+
+
+def testUnavailablePalette(publish):
+  assert len(ColorBrewerPalette('Oranges', 9).colors) == 9
+  with pytest.raises(ValueError, match="'Oranges' with 12 colors requires QGIS"):
+    publish('palette', classificationNbOfClasses=12)
+  with pytest.raises(ValueError, match="'Blues' with 5 colors requires QGIS"):
+    publish('palette', colorScheme='Blues')
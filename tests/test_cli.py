@@ -0,0 +1,78 @@
+import json
+import os
+import re
+
+import pytest
+
+from conftest import DATA_FOLDER, getOutputOptions, readOutputs
+from moses_mapfile import main
+
+
+def runCli(tmp_path, *arguments, **options):
+  folder = str(tmp_path / 'output')
+  os.makedirs(folder, exist_ok=True)
+  config = str(tmp_path / 'moses.json')
+  with open(config, 'w') as configFile:
+    json.dump({**getOutputOptions(folder), 'dataSource': {'type': 'csv', 'folder': DATA_FOLDER}, **options}, configFile)
+  main(['--config', config] + list(arguments))
+  return folder
+
+
+def getLayerNames(file):
+  with open(file) as mapFile:
+    return re.findall(r'^      NAME "(MOSES[^"]*)"', mapFile.read(), re.MULTILINE)
+
+
+def testMapfileStage(tmp_path):
+  folder = runCli(tmp_path, '--stages', 'mapfile')
+  assert sorted(os.listdir(folder)) == ['moses.map']
+  assert len(getLayerNames(os.path.join(folder, 'moses.map'))) == 17
+
+
+def testAllStages(tmp_path):
+  folder = runCli(tmp_path, '--stages', 'mapfile,time,contexts')
+  for file in ('moses.map', 'moses-time.map', 'moses.xml', 'moses-time.xml', 'moses031.xml', 'moses501-time.xml'):
+    assert os.path.exists(os.path.join(folder, file))
+
+
+def testContextsStage(tmp_path):
+  folder = runCli(tmp_path, '--stages', 'contexts')
+  assert 'moses.map' not in os.listdir(folder)
+  with open(os.path.join(folder, 'moses.xml')) as contextFile:
+    assert 'MOSES.Fisheries-Aquaculture.031.V11110.NUTS2.2014' in contextFile.read()
+
+
+def testUnknownStage(tmp_path):
+  with pytest.raises(SystemExit):
+    runCli(tmp_path, '--stages', 'mapfile,tiling')
+
+
+def testFilters(tmp_path):
+  manifest = str(tmp_path / 'moses-manifest.json')
+  folder = runCli(tmp_path, '--stages', 'mapfile', manifest=manifest)
+  with open(os.path.join(folder, 'moses.map')) as mapFile:
+    mapfile = mapFile.read()
+  with open(manifest) as manifestFile:
+    layers = json.load(manifestFile)['layers']
+  runCli(tmp_path, '--stages', 'mapfile', '--activity', '03,1', '--level', '2', '--level', '3', manifest=manifest)
+  with open(os.path.join(folder, 'moses.map')) as mapFile:
+    assert mapFile.read() == mapfile
+  with open(manifest) as manifestFile:
+    assert json.load(manifestFile)['layers'] == layers
+
+
+def testFilteredRunKeepsOtherLayersInOutputs(tmp_path):
+  manifest = str(tmp_path / 'moses-manifest.json')
+  folder = runCli(tmp_path, manifest=manifest)
+  outputs = readOutputs(folder)
+  assert len(getLayerNames(os.path.join(folder, 'moses.map'))) == 17
+  runCli(tmp_path, '--activity', '03,1', manifest=manifest)
+  # Layers of 50,1 are copied from the previous run in the global and activity outputs
+  assert readOutputs(folder) == outputs
+  with open(os.path.join(folder, 'moses.xml')) as contextFile:
+    assert 'MOSES.Transport.501.V12120.NUTS0.2015' in contextFile.read()
+
+
+def testFilteredRunWithoutManifestPublishesAllLayers(tmp_path):
+  folder = runCli(tmp_path, '--stages', 'mapfile', '--indicator', 'V12120')
+  assert len(getLayerNames(os.path.join(folder, 'moses.map'))) == 17
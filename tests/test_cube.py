@@ -0,0 +1,81 @@
+import os
+import shutil
+
+import numpy
+import pytest
+
+from conftest import DATA_FOLDER
+from moses_mapfile import CubeDataSource, FileDataSource, IndicatorCube
+from test_datasources import getCombinations
+
+
+class UnstampedDataSource(FileDataSource):
+  """
+  Source whose stamp can not be computed, like a database without table statistics.
+  """
+
+  def getStamp(self):
+    return None
+
+
+def writeNutsExtent(folder, nutsId, extent):
+  nutsFile = os.path.join(folder, 'nuts.csv')
+  with open(nutsFile) as csvFile:
+    lines = csvFile.read().splitlines()
+  lines = [f"{nutsId};{line.split(';')[1]};{';'.join(str(c) for c in extent)}" if line.startswith(nutsId + ';') else line
+           for line in lines]
+  with open(nutsFile, 'w') as csvFile:
+    csvFile.write('\n'.join(lines) + '\n')
+
+
+def testCubeMatchesSource(csvSource, tmp_path):
+  cube = CubeDataSource(csvSource, str(tmp_path / 'cube'))
+  levels = {0, 1, 2, 3}
+  assert getCombinations(cube.getIndicatorStatistics(levels)) == getCombinations(csvSource.getIndicatorStatistics(levels))
+  assert cube.getNutsExtents() == csvSource.getNutsExtents()
+  # Offline cube
+  assert getCombinations(CubeDataSource(None, str(tmp_path / 'cube')).getIndicatorStatistics({2})) == \
+         getCombinations(csvSource.getIndicatorStatistics({2}))
+
+
+def testNutsChangesRefreshCube(tmp_path):
+  folder = str(tmp_path / 'data')
+  shutil.copytree(DATA_FOLDER, folder)
+  CubeDataSource(FileDataSource(folder), str(tmp_path / 'cube'))
+  writeNutsExtent(folder, 'FR101', (2.2, 48.8, 2.5, 48.95))
+  cube = CubeDataSource(FileDataSource(folder), str(tmp_path / 'cube'))
+  assert cube.getNutsExtents()['FR101'] == (2.2, 48.8, 2.5, 48.95)
+
+
+def testMissingStampAlwaysRefreshesCube(tmp_path):
+  folder = str(tmp_path / 'data')
+  shutil.copytree(DATA_FOLDER, folder)
+  CubeDataSource(UnstampedDataSource(folder), str(tmp_path / 'cube'))
+  writeNutsExtent(folder, 'FR101', (2.2, 48.8, 2.5, 48.95))
+  cube = CubeDataSource(UnstampedDataSource(folder), str(tmp_path / 'cube'))
+  assert cube.getNutsExtents()['FR101'] == (2.2, 48.8, 2.5, 48.95)
+
+
+def testRefreshReplacesCubeFolder(tmp_path):
+  folder = str(tmp_path / 'data')
+  shutil.copytree(DATA_FOLDER, folder)
+  cubeFolder = str(tmp_path / 'cube')
+  CubeDataSource(FileDataSource(folder), cubeFolder)
+  writeNutsExtent(folder, 'FR101', (2.2, 48.8, 2.5, 48.95))
+  CubeDataSource(FileDataSource(folder), cubeFolder)
+  assert sorted(os.listdir(str(tmp_path))) == ['cube', 'data']
+
+
+def testInterruptedSaveKeepsPreviousCube(csvSource, tmp_path, monkeypatch):
+  cubeFolder = str(tmp_path / 'cube')
+  CubeDataSource(csvSource, cubeFolder)
+  stamp = IndicatorCube.load(cubeFolder).stamp
+
+  def failingSave(file, array):
+    raise OSError('Disk full')
+  monkeypatch.setattr(numpy, 'save', failingSave)
+  with pytest.raises(OSError):
+    IndicatorCube.build(csvSource, 'new stamp').save(cubeFolder)
+  cube = IndicatorCube.load(cubeFolder)
+  assert cube.stamp == stamp
+  assert len(cube.arrays['value']) > 0
@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+from conftest import readOutputs
+from moses_mapfile import DataSource
+
+
+def testDataSourceIsAbstract():
+  with pytest.raises(TypeError):
+    DataSource()
+
+
+def testCsvStatistics(csvSource):
+  statistics = csvSource.getIndicatorStatistics({0, 1, 2, 3})
+  assert sorted(statistics) == ['03,1', '50,1']
+  combination = statistics['03,1']['V11110'][3]['2013']
+  assert (combination.count, combination.min, combination.max) == (5, 2.0, 310.0)
+  # NUTS ids and values are ordered by value
+  assert combination.nutsIds == ['FR105', 'FR101', 'BE100', 'FR511', 'FR522']
+  assert combination.values == [2.0, 4.0, 12.0, 133.0, 310.0]
+  # Empty values are skipped
+  assert sorted(statistics['50,1']['V12120'][0]) == ['2013', '2014', '2015']
+  assert statistics['50,1']['V12120'][0]['2015'].nutsIds == ['FR']
+
+
+def testCsvLevelFilter(csvSource):
+  statistics = csvSource.getIndicatorStatistics({2})
+  assert list(statistics['03,1']['V11110']) == [2]
+
+
+def getCombinations(statistics):
+  # Statistics of a cube hold arrays
+  return {(activityId, indicator, nutsLevel, year): (yearStatistics.count, yearStatistics.min, yearStatistics.max,
+                                                     list(yearStatistics.nutsIds), list(yearStatistics.values))
+          for activityId, activityStatistics in statistics.items()
+          for indicator, indicatorStatistics in activityStatistics.items()
+          for nutsLevel, levelStatistics in indicatorStatistics.items()
+          for year, yearStatistics in levelStatistics.items()}
+
+
+def testSqliteMatchesCsv(csvSource, sqliteSource):
+  levels = {0, 1, 2, 3}
+  assert getCombinations(sqliteSource.getIndicatorStatistics(levels)) == getCombinations(csvSource.getIndicatorStatistics(levels))
+  assert sqliteSource.getActivities() == csvSource.getActivities()
+  assert sqliteSource.getIndicatorLabels() == csvSource.getIndicatorLabels()
+  assert sqliteSource.getNutsExtents() == csvSource.getNutsExtents()
+  assert csvSource.getIndicatorLabels()['V12120'] == 'Turnover (EUR)'
+  assert csvSource.getNutsExtents()['FR101'] == (2.22, 48.82, 2.47, 48.9)
+
+
+def testSqlitePublicationMatchesCsv(publish, sqliteSource, tmp_path):
+  publish('csv')
+  publish('sqlite', sqliteSource)
+  csvOutputs = readOutputs(str(tmp_path / 'csv'))
+  assert len(csvOutputs) > 0
+  assert readOutputs(str(tmp_path / 'sqlite')) == csvOutputs
+
+
+def testPublicationLayers(publish, tmp_path):
+  publication = publish('csv')
+  # 4 levels x 3 years of fishing enterprises, turnover of 3 years at level 0 and 2 years at level 1
+  assert publication.instrumentation.counters['layers'] == 17
+  assert publication.instrumentation.counters['timeLayers'] == 6
+  with open(str(tmp_path / 'csv' / 'moses.map')) as mapFile:
+    mapfile = mapFile.read()
+  assert 'NAME "MOSES.Fisheries-Aquaculture.031.V11110.NUTS3.2013"' in mapfile
+  assert os.path.exists(str(tmp_path / 'csv' / 'moses031.xml'))
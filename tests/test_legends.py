@@ -0,0 +1,86 @@
+import os
+import struct
+import zlib
+
+import numpy
+
+from moses_mapfile import LegendRenderer, MosesPublication
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def readPng(file):
+  """
+  Width, height and RGBA pixels of a PNG file, checking its chunks.
+
+  :rtype: tuple
+  """
+  with open(file, 'rb') as pngFile:
+    data = pngFile.read()
+  assert data[:8] == PNG_SIGNATURE
+  chunks = []
+  offset = 8
+  while offset < len(data):
+    length, = struct.unpack('>I', data[offset:offset + 4])
+    chunkType = data[offset + 4:offset + 8]
+    chunkData = data[offset + 8:offset + 8 + length]
+    crc, = struct.unpack('>I', data[offset + 8 + length:offset + 12 + length])
+    assert crc == zlib.crc32(chunkType + chunkData) & 0xffffffff
+    chunks.append((chunkType, chunkData))
+    offset = offset + 12 + length
+  assert [chunkType for chunkType, chunkData in chunks] == [b'IHDR', b'IDAT', b'IEND']
+  width, height, bitDepth, colorType, compression, filterMethod, interlace = struct.unpack('>IIBBBBB', chunks[0][1])
+  assert (bitDepth, colorType, compression, filterMethod, interlace) == (8, 6, 0, 0, 0)
+  raw = numpy.frombuffer(zlib.decompress(chunks[1][1]), dtype=numpy.uint8).reshape(height, 1 + width * 4)
+  # Rows are not filtered
+  assert (raw[:, 0] == 0).all()
+  return width, height, raw[:, 1:].reshape(height, width, 4)
+
+
+def getClasses(*bounds):
+  colors = ['254 237 222', '253 190 133', '230 85 13']
+  return {x: MosesPublication.ThematicCategory(lower, upper, f'{lower} - {upper}', colors[x])
+          for x, (lower, upper) in enumerate(bounds)}
+
+
+def testLegendPng(tmp_path):
+  renderer = LegendRenderer(str(tmp_path), 'http://localhost/legends/')
+  url, width, height = renderer.getLegend(getClasses((0, 10), (10, 25.5), (25.5, 100)))
+  files = os.listdir(str(tmp_path))
+  assert url == f'http://localhost/legends/{files[0]}'
+  pngWidth, pngHeight, pixels = readPng(str(tmp_path / files[0]))
+  # 'No data' and 3 classes of 10 pixels keys with 4 pixels spacing, labels of at most 10 characters
+  assert (pngWidth, pngHeight) == (width, height) == (5 + 20 + 5 + 10 * 6 + 5, 5 * 2 + 4 * 14 - 4)
+  # Transparent margin, outlined keys with the class colors
+  assert (pixels[0] == 0).all()
+  assert tuple(pixels[5, 5]) == LegendRenderer.OUTLINE_COLOR + (255,)
+  assert tuple(pixels[10, 10]) == LegendRenderer.NO_DATA_COLOR + (255,)
+  assert tuple(pixels[5 + 3 * 14 + 5, 10]) == (230, 85, 13, 255)
+  # Labels are drawn in the label color
+  labelPixels = pixels[:, 30:]
+  assert {tuple(p) for p in labelPixels.reshape(-1, 4)} == {(0, 0, 0, 0), LegendRenderer.LABEL_COLOR + (255,)}
+
+
+def testIdenticalClassesShareTheirLegend(tmp_path):
+  renderer = LegendRenderer(str(tmp_path), 'http://localhost/legends')
+  legend = renderer.getLegend(getClasses((0, 10), (10, 20)))
+  # Another renderer, as in workers, finds the same file
+  assert LegendRenderer(str(tmp_path), 'http://localhost/legends').getLegend(getClasses((0, 10), (10, 20))) == legend
+  assert renderer.getLegend(getClasses((0, 10), (10, 30))) != legend
+  assert len(os.listdir(str(tmp_path))) == 2
+
+
+def testPublishedLegends(publish, tmp_path):
+  legendFolder = str(tmp_path / 'legends')
+  publication = publish('publication', isBuildingLegends=True, legendFolder=legendFolder,
+                        legendBaseUrl='http://localhost/legends')
+  files = sorted(os.listdir(legendFolder))
+  # One legend file per distinct classification, referenced by layers
+  assert len(files) == len(publication.legendRenderer.legends) > 1
+  mapfiles = ''
+  for file in ('moses.map', 'moses-time.map'):
+    with open(str(tmp_path / 'publication' / file)) as mapFile:
+      mapfiles = mapfiles + mapFile.read()
+  assert {file for file in files if f'http://localhost/legends/{file}' in mapfiles} == set(files)
+  for file in files:
+    readPng(os.path.join(legendFolder, file))
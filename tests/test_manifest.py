@@ -0,0 +1,85 @@
+import os
+import shutil
+
+import pytest
+
+from conftest import DATA_FOLDER, readOutputs
+from moses_mapfile import FileDataSource
+
+
+def testUnchangedLayersAreReused(publish, tmp_path):
+  manifest = str(tmp_path / 'moses-manifest.json')
+  first = publish('first', manifest=manifest)
+  assert first.instrumentation.counters.get('unchangedLayers', 0) == 0
+  second = publish('second', manifest=manifest)
+  counters = second.instrumentation.counters
+  assert counters['unchangedLayers'] == counters['layers'] == 17
+  assert counters['unchangedTimeLayers'] == counters['timeLayers'] == 6
+  assert readOutputs(str(tmp_path / 'second')) == readOutputs(str(tmp_path / 'first'))
+
+
+def testChangedValuesInvalidateTheirLayers(publish, tmp_path):
+  folder = str(tmp_path / 'data')
+  shutil.copytree(DATA_FOLDER, folder)
+  manifest = str(tmp_path / 'moses-manifest.json')
+  publish('first', FileDataSource(folder), manifest=manifest)
+
+  valuesFile = os.path.join(folder, 'moses_values.csv')
+  with open(valuesFile, encoding='latin-1') as csvFile:
+    values = csvFile.read()
+  with open(valuesFile, 'w', encoding='latin-1') as csvFile:
+    csvFile.write(values.replace('FR101;03,1;V11110;-;4;', 'FR101;03,1;V11110;-;9;'))
+  counters = publish('second', FileDataSource(folder), manifest=manifest).instrumentation.counters
+  # Only the NUTS3 layer of 2013 and the NUTS3 time layer changed
+  assert counters['unchangedLayers'] == counters['layers'] - 1
+  assert counters['unchangedTimeLayers'] == counters['timeLayers'] - 1
+
+
+def testChangedSettingsInvalidateAllLayers(publish, tmp_path):
+  manifest = str(tmp_path / 'moses-manifest.json')
+  publish('first', manifest=manifest)
+  counters = publish('second', manifest=manifest, classificationNbOfClasses=4).instrumentation.counters
+  assert counters.get('unchangedLayers', 0) == 0
+  assert counters.get('unchangedTimeLayers', 0) == 0
+
+
+def testLayersAreRebuiltWithoutManifest(publish, tmp_path):
+  publish('first')
+  counters = publish('second').instrumentation.counters
+  assert counters.get('unchangedLayers', 0) == 0
+  assert not os.path.exists(str(tmp_path / 'moses-manifest.json'))
+
+
+@pytest.mark.parametrize('filters', [{'activityIds': ['50,1']}, {'selectedNutsLevels': {3}},
+                                     {'activityIds': ['03,1'], 'indicatorIds': ['V11110'], 'selectedNutsLevels': {0, 1}}])
+def testFilteredRunKeepsOtherLayers(publish, tmp_path, filters):
+  manifest = str(tmp_path / 'moses-manifest.json')
+  publish('first', manifest=manifest)
+  counters = publish('filtered', manifest=manifest, **filters).instrumentation.counters
+  # Filtered out layers are copied from the previous run in the outputs
+  assert counters['layers'] == 17 and counters['timeLayers'] == 6
+  assert counters['keptLayers'] + counters['unchangedLayers'] == 17
+  assert counters['keptTimeLayers'] + counters['unchangedTimeLayers'] == 6
+  assert readOutputs(str(tmp_path / 'filtered')) == readOutputs(str(tmp_path / 'first'))
+
+  counters = publish('second', manifest=manifest).instrumentation.counters
+  assert counters['unchangedLayers'] == counters['layers']
+  assert counters['unchangedTimeLayers'] == counters['timeLayers']
+
+
+def testFilteredOutLayersAreNotRebuilt(publish, tmp_path):
+  folder = str(tmp_path / 'data')
+  shutil.copytree(DATA_FOLDER, folder)
+  manifest = str(tmp_path / 'moses-manifest.json')
+  publish('first', FileDataSource(folder), manifest=manifest)
+
+  valuesFile = os.path.join(folder, 'moses_values.csv')
+  with open(valuesFile, encoding='latin-1') as csvFile:
+    values = csvFile.read()
+  with open(valuesFile, 'w', encoding='latin-1') as csvFile:
+    csvFile.write(values.replace('FR101;03,1;V11110;-;4;', 'FR101;03,1;V11110;-;9;'))
+  # The changed NUTS3 layer is filtered out by level
+  publish('filtered', FileDataSource(folder), manifest=manifest, selectedNutsLevels={0, 1, 2})
+  assert readOutputs(str(tmp_path / 'filtered')) == readOutputs(str(tmp_path / 'first'))
+  counters = publish('second', FileDataSource(folder), manifest=manifest).instrumentation.counters
+  assert counters['unchangedLayers'] == counters['layers'] - 1
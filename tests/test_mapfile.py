@@ -0,0 +1,114 @@
+import math
+import os
+import re
+
+import pytest
+
+
+def readFile(folder, file):
+  with open(os.path.join(folder, file)) as outputFile:
+    return outputFile.read()
+
+
+def getLayerBlock(mapfile, layerName):
+  return re.search(r'# # ' + re.escape(layerName) + r' ##\n(.*?)\n    END\n', mapfile, re.S).group(1)
+
+
+def testFeatureInfoLayers(publish, tmp_path):
+  folder = str(tmp_path / 'featureinfo')
+  publish('featureinfo', isOptimizingFeatureInfo=True, isUsingBaseLayers=True, featureInfoMaxFeatures=5,
+          schemaSql=os.path.join(folder, 'moses-schema.sql'))
+  layer = getLayerBlock(readFile(folder, 'moses.map'), 'MOSES.Fisheries-Aquaculture.031.V11110.NUTS2.2013')
+  assert '''      DATA "wkb_geometry FROM (
+      SELECT v.nuts_id, v.year, v.value, v.unit, v.status, v.wkb_geometry
+              FROM moses.moses_indicator_values_query_level2 v
+              WHERE v.indicator_id = 'V11110'
+                AND v.activity_id = '03,1' AND v.year = '2013'
+          ) AS RS USING UNIQUE nuts_id USING srid=4326"''' in layer
+  assert 'gml_include_items "nuts_id,year,value,unit,status"' in layer
+  assert 'wms_include_items "nuts_id,year,value,unit,status"' in layer
+  assert 'wms_feature_info_max_features "5"' in layer
+
+  timeLayer = getLayerBlock(readFile(folder, 'moses-time.map'), 'MOSES.Fisheries-Aquaculture.031.V11110.NUTS2')
+  assert 'FROM moses.moses_indicator_values_date_query_level2 v' in timeLayer
+  assert 'wms_feature_info_max_features "5"' in timeLayer
+
+
+def testLayersReturnAllItems(publish, tmp_path):
+  publish('default')
+  layer = getLayerBlock(readFile(str(tmp_path / 'default'), 'moses.map'), 'MOSES.Fisheries-Aquaculture.031.V11110.NUTS2.2013')
+  assert 'gml_include_items "all"' in layer
+  assert 'wms_include_items' not in layer
+  assert 'wms_feature_info_max_features' not in layer
+
+
+def testScaleBands(publish, tmp_path):
+  folder = str(tmp_path / 'scales')
+  publish('scales', geometryResolutions=[(0, 0), (5000000, 0.005), (25000000, 0.02)],
+          schemaSql=os.path.join(folder, 'moses-schema.sql'))
+  layer = getLayerBlock(readFile(folder, 'moses.map'), 'MOSES.Fisheries-Aquaculture.031.V11110.NUTS2.2013')
+  # Without simplification, the first band reads the NUTS table
+  assert '''      SCALETOKEN
+        NAME "%nuts%"
+        VALUES
+          "0" "nuts"
+          "5000000" "nuts_level2_r1"
+          "25000000" "nuts_level2_r2"
+        END
+      END''' in layer
+  assert 'FROM moses.%nuts% n' in layer
+  assert '''CREATE TABLE moses.nuts_level2_r2 AS
+  SELECT nuts_id, levl_code,
+         ST_Multi(ST_SimplifyPreserveTopology(wkb_geometry, 0.02)) AS wkb_geometry
+    FROM moses.nuts
+   WHERE levl_code = '2';''' in readFile(folder, 'moses-schema.sql')
+
+
+def testScaleBandsOfLevelTables(publish, tmp_path):
+  folder = str(tmp_path / 'scales')
+  publish('scales', isUsingLevelTables=True, geometryResolutions=[(0, 0), (5000000, 0.005)],
+          schemaSql=os.path.join(folder, 'moses-schema.sql'))
+  timeLayer = getLayerBlock(readFile(folder, 'moses-time.map'), 'MOSES.Fisheries-Aquaculture.031.V11110.NUTS2')
+  assert '''        VALUES
+          "0" "nuts_level2"
+          "5000000" "nuts_level2_r1"
+        END''' in timeLayer
+  assert 'FROM moses.%nuts% n\n             LEFT OUTER JOIN moses.moses_indicator_values_date_level2 v' in timeLayer
+
+
+def testLayersWithoutScaleBands(publish, tmp_path):
+  publish('default')
+  mapfile = readFile(str(tmp_path / 'default'), 'moses.map')
+  assert 'SCALETOKEN' not in mapfile and '%nuts%' not in mapfile
+  assert 'FROM moses.nuts n' in getLayerBlock(mapfile, 'MOSES.Fisheries-Aquaculture.031.V11110.NUTS2.2013')
+
+
+def testProjectedLayers(publish, tmp_path):
+  folder = str(tmp_path / 'projected')
+  publish('projected', layerSrid=3857, schemaSql=os.path.join(folder, 'moses-schema.sql'))
+  layer = getLayerBlock(readFile(folder, 'moses.map'), 'MOSES.Fisheries-Aquaculture.031.V11110.NUTS2.2013')
+  # Extent of the NUTS having data (-5.14 46.27 4.48 50.91) in spherical mercator
+  radius = 6378137.0
+  extent = [radius * math.radians(-5.14), radius * math.log(math.tan(math.pi / 4 + math.radians(46.27) / 2)),
+            radius * math.radians(4.48), radius * math.log(math.tan(math.pi / 4 + math.radians(50.91) / 2))]
+  renderedExtent = ' '.join(f'{c:.2f}' for c in extent)
+  assert f'      EXTENT {renderedExtent}\n      UNITS METERS' in layer
+  assert f'wms_extent "{renderedExtent}"' in layer
+  # Geometries are read from the projected column maintained by the schema script
+  assert '''      DATA "wkb_geometry_3857 FROM (
+      SELECT n.nuts_id, v.activity_id, v.indicator_id, v.unit,
+        year, value, status, data_source, website, wkb_geometry_3857
+              FROM moses.nuts n''' in layer
+  assert ') AS RS USING UNIQUE nuts_id USING srid=3857"' in layer
+  assert '"init=epsg:3857"' in layer
+  assert 'wms_srs "EPSG:3857"' in layer
+  assert 'ALTER TABLE moses.nuts ADD COLUMN IF NOT EXISTS wkb_geometry_3857 geometry(MultiPolygon, 3857);' \
+      in readFile(folder, 'moses-schema.sql')
+
+  timeLayer = getLayerBlock(readFile(folder, 'moses-time.map'), 'MOSES.Fisheries-Aquaculture.031.V11110.NUTS2')
+  assert 'DATA "wkb_geometry_3857 FROM (' in timeLayer and 'wms_srs "EPSG:3857"' in timeLayer
+
+
+def testUnsupportedLayerSrid(publish):
+  with pytest.raises(ValueError, match='EPSG:2154 is not one of EPSG:4326, EPSG:3857, EPSG:3395'):
+    publish('projected', layerSrid=2154)
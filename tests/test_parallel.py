@@ -0,0 +1,26 @@
+from conftest import readOutputs
+from moses_mapfile import MosesPublication
+
+
+def testParallelRunIsIdenticalToSerialRun(publish, tmp_path):
+  options = {'isBuildingActivityMapfiles': True, 'mapfileIncludeMode': 'activity'}
+  serial = publish('serial', numberOfWorkers=1, **options)
+  parallel = publish('parallel', numberOfWorkers=2, **options)
+  outputs = readOutputs(str(tmp_path / 'serial'))
+  assert len(outputs) > 4
+  assert readOutputs(str(tmp_path / 'parallel')) == outputs
+  assert parallel.instrumentation.counters['layers'] == serial.instrumentation.counters['layers']
+
+
+def testWorkersStartBeforeOutputsAreOpened(publish, monkeypatch):
+  # Workers are spawned with a pickled publication, recorded here in the main process
+  builders = []
+  getState = MosesPublication.__getstate__
+
+  def recordState(publication):
+    builders.append('mapBuilder' in vars(publication))
+    return getState(publication)
+
+  monkeypatch.setattr(MosesPublication, '__getstate__', recordState)
+  publish('parallel', numberOfWorkers=2)
+  assert builders == [False, False]
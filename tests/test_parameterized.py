@@ -0,0 +1,71 @@
+import os
+import re
+
+import pytest
+
+# Options publishing one layer per NUTS level with classes in the database
+PARAMETERIZED = {'isParameterizedMode': True, 'wmsTimeLayerMode': False}
+
+
+def publishParameterized(publish, tmp_path, name, **options):
+  classes = str(tmp_path / name / 'moses-classes.sql')
+  return publish(name, classes=classes, **{**PARAMETERIZED, **options}), str(tmp_path / name)
+
+
+def readFile(folder, file):
+  with open(os.path.join(folder, file)) as outputFile:
+    return outputFile.read()
+
+
+def getLayerBlock(mapfile, layerName):
+  return re.search(r'# # ' + re.escape(layerName) + r' ##\n(.*?)\n    END\n', mapfile, re.S).group(1)
+
+
+def testOneLayerPerLevel(publish, tmp_path):
+  publishParameterized(publish, tmp_path, 'parameterized')
+  mapfile = readFile(str(tmp_path / 'parameterized'), 'moses.map')
+  assert re.findall(r'^    # # (.*) ##$', mapfile, re.M) == ['MOSES.NUTS0', 'MOSES.NUTS1', 'MOSES.NUTS2', 'MOSES.NUTS3']
+
+  layer = getLayerBlock(mapfile, 'MOSES.NUTS2')
+  assert '''      VALIDATION
+        "activity" "^[0-9,]{1,10}$"
+        "indicator" "^[A-Za-z0-9_]{1,10}$"
+        "year" "^[0-9]{4}$"
+        "default_activity" "03,1"
+        "default_indicator" "V11110"
+        "default_year" "2013"
+      END''' in layer
+  # Values are selected by the substituted request parameters, classes by level
+  assert "ON v.nuts_id = n.nuts_id AND v.indicator_id = '%indicator%'" in layer
+  assert "AND v.activity_id = '%activity%' AND v.year = '%year%'" in layer
+  assert "AND c.nuts_level = '2' AND c.year = v.year" in layer
+  assert "c.class_index, c.label, c.color" in layer
+
+
+def testClassesAreLabelledByIndex(publish, tmp_path):
+  publishParameterized(publish, tmp_path, 'parameterized')
+  folder = str(tmp_path / 'parameterized')
+  layer = getLayerBlock(readFile(folder, 'moses.map'), 'MOSES.NUTS0')
+  names = re.findall(r'NAME "(.*)"\n        EXPRESSION \(\[class_index\] = (\d+)\)', layer)
+  assert names == [('120 - 804.2', '0'), ('804.2 - 1488.4', '1'), ('1488.4 - 2172.6', '2'),
+                   ('2172.6 - 2856.8', '3'), ('2856.8 - 3541', '4')]
+  assert layer.count('COLOR [color]') == len(names)
+
+  # Classes of all combinations are loaded in the database
+  classes = readFile(folder, 'moses-classes.sql')
+  assert "INSERT INTO moses.moses_indicator_classes VALUES ('03,1', 'V11110', '0', '2013', 0, 120.0, 804.2, false, " \
+         "'120 - 804.2', '#feedde');" in classes
+  assert "('03,1', 'V11110', '0', '2013', 4, 2856.8, 3541.0, true, '2856.8 - 3541', '#a63603');" in classes
+  assert classes.index('BEGIN;') < classes.index('DELETE FROM') < classes.index('INSERT INTO') < classes.index('COMMIT;')
+
+
+def testMapfileStageDisabled(publish, tmp_path):
+  publishParameterized(publish, tmp_path, 'parameterized', isBuildingMapfile=False)
+  files = os.listdir(str(tmp_path / 'parameterized'))
+  assert 'moses.map' not in files
+  assert 'moses-classes.sql' not in files
+
+
+def testTimeLayersAreNotSupported(publish, tmp_path):
+  with pytest.raises(ValueError, match='time layers'):
+    publishParameterized(publish, tmp_path, 'parameterized', wmsTimeLayerMode=True)
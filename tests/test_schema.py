@@ -0,0 +1,65 @@
+
+from moses_mapfile import QueryShape, SchemaOptimizer
+
+# Schema script of the CSV fixture layers, with covering indexes on the values tables
+SCHEMA_SQL = """BEGIN;
+
+DO $$
+BEGIN
+  IF current_setting('server_version_num')::integer < 110000 THEN
+    RAISE EXCEPTION 'Covering indexes of this script require PostgreSQL 11 or later.';
+  END IF;
+END
+$$;
+
+CREATE INDEX IF NOT EXISTS nuts_levl_code_nuts_idx
+  ON moses.nuts USING btree (levl_code, nuts_id);
+CREATE INDEX IF NOT EXISTS nuts_wkb_geometry_idx
+  ON moses.nuts USING gist (wkb_geometry);
+CREATE INDEX IF NOT EXISTS moses_indicator_values_indicator_activity_year_nuts_idx
+  ON moses.moses_indicator_values USING btree (indicator_id, activity_id, year, nuts_id) INCLUDE (value);
+CREATE INDEX IF NOT EXISTS moses_indicator_values_date_indicator_activity_nuts_idx
+  ON moses.moses_indicator_values_date USING btree (indicator_id, activity_id, nuts_id) INCLUDE (year, value);
+
+ANALYZE moses.nuts;
+ANALYZE moses.moses_indicator_values;
+ANALYZE moses.moses_indicator_values_date;
+COMMIT;
+"""
+
+
+def readSchema(publish, tmp_path, name, **options):
+  schemaSql = str(tmp_path / name / 'moses-schema.sql')
+  publish(name, isOptimizingSchema=True, schemaSql=schemaSql, **options)
+  with open(schemaSql) as sqlFile:
+    return sqlFile.read()
+
+
+def testSchemaScript(publish, tmp_path):
+  assert readSchema(publish, tmp_path, 'schema') == SCHEMA_SQL
+
+
+def testVersionIsCheckedForCoveringIndexes(tmp_path):
+  optimizer = SchemaOptimizer(str(tmp_path / 'moses-schema.sql'), 'moses', (0,))
+  optimizer.addQueryShapes([QueryShape('nuts', ['levl_code'], 'nuts_id', [], 'wkb_geometry')])
+  assert 'server_version_num' not in optimizer.render()
+  optimizer.addQueryShapes([QueryShape('moses_indicator_values', ['indicator_id'], 'nuts_id', ['value'], None)])
+  sql = optimizer.render()
+  assert sql.index('server_version_num') < sql.index('INCLUDE (value)')
+
+
+def testLevelTables(publish, tmp_path):
+  sql = readSchema(publish, tmp_path, 'levels', isUsingLevelTables=True, nutsLevels=(2,))
+  assert """CREATE TABLE moses.moses_indicator_values_level2 AS
+  SELECT t.* FROM moses.moses_indicator_values t
+    JOIN moses.nuts n ON n.nuts_id = t.nuts_id
+   WHERE n.levl_code = '2';""" in sql
+  assert """CREATE INDEX IF NOT EXISTS moses_indicator_values_level2_indicator_activity_year_nuts_idx
+  ON moses.moses_indicator_values_level2 USING btree (indicator_id, activity_id, year, nuts_id) INCLUDE (value);""" in sql
+  assert 'ANALYZE moses.moses_indicator_values_date_level2;' in sql
+
+
+def testLongIndexNames():
+  name = SchemaOptimizer.getIndexName('moses_indicator_values_date_query_level2', ['indicator_id', 'activity_id', 'nuts_id'])
+  assert len(name) == SchemaOptimizer.MAX_NAME_LENGTH
+  assert name != SchemaOptimizer.getIndexName('moses_indicator_values_date_query_level3', ['indicator_id', 'activity_id', 'nuts_id'])
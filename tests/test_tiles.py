@@ -0,0 +1,100 @@
+import csv
+import json
+import os
+import shutil
+
+from conftest import DATA_FOLDER, getOutputOptions
+from moses_benchmark import SyntheticDataset
+from moses_mapfile import FileDataSource, MosesPublication, TileCacheBuilder
+from test_cli import runCli
+
+
+def readSeeds(folder):
+  with open(os.path.join(folder, 'moses-seed.csv')) as seedFile:
+    return list(csv.reader(seedFile))
+
+
+def testTilesStage(tmp_path):
+  folder = runCli(tmp_path, '--stages', 'mapfile,tiles')
+  assert sorted(os.listdir(folder)) == ['moses-mapcache.xml', 'moses-seed.csv', 'moses.map']
+  seeds = readSeeds(folder)
+  assert seeds[0] == ['tileset', 'zoom', 'column', 'row']
+  # BE and FR straddle the Greenwich meridian
+  assert [row[1:] for row in seeds if row[0] == 'MOSES.Fisheries-Aquaculture.031.V11110.NUTS0.2013'][:4] == \
+      [['0', '0', '0'], ['1', '0', '0'], ['1', '1', '0'], ['2', '1', '1']]
+
+
+def testSeedingListIsDeterministic(publish, tmp_path):
+  serial = publish('serial', isBuildingTileCache=True)
+  parallel = publish('parallel', isBuildingTileCache=True, numberOfWorkers=2)
+  seeds = readSeeds(str(tmp_path / 'serial'))
+  assert len(seeds) - 1 == serial.tileCacheBuilder.numberOfTiles > 0
+  assert readSeeds(str(tmp_path / 'parallel')) == seeds
+  assert parallel.tileCacheBuilder.numberOfTiles == serial.tileCacheBuilder.numberOfTiles
+  # Sorted by layer, zoom, column and row, without duplicates
+  rows = [(row[0], int(row[1]), int(row[2]), int(row[3])) for row in seeds[1:]]
+  assert len(set(rows)) == len(rows)
+  for layerName in {row[0] for row in rows}:
+    layerRows = [row[1:] for row in rows if row[0] == layerName]
+    assert layerRows == sorted(layerRows)
+
+
+def testTileRanges():
+  builder = TileCacheBuilder(None, None, '', '', {}, {})
+  assert builder.getTileRanges((2.22, 48.82, 2.47, 48.9), 9) == (259, 176, 259, 176)
+  assert builder.getTileRanges((-180, -90, 180, 90), 2) == (0, 0, 3, 3)
+
+
+def testSyntheticDatasetHasTiles(tmp_path):
+  dataset = SyntheticDataset(nbOfActivities=2, nbOfIndicators=2, nbOfCountries=2, nutsBranching=2, sparsity=1)
+  dataset.writeCsv(str(tmp_path / 'data'))
+  folder = str(tmp_path / 'output')
+  os.makedirs(folder)
+  publication = MosesPublication(FileDataSource(str(tmp_path / 'data')), isBuildingTileCache=True, wmsTimeLayerMode=False,
+                                 isBuildingContexts=False, **getOutputOptions(folder))
+  assert publication.tileCacheBuilder.numberOfTiles > 0
+
+
+def testTilesetsCombineBaseLayers(publish, tmp_path):
+  publish('base', isBuildingTileCache=True, isUsingBaseLayers=True)
+  with open(str(tmp_path / 'base' / 'moses-mapcache.xml')) as configFile:
+    config = configFile.read()
+  assert '<LAYERS>MOSES.Base.NUTS2,MOSES.Fisheries-Aquaculture.031.V11110.NUTS2.2013</LAYERS>' in config
+  assert '<tileset name="MOSES.Fisheries-Aquaculture.031.V11110.NUTS2.2013">' in config
+
+
+def testMultipartNutsSeedTheirParts(publish, tmp_path):
+  # France with Corsica and Reunion, its bounding box spanning Africa
+  folder = str(tmp_path / 'data')
+  shutil.copytree(DATA_FOLDER, folder)
+  nutsFile = os.path.join(folder, 'nuts.csv')
+  with open(nutsFile) as csvFile:
+    nuts = csvFile.read()
+  with open(nutsFile, 'w') as csvFile:
+    csvFile.write(nuts.replace('FR;0;-5.14;41.33;9.56;51.09', 'FR;0;-5.14;-21.39;55.84;51.09'))
+  parts = [(-5.14, 42.33, 8.23, 51.09), (8.53, 41.33, 9.56, 43.03), (55.21, -21.39, 55.84, -20.87)]
+  geometry = {'type': 'MultiPolygon',
+              'coordinates': [[[[minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny]]]
+                              for minx, miny, maxx, maxy in parts]}
+  with open(os.path.join(folder, 'nuts.geojson'), 'w') as geojsonFile:
+    json.dump({'type': 'FeatureCollection',
+               'features': [{'type': 'Feature', 'properties': {'nuts_id': 'FR', 'levl_code': 0}, 'geometry': geometry}]},
+              geojsonFile)
+  source = FileDataSource(folder)
+  assert source.getNutsPartExtents([0, 1]) == {'FR': parts}
+
+  publication = publish('tiles', source, isBuildingTileCache=True)
+  layerName = 'MOSES.Fisheries-Aquaculture.031.V11110.NUTS0.2013'
+  tiles = {tuple(int(c) for c in row[1:]) for row in readSeeds(str(tmp_path / 'tiles')) if row[0] == layerName}
+  # Tiles of the parts of France and of the bounding box of Belgium which has no geometry
+  builder = publication.tileCacheBuilder
+  expected = set()
+  for zoom in range(0, 7):
+    for minColumn, minRow, maxColumn, maxRow in [builder.getTileRanges(extent, zoom)
+                                                 for extent in parts + [source.getNutsExtents()['BE']]]:
+      expected.update((zoom, column, row) for column in range(minColumn, maxColumn + 1) for row in range(minRow, maxRow + 1))
+  assert tiles == expected
+  # The bounding box of France would seed Africa
+  minColumn, minRow, maxColumn, maxRow = builder.getTileRanges(source.getNutsExtents()['FR'], 6)
+  assert len([tile for tile in tiles if tile[0] == 6]) < (maxColumn - minColumn + 1) * (maxRow - minRow + 1) / 10
+  assert (6,) + tuple(builder.getTileRanges((20, 10, 20, 10), 6)[:2]) not in tiles
@@ -0,0 +1,44 @@
+import json
+import os
+import shutil
+
+import numpy
+
+from conftest import DATA_FOLDER
+from moses_mapfile import FileDataSource
+
+
+def writeGeometries(folder, geometries):
+  with open(os.path.join(folder, 'nuts.geojson'), 'w') as geojsonFile:
+    json.dump({'type': 'FeatureCollection',
+               'features': [{'type': 'Feature', 'properties': {'nuts_id': nutsId, 'levl_code': level}, 'geometry': geometry}
+                            for nutsId, level, geometry in geometries]},
+              geojsonFile)
+
+
+def testExportVectors(publish, tmp_path):
+  folder = str(tmp_path / 'data')
+  shutil.copytree(DATA_FOLDER, folder)
+  # BE has no geometry in the NUTS table
+  france = {'type': 'Polygon', 'coordinates': [[[-5.14, 41.33], [9.56, 41.33], [9.56, 51.09], [-5.14, 41.33]]]}
+  writeGeometries(folder, [('BE', 0, None), ('FR', 0, france)])
+  vectorFolder = str(tmp_path / 'vectors')
+  publish('vectors', FileDataSource(folder), isExportingVectors=True, vectorFolder=vectorFolder,
+          vectorBaseUrl='http://localhost/vectors/')
+
+  with open(os.path.join(vectorFolder, 'nuts0.geojson')) as geojsonFile:
+    geometries = json.loads(geojsonFile.read())
+  assert geometries == {'type': 'FeatureCollection',
+                        'features': [{'type': 'Feature', 'properties': {'nuts_id': 'FR', 'index': 0}, 'geometry': france}]}
+
+  with open(os.path.join(vectorFolder, 'moses-vector.json')) as manifestFile:
+    manifest = json.load(manifestFile)
+  # BE values are still exported, indexed after the NUTS having a geometry
+  assert manifest['levels']['0'] == {'geometry': 'http://localhost/vectors/nuts0.geojson', 'nutsIds': ['FR', 'BE']}
+  assert manifest['levels']['1']['geometry'] is None
+  indicator = manifest['indicators'][0]
+  assert (indicator['activity'], indicator['indicator']) == ('03,1', 'V11110')
+  assert indicator['levels']['0']['years'] == ['2013', '2014', '2015']
+  values = numpy.fromfile(os.path.join(vectorFolder, '031.V11110.f32'), dtype='<f4')
+  assert values[:6].tolist()[:5] == [3541, 120, 3610, 130, 3702]
+  assert numpy.isnan(values[5])